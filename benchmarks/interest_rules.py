@@ -0,0 +1,110 @@
+"""
+Throughput of scoring a parsed batch with the interest rules.
+
+Scores the same Vehicles, built from the recorded U Pull & Save rows (see
+recorded.py) scaled to a synthetic sweep, three ways:
+
+    inline       the condition each scraper used to hard-code, for reference
+    interpreted  the rules of interest_rules.json read and matched car by car, uncompiled
+    compiled     common.interest.score_vehicles, the rules as the scrapers run them
+
+and checks that all three give every car the same interest level.
+
+    python benchmarks/interest_rules.py [--size 100000] [--repeat 5] [--source upullandsave]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from common.interest import INTEREST_RULES_PATH, InterestRules
+from common.vehicle import Vehicle
+from recorded import Recordings
+
+def build_vehicles(rows, source):
+    return [Vehicle(source=source, location="Hebron", make="MERCEDES-BENZ", year=car['year'], model=car['model'], stock_num=car['stock_number'], vin=car['vin']) for car in rows]
+
+def score_inline(cars):
+    for car in cars:
+        year = car['year']
+        model = car['model']
+        if (year >= 1976 and year <= 1985) or (year >= 1996 and year <= 2002 and model == "E-CLASS"):
+            car['interest_level'] = 1
+        else:
+            car['interest_level'] = 0
+    return cars
+
+def interpreted_scorer(config, source):
+    """Return a scorer matching the source's rules from the raw config, as a hand-written loop would."""
+    override = config.get('yards', {}).get(source, {})
+    names = {rule['name'] for rule in override.get('rules', [])}
+    rules = [rule for rule in config.get('rules', []) if rule['name'] not in names] + override.get('rules', [])
+    min_level = override.get('min_level', 0)
+
+    def matches(rule, car):
+        if rule.get('years') and not any(low <= car['year'] <= high for low, high in rule['years']):
+            return False
+        for field in ('make', 'model'):
+            if rule.get(field) and not (car.get(field) and re.search(rule[field], car[field])):
+                return False
+        return True
+
+    def score(cars):
+        kept = []
+        for car in cars:
+            car['interest_level'] = max([rule['level'] for rule in rules if matches(rule, car)], default=0)
+            if car['interest_level'] >= min_level:
+                kept.append(car)
+        return kept
+
+    return score
+
+def best_time(score, cars, repeat):
+    """Return the fastest of repeat runs of score over cars, and the levels it gave them."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        score(cars)
+        timings.append(time.perf_counter() - start)
+    return min(timings), [car['interest_level'] for car in cars]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--source", default="upullandsave", help="yard whose rules are applied")
+    args = parser.parse_args()
+
+    recordings = Recordings(args.size)
+    rows = recordings.json_rows(recordings.upullandsave["data"], "stock_number", 0, args.size)
+    cars = build_vehicles(rows, args.source)
+
+    with open(INTEREST_RULES_PATH) as file:
+        config = json.load(file)
+    start = time.perf_counter()
+    compiled = InterestRules(config).for_yard(args.source)
+    compile_time = time.perf_counter() - start
+
+    results = {
+        "inline": best_time(score_inline, cars, args.repeat),
+        "interpreted": best_time(interpreted_scorer(config, args.source), cars, args.repeat),
+        "compiled": best_time(compiled.score, cars, args.repeat),
+    }
+
+    print(f"Scoring {len(cars)} cars with the {args.source} rules of {INTEREST_RULES_PATH} (compiled in {compile_time * 1000:.2f} ms)")
+    print(f"{'scorer':<12} {'best':>10} {'per car':>10} {'cars/s':>12}")
+    for name, (seconds, _) in results.items():
+        print(f"{name:<12} {seconds * 1000:>8.1f}ms {seconds / len(cars) * 1e9:>8.0f}ns {len(cars) / seconds:>12,.0f}")
+    interesting = sum(1 for level in results["compiled"][1] if level)
+    print(f"{interesting} cars of interest.")
+    if results["interpreted"][1] != results["compiled"][1]:
+        print("The compiled rules disagree with the interpreted rules.")
+    if results["inline"][1] != results["compiled"][1]:
+        print("The compiled rules disagree with the inline condition (expected for yards with overridden rules).")
+
+if __name__ == "__main__":
+    main()
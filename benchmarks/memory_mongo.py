@@ -0,0 +1,147 @@
+"""
+In-memory stand-in for the parts of a pymongo collection the scrapers use.
+
+Supports find/find_one/count_documents with equality, $in, $exists and $or filters,
+inclusion and exclusion projections, insert_one/insert_many, bulk_write with
+InsertOne, UpdateOne ($set) and DeleteMany, and create_index. Documents are
+also indexed by stock_num, so the reconcile lookups stay cheap at 100k cars
+the way they are on a real, indexed collection.
+"""
+from bson import ObjectId
+from collections import defaultdict
+from pymongo import DeleteMany, InsertOne, UpdateOne
+import threading
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+            continue
+        value = doc.get(field)
+        if isinstance(condition, dict) and "$in" in condition:
+            if value not in condition["$in"]:
+                return False
+        elif isinstance(condition, dict) and "$exists" in condition:
+            if (field in doc) != condition["$exists"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+def project(doc, projection):
+    if not projection:
+        return dict(doc)
+    included = [field for field, wanted in projection.items() if wanted and field != "_id"]
+    if included:
+        projected = {field: doc[field] for field in included if field in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        return projected
+    return {field: value for field, value in doc.items() if projection.get(field, 1)}
+
+class BulkWriteResult:
+    def __init__(self):
+        self.inserted_count = 0
+        self.modified_count = 0
+        self.deleted_count = 0
+
+class MemoryCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._docs = {}
+        self._by_stock_num = defaultdict(set)
+        self._indexes = {"_id_": {"key": [("_id", 1)]}}
+        # Yards of the same source reconcile from parallel threads
+        self._lock = threading.RLock()
+
+    def create_index(self, keys, **kwargs):
+        keys = [(keys, 1)] if isinstance(keys, str) else list(keys)
+        name = kwargs.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+        self._indexes[name] = dict(kwargs, key=keys)
+        return name
+
+    def index_information(self):
+        return dict(self._indexes)
+
+    def _candidates(self, query):
+        condition = query.get("stock_num")
+        if condition is None:
+            return list(self._docs.values())
+        stock_nums = condition["$in"] if isinstance(condition, dict) else [condition]
+        ids = set()
+        for stock_num in stock_nums:
+            ids.update(self._by_stock_num.get(stock_num, ()))
+        return [self._docs[doc_id] for doc_id in ids]
+
+    def find(self, query=None, projection=None):
+        query = query or {}
+        with self._lock:
+            return iter([project(doc, projection) for doc in self._candidates(query) if matches(doc, query)])
+
+    def find_one(self, query=None, projection=None):
+        return next(self.find(query, projection), None)
+
+    def count_documents(self, query):
+        return sum(1 for _ in self.find(query))
+
+    def insert_one(self, doc):
+        doc.setdefault("_id", ObjectId())
+        stored = dict(doc)
+        with self._lock:
+            self._docs[stored["_id"]] = stored
+            if "stock_num" in stored:
+                self._by_stock_num[stored["stock_num"]].add(stored["_id"])
+
+    def insert_many(self, docs, ordered=True):
+        with self._lock:
+            for doc in docs:
+                self.insert_one(doc)
+
+    def _update_one(self, query, update):
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                changed = {field: value for field, value in update["$set"].items() if doc.get(field) != value}
+                doc.update(changed)
+                return 1 if changed else 0
+        return 0
+
+    def _delete_many(self, query):
+        doomed = [doc for doc in self._candidates(query) if matches(doc, query)]
+        for doc in doomed:
+            del self._docs[doc["_id"]]
+            self._by_stock_num[doc.get("stock_num")].discard(doc["_id"])
+        return len(doomed)
+
+    def bulk_write(self, operations, ordered=True):
+        result = BulkWriteResult()
+        with self._lock:
+            self._apply(operations, result)
+        return result
+
+    def _apply(self, operations, result):
+        for operation in operations:
+            if isinstance(operation, InsertOne):
+                self.insert_one(operation._doc)
+                result.inserted_count += 1
+            elif isinstance(operation, UpdateOne):
+                result.modified_count += self._update_one(operation._filter, operation._doc)
+            elif isinstance(operation, DeleteMany):
+                result.deleted_count += self._delete_many(operation._filter)
+            else:
+                # reconcile only sends the operations above
+                raise TypeError(f"unsupported bulk operation {type(operation).__name__}")
+
+class MemoryDatabase:
+    def __init__(self, name="benchmark"):
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(self, name)
+        return self._collections[name]
+
+    def command(self, *args, **kwargs):
+        return {"ok": 1}
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of the HTML parsing step of the table-based scrapers.
+
+Parses the saved page fixtures in benchmarks/fixtures twice: the way the
+scrapers used to (a full html.parser tree of the whole page), and through
+common.parsing with each scraper's INVENTORY_STRAINER, so only the inventory
+rows are built. Prints the median parse time and the peak memory of both.
+
+    python benchmarks/parse_html.py [repeat]
+"""
+from bs4 import BeautifulSoup
+import importlib
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.parsing import HTML_PARSER, parse_html
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# How each scraper finds its inventory rows once the page is parsed
+ROW_FINDERS = {
+    "jacks": lambda soup: soup.find('table', {'id': 'vehicles'}).find('tbody').find_all('tr'),
+    "lkq": lambda soup: soup.find_all('div', {'class': 'pypvi_resultRow'}),
+    "pullnsave": lambda soup: soup.find('table', {'class': 'table', 'id': 'vehicletable1'}).find('tbody').find_all('tr'),
+    "utpap": lambda soup: soup.find('table', {'class': 'resultsTable', 'id': 'cars-table'}).find_all('tr'),
+}
+
+def measure(parse, markup, find_rows, repeat):
+    """Return the median seconds, peak traced bytes and row count of parsing markup."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = find_rows(parse(markup))
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    find_rows(parse(markup))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak, len(rows)
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f"{'source':<10} {'rows':>5} {'html.parser full':>18} {HTML_PARSER + ' strained':>18} {'speedup':>8} {'peak before':>12} {'peak after':>12}")
+    for source, find_rows in ROW_FINDERS.items():
+        with open(os.path.join(FIXTURES_DIR, f"{source}.html")) as file:
+            markup = file.read()
+        strainer = importlib.import_module(f"{source}.main").INVENTORY_STRAINER
+
+        before, before_peak, before_rows = measure(lambda page: BeautifulSoup(page, 'html.parser'), markup, find_rows, repeat)
+        after, after_peak, after_rows = measure(lambda page: parse_html(page, strainer), markup, find_rows, repeat)
+        assert before_rows == after_rows, f"{source}: {before_rows} rows before, {after_rows} after"
+
+        print(f"{source:<10} {after_rows:>5} {before * 1000:>16.1f}ms {after * 1000:>16.1f}ms {before / after:>7.1f}x {before_peak / 1024:>10.0f}KB {after_peak / 1024:>10.0f}KB")
+
+if __name__ == "__main__":
+    main()
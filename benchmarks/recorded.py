@@ -0,0 +1,179 @@
+"""
+Recorded responses of every yard's endpoints, scaled to any inventory size.
+
+The fixtures in benchmarks/fixtures hold a page or a few dozen rows of each
+endpoint's real response format. Recordings(size) answers a request the way
+the live site would for an inventory of `size` vehicles, by repeating the
+recorded rows and giving every copy its own stock number and VIN. Sources
+that search two yards get half the inventory per yard.
+
+    status, content_type, body = Recordings(10000).respond("GET", url, data)
+"""
+from urllib.parse import parse_qs, urlparse
+import itertools
+import json
+import os
+import re
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+HTML = "text/html; charset=UTF-8"
+JSON = "application/json"
+
+# Rows per page of the LKQ inventory
+LKQ_PAGE_SIZE = 25
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as file:
+        return file.read()
+
+def load_json_fixture(name):
+    return json.loads(load_fixture(name))
+
+def unique_vin(vin, index):
+    """Return a 17 character VIN made unique by replacing its serial number."""
+    return f"{vin.strip()[:11]}{index:06d}"
+
+def split_rows(markup, start, end, row_pattern):
+    """Split a page into the markup before its inventory rows, the rows, and the markup after them."""
+    head, rest = markup.split(start, 1)
+    body, tail = rest.split(end, 1)
+    return head + start, re.findall(row_pattern, body, re.S), end + tail
+
+def replace_cells(row, replacements):
+    """Replace the text of a table row's cells by index, with functions of the old text."""
+    cells = itertools.count()
+
+    def replace(match):
+        index = next(cells)
+        if index not in replacements:
+            return match.group(0)
+        return f"{match.group(1)}{replacements[index](match.group(2))}{match.group(3)}"
+
+    return re.sub(r"(<td[^>]*>)(.*?)(</td>)", replace, row, flags=re.S)
+
+class HtmlTable:
+    """A recorded HTML page whose inventory rows are table rows."""
+
+    def __init__(self, fixture, start, end, uniquify):
+        self.head, self.rows, self.tail = split_rows(load_fixture(fixture), start, end, r"<tr>.*?</tr>")
+        self.uniquify = uniquify
+
+    def render(self, count, key=""):
+        rows = (self.uniquify(row, key, index) for index, row in zip(range(count), itertools.cycle(self.rows)))
+        return self.head + "".join(rows) + self.tail
+
+class Recordings:
+    """Answers the requests of every scraper for an inventory of `size` vehicles."""
+
+    def __init__(self, size):
+        self.size = size
+        self.per_yard = max(1, size // 2)
+
+        self.jacks = HtmlTable("jacks.html", "<tbody>", "</tbody>",
+                               lambda row, key, i: replace_cells(row, {5: lambda row_num: f"{row_num}-{i}"}))
+        self.utpap = HtmlTable("utpap.html", '<table class="resultsTable" id="cars-table">', "</table>",
+                               lambda row, key, i: replace_cells(row, {3: lambda stock: f"{stock}-{key}-{i}"}))
+        self.pullnsave = HtmlTable("pullnsave.html", "<tbody>", "</tbody>",
+                                   lambda row, key, i: replace_cells(row, {7: lambda stock: f"{stock}-{key}-{i}", 8: lambda vin: unique_vin(vin, i)}))
+
+        lkq = load_fixture("lkq.html")
+        self.lkq_head, rest = lkq.split('<div class="pypvi_results">', 1)
+        self.lkq_head += '<div class="pypvi_results">'
+        rows = rest.split('<div class="pypvi_end">', 1)[0]
+        self.lkq_rows = re.split(r'(?=<div class="pypvi_resultRow")', rows)[1:]
+
+        self.picknpull = load_json_fixture("picknpull_search.json")
+        self.picknpull_vehicle = load_fixture("picknpull_vehicle.json")
+        self.pullapart = load_json_fixture("pullapart_search.json")
+        self.pullapart_extended_info = load_fixture("pullapart_extended_info.json")
+        self.pullapart_image = load_fixture("pullapart_image.json")
+        self.tearapart_inventory = load_fixture("tearapart_inventory.html")
+        self.tearapart = load_json_fixture("tearapart_search.json")
+        self.upullandsave = load_json_fixture("upullandsave.json")
+        self.nhtsa_result = load_json_fixture("nhtsa_batch.json")["Results"][0]
+        self._cache = {}
+
+    def lkq_page(self, store, page):
+        first = (page - 1) * LKQ_PAGE_SIZE
+        last = min(page * LKQ_PAGE_SIZE, self.per_yard)
+        rows = []
+        for i in range(first, last):
+            row = self.lkq_rows[i % len(self.lkq_rows)]
+            row = re.sub(r"(<b>Stock #:</b> )([^<]+)", lambda match: f"{match.group(1)}{match.group(2)}-{store}-{i}", row)
+            row = re.sub(r"(<b>VIN:</b> )(\w+)", lambda match: f"{match.group(1)}{unique_vin(match.group(2), i)}", row)
+            rows.append(row)
+        end = '<div class="pypvi_end"></div>' if last >= self.per_yard else ""
+        return self.lkq_head + "".join(rows) + end + "</div>"
+
+    def json_rows(self, rows, stock_key, start, stop):
+        """Return rows start to stop of the recorded JSON rows repeated, with unique stock numbers and VINs."""
+        scaled = []
+        for i in range(start, stop):
+            row = rows[i % len(rows)]
+            row = dict(row, vin=unique_vin(row["vin"], i))
+            row[stock_key] = row[stock_key] + i * 1000000 if isinstance(row[stock_key], int) else f"{row[stock_key]}-{i}"
+            scaled.append(row)
+        return scaled
+
+    def respond(self, method, url, data=None):
+        """
+        Return the status, content type and body (bytes) the live site would answer a request with.
+
+        Inventory responses are built once and then served from memory, so
+        repeated runs measure the scraper rather than this module.
+        """
+        key = (method, url, data if isinstance(data, str) else json.dumps(data, sort_keys=True))
+        if key in self._cache:
+            return self._cache[key]
+        status, content_type, body = self._respond(method, url, data)
+        response = status, content_type, body.encode()
+        # VIN decodes and webhooks differ for every request, so they aren't worth keeping
+        if "vpic.nhtsa" not in url and "/api/webhook/" not in url:
+            self._cache[key] = response
+        return response
+
+    def _respond(self, method, url, data):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        form = parse_qs(data) if isinstance(data, str) else {key: [value] for key, value in (data or {}).items()}
+        host, path = parsed.netloc, parsed.path
+
+        if "jacksusedautoparts" in host:
+            return 200, HTML, self.jacks.render(self.size)
+        if "pyp.com" in host:
+            return 200, HTML, self.lkq_page(query["store"][0], int(query["page"][0]))
+        if "picknpull" in host and path.endswith("/search"):
+            location = dict(self.picknpull[0], vehicles=self.json_rows(self.picknpull[0]["vehicles"], "barCodeNumber", 0, self.size))
+            return 200, JSON, json.dumps([location])
+        if "picknpull" in host:
+            return 200, JSON, self.picknpull_vehicle
+        if "inventoryservice.pullapart" in host and "/Vehicle/Search" in path:
+            location = dict(self.pullapart[0], exact=[
+                dict(row, ticketID=row["ticketID"] + i * 1000000)
+                for i, row in enumerate(self.json_rows(self.pullapart[0]["exact"], "vinID", 0, self.size))
+            ])
+            return 200, JSON, json.dumps([location])
+        if "inventoryservice.pullapart" in host:
+            return 200, JSON, self.pullapart_extended_info
+        if "imageservice.pullapart" in host:
+            return 200, JSON, self.pullapart_image
+        if "pullnsave" in host:
+            return 200, HTML, self.pullnsave.render(self.per_yard, form.get("store", [""])[0])
+        if "tearapart" in host and "admin-ajax" in path:
+            return 200, JSON, json.dumps(dict(self.tearapart, products=self.json_rows(self.tearapart["products"], "stocknumber", 0, self.size)))
+        if "tearapart" in host:
+            return 200, HTML, self.tearapart_inventory
+        if "upullandsave" in host:
+            start, length = int(form["start"][0]), int(form["length"][0])
+            rows = self.json_rows(self.upullandsave["data"], "stock_number", start, min(start + length, self.size))
+            return 200, JSON, json.dumps(dict(self.upullandsave, recordsTotal=self.size, recordsFiltered=self.size, data=rows))
+        if "utpap" in host:
+            yard = re.search(r"search-inventory_(\w+)\.php", path).group(1)
+            return 200, HTML, self.utpap.render(self.per_yard, yard)
+        if "vpic.nhtsa" in host:
+            vins = form.get("data", [""])[0].split(";")
+            return 200, JSON, json.dumps({"Count": len(vins), "Results": [dict(self.nhtsa_result, VIN=vin) for vin in vins]})
+        if "/api/webhook/" in path:
+            return 200, JSON, ""
+        return 404, HTML, "Not Found"
@@ -0,0 +1,151 @@
+"""
+Local HTTP server that stands in for every yard site, vPIC and the Home Assistant webhook.
+
+Serves the recorded responses of benchmarks/recorded.py, scaled to a
+synthetic inventory size, with configurable latency and injected faults, so
+concurrency changes can be load-tested without touching the real sites.
+Point the scrapers at it with the shared HTTP client's base-URL override:
+
+    python benchmarks/replay_server.py --size 10000 --latency lognormal:120:0.6 --error-rate 0.02
+    HTTP_BASE_URL_OVERRIDE=http://127.0.0.1:8800 python -m common.runtime
+
+Requests arrive as /<original host>/<original path>. Latency specs are in
+milliseconds: fixed:MS, uniform:LOW:HIGH, exponential:MEAN or
+lognormal:MEDIAN:SIGMA. --host-latency sets a different one for a single host.
+"""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import math
+import os
+import random
+import signal
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from recorded import Recordings
+
+def parse_latency(spec):
+    """Turn a latency spec into a function returning a delay in seconds."""
+    kind, *params = spec.split(":")
+    params = [float(param) for param in params]
+    if kind == "fixed":
+        delay = params[0] / 1000
+        return lambda: delay
+    if kind == "uniform":
+        low, high = params[0] / 1000, params[1] / 1000
+        return lambda: random.uniform(low, high)
+    if kind == "exponential":
+        mean = params[0] / 1000
+        return lambda: random.expovariate(1 / mean) if mean > 0 else 0.0
+    if kind == "lognormal":
+        median, sigma = params[0] / 1000, params[1]
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, recordings, latency, host_latency, error_rate, error_statuses, reset_rate, verbose):
+        super().__init__(address, ReplayHandler)
+        self.recordings = recordings
+        self.latency = latency
+        self.host_latency = host_latency
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.reset_rate = reset_rate
+        self.verbose = verbose
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+
+    def count(self, host, outcome):
+        with self._counts_lock:
+            self.counts[(host, outcome)] += 1
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    # Keep connections alive so the client's connection pooling is exercised
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.replay("GET")
+
+    def do_POST(self):
+        self.replay("POST")
+
+    def replay(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length).decode() if length else None
+        host = self.path.lstrip("/").split("/", 1)[0]
+        url = f"https://{self.path.lstrip('/')}"
+
+        time.sleep(server.host_latency.get(host, server.latency)())
+
+        if random.random() < server.reset_rate:
+            # Drop the connection without answering
+            server.count(host, "reset")
+            self.close_connection = True
+            return
+
+        if random.random() < server.error_rate:
+            status, content_type, body = random.choice(server.error_statuses), "text/plain", b"Injected fault"
+            server.count(host, "error")
+        else:
+            status, content_type, body = server.recordings.respond(method, url, data)
+            server.count(host, status)
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--size", type=int, default=1000, help="vehicles in each source's inventory")
+    parser.add_argument("--latency", default="fixed:0", help="latency spec applied to every request")
+    parser.add_argument("--host-latency", action="append", default=[], metavar="HOST=SPEC", help="latency spec for one host")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered with an error status")
+    parser.add_argument("--error-statuses", type=int, nargs="+", default=[429, 500, 502, 503, 504])
+    parser.add_argument("--reset-rate", type=float, default=0, help="share of requests whose connection is dropped")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    host_latency = dict(entry.split("=", 1) for entry in args.host_latency)
+    server = ReplayServer(
+        (args.host, args.port),
+        Recordings(args.size),
+        parse_latency(args.latency),
+        {host: parse_latency(spec) for host, spec in host_latency.items()},
+        args.error_rate,
+        args.error_statuses,
+        args.reset_rate,
+        args.verbose,
+    )
+    # Print the summary on docker stop and kill as well as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print(f"Replaying {args.size} vehicles per source on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for (host, outcome), count in sorted(server.counts.items(), key=str):
+            print(f"{host:<40} {str(outcome):<6} {count:>7}")
+
+if __name__ == "__main__":
+    main()
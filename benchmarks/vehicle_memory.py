@@ -0,0 +1,73 @@
+"""
+Memory per record of the canonical Vehicle against the plain dicts the scrapers used to build.
+
+Both are built from the same recorded U Pull & Save rows (see recorded.py),
+scaled to a synthetic sweep, with the same fields and values. The rows
+themselves are allocated before measuring, so only the records and the
+values built for them are counted.
+
+    python benchmarks/vehicle_memory.py [--size 100000]
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from common.vehicle import Vehicle
+from recorded import Recordings
+
+def car_fields(car):
+    images = car['images'] or []
+    return {
+        "location": "Hebron",
+        "year": int(car['year']),
+        "model": car['model'].upper(),
+        "vin": car['vin'],
+        "stock_num": car['stock_number'],
+        "color": car['color'],
+        "row": str(car['yard_row']),
+        "date": car['date_set'],
+        "image": images[0]['url'] if images else None,
+        "image_urls": [image['url'] for image in images],
+        "interest_level": 0,
+    }
+
+def build_dicts(rows):
+    return [dict(car_fields(car), source="upullandsave") for car in rows]
+
+def build_vehicles(rows):
+    return [Vehicle(source="upullandsave", **car_fields(car)) for car in rows]
+
+def measure(build, rows):
+    """Return the bytes held by the records build makes from rows."""
+    gc.collect()
+    tracemalloc.start()
+    records = build(rows)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return current
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=100000)
+    args = parser.parse_args()
+
+    recordings = Recordings(args.size)
+    rows = recordings.json_rows(recordings.upullandsave["data"], "stock_number", 0, args.size)
+
+    dicts = measure(build_dicts, rows)
+    vehicles = measure(build_vehicles, rows)
+    container_dict = sys.getsizeof(build_dicts(rows[:1])[0])
+    container_vehicle = sys.getsizeof(build_vehicles(rows[:1])[0])
+
+    print(f"{'record':<10} {'total':>10} {'per record':>11} {'container':>10}")
+    print(f"{'dict':<10} {dicts / 1024 / 1024:>8.1f}MB {dicts / args.size:>9.0f} B {container_dict:>8} B")
+    print(f"{'Vehicle':<10} {vehicles / 1024 / 1024:>8.1f}MB {vehicles / args.size:>9.0f} B {container_vehicle:>8} B")
+    print(f"Vehicle records take {100 * (1 - vehicles / dicts):.0f}% less memory for {args.size} cars.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Offline benchmark of every yard scraper, end to end.
+
+Each scraper's run() is driven against the recorded responses in
+benchmarks/fixtures (see recorded.py), scaled to synthetic inventories, with
+an in-memory MongoDB stand-in (see memory_mongo.py) in place of MONGO_URI.
+Nothing touches the network. For every source, size and scenario it reports
+throughput, latency percentiles and the peak traced memory of a run, and can
+write the results as JSON so runs can be compared over time.
+
+Scenarios:
+    cold       empty database, no snapshots or cached VIN decodes: every car is new
+    warm       database already holds the inventory, snapshots cleared: full reconcile, nothing new
+    unchanged  database and snapshots kept: the unchanged-inventory fast path
+
+    python benchmarks/yards.py [--sources jacks lkq] [--sizes 1000 10000 100000]
+                               [--scenarios cold warm] [--repeat 3] [--output results.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Keep every file the scrapers write out of the real locations, and never post to Home Assistant
+STATE_DIR = tempfile.mkdtemp(prefix="yard-benchmark-")
+os.environ["SNAPSHOT_DIR"] = os.path.join(STATE_DIR, "snapshots")
+os.environ["VIN_CACHE_PATH"] = os.path.join(STATE_DIR, "vin_cache.sqlite3")
+os.environ["PULLAPART_IMAGE_CACHE_PATH"] = os.path.join(STATE_DIR, "missing_images.sqlite3")
+os.environ["TEARAPART_NONCE_CACHE_PATH"] = os.path.join(STATE_DIR, "nonce.json")
+os.environ["HA_SPOOL_PATH"] = os.path.join(STATE_DIR, "spool.jsonl")
+os.environ["CHURN_HISTORY_PATH"] = os.path.join(STATE_DIR, "churn.json")
+os.environ["HOME_ASSISTANT_WEBHOOK_ID"] = "benchmark"
+os.environ["HA_FLUSH_INTERVAL"] = "0"
+os.environ["HTTP_MAX_RETRIES"] = "0"
+
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from common.http_client import session
+from common.notify import notifier
+from common.runtime import ADAPTERS, load_adapters
+from memory_mongo import MemoryDatabase
+from recorded import Recordings
+
+SCENARIOS = ["cold", "warm", "unchanged"]
+
+class RecordedTransport:
+    """Stands in for the shared requests.Session, answering every request from the recordings."""
+
+    def __init__(self):
+        self.recordings = None
+
+    def request(self, method, url, data=None, **kwargs):
+        status, content_type, body = self.recordings.respond(method, url, data)
+        response = requests.models.Response()
+        response.status_code = status
+        response.headers["Content-Type"] = content_type
+        response.url = url
+        response.encoding = "utf-8"
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        pass
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+def clear_run_state(clear_snapshots=True):
+    """Forget the snapshots (and VIN decodes and image misses) earlier runs left behind."""
+    if clear_snapshots:
+        shutil.rmtree(os.environ["SNAPSHOT_DIR"], ignore_errors=True)
+    for path, table in [(os.environ["VIN_CACHE_PATH"], "vin_decodes"), (os.environ["PULLAPART_IMAGE_CACHE_PATH"], "misses")]:
+        try:
+            with sqlite3.connect(path) as connection:
+                connection.execute(f"DELETE FROM {table}")
+        except sqlite3.OperationalError:
+            pass
+
+class YardBenchmark:
+    """Runs one source's scraper against a scaled inventory."""
+
+    def __init__(self, name, adapter, size):
+        self.name = name
+        self.adapter = adapter
+        self.size = size
+        self.database = MemoryDatabase()
+        self.health = None
+
+    @property
+    def collection(self):
+        return self.database["cars"]
+
+    def prepare(self, scenario):
+        if scenario == "cold":
+            self.database = MemoryDatabase()
+            clear_run_state()
+        elif scenario == "warm":
+            clear_run_state()
+        # The scrapers look their collection up through the name they imported
+        self.adapter.get_collection = lambda: self.collection
+        # Keep the health status in memory, so the host's healthcheck files are never touched
+        self.adapter.update_health_status = self.set_health
+
+    def set_health(self, status):
+        self.health = status
+
+    def run_once(self):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            self.adapter.run()
+            elapsed = time.perf_counter() - start
+            # Deliver the queued notifications before the next run starts
+            notifier.flush()
+        return elapsed
+
+    def measure(self, scenario, repeat):
+        # Build the scaled responses, and the database the warm scenarios start from, outside the measurements
+        self.prepare("cold")
+        self.run_once()
+
+        latencies = []
+        for _ in range(repeat):
+            self.prepare(scenario)
+            latencies.append(self.run_once())
+
+        self.prepare(scenario)
+        tracemalloc.start()
+        self.run_once()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        median = percentile(latencies, 50)
+        return {
+            "source": self.name,
+            "size": self.size,
+            "scenario": scenario,
+            "repeat": repeat,
+            "latency_ms": {
+                "p50": round(median * 1000, 2),
+                "p90": round(percentile(latencies, 90) * 1000, 2),
+                "p99": round(percentile(latencies, 99) * 1000, 2),
+                "min": round(min(latencies) * 1000, 2),
+                "max": round(max(latencies) * 1000, 2),
+            },
+            "throughput_vehicles_per_s": round(self.size / median, 1),
+            "peak_memory_kb": round(peak / 1024),
+            "stored_vehicles": self.collection.count_documents({}),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sources", nargs="+", default=ADAPTERS, choices=ADAPTERS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--scenarios", nargs="+", default=["cold", "warm"], choices=SCENARIOS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    transport = RecordedTransport()
+    session._session = transport
+    adapters = load_adapters(args.sources)
+    notifier.start()
+
+    results = []
+    print(f"{'source':<13} {'size':>7} {'scenario':<10} {'p50':>10} {'p90':>10} {'p99':>10} {'vehicles/s':>11} {'peak':>10} {'stored':>7}")
+    try:
+        for size in args.sizes:
+            transport.recordings = Recordings(size)
+            for name, adapter in adapters.items():
+                for scenario in args.scenarios:
+                    result = YardBenchmark(name, adapter, size).measure(scenario, args.repeat)
+                    results.append(result)
+                    latency = result["latency_ms"]
+                    print(f"{name:<13} {size:>7} {scenario:<10} {latency['p50']:>8.1f}ms {latency['p90']:>8.1f}ms {latency['p99']:>8.1f}ms "
+                          f"{result['throughput_vehicles_per_s']:>11.0f} {result['peak_memory_kb'] / 1024:>8.1f}MB {result['stored_vehicles']:>7}")
+    finally:
+        notifier.close()
+        shutil.rmtree(STATE_DIR, ignore_errors=True)
+
+    if args.output:
+        report = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
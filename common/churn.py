@@ -0,0 +1,105 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+import json
+import os
+import threading
+
+# Load environment variables
+load_dotenv()
+
+CHURN_HISTORY_PATH = os.getenv('CHURN_HISTORY_PATH', '/tmp/scheduler/churn.json')
+# Weight of the newest observation in each hour's moving average
+CHURN_SMOOTHING = float(os.getenv('CHURN_SMOOTHING', '0.3'))
+
+# Cars added and removed per source since the scheduler last asked
+_changes = defaultdict(int)
+_changes_lock = threading.Lock()
+
+def count_changes(source, changes):
+    """Add to the number of cars a source added or removed in the current run."""
+    with _changes_lock:
+        _changes[source] += changes
+
+def take_changes(source):
+    """Return and reset the number of cars a source added or removed since the last call, or None if no run of it finished comparing its inventory."""
+    with _changes_lock:
+        return _changes.pop(source, None)
+
+def hour_start(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+class ChurnHistory:
+    """
+    Learned inventory churn of each yard, by hour of the day.
+
+    Each yard keeps 24 moving averages of the cars it adds and removes per
+    hour. A run's changes are spread evenly over the hours since the
+    previous run, since they could have happened at any point in between.
+    Hours with no observations yet are None.
+    """
+
+    def __init__(self, path=CHURN_HISTORY_PATH, smoothing=CHURN_SMOOTHING):
+        self.path = path
+        self.smoothing = smoothing
+        self._rates = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as file:
+                    self._rates = json.load(file)
+            except ValueError:
+                pass
+
+    def rates(self, yard):
+        """Return the learned changes per hour of a yard for each hour of the day, or None if nothing is known."""
+        return self._rates.get(yard)
+
+    def record(self, yard, changes, since, until):
+        """Record the changes a yard's run found, made between the epoch times since and until."""
+        hours = (until - since) / 3600
+        if hours <= 0:
+            return
+        rate = changes / hours
+        rates = self._rates.setdefault(yard, [None] * 24)
+
+        moment = hour_start(datetime.fromtimestamp(since))
+        end = datetime.fromtimestamp(until)
+        seen = set()
+        while moment < end and len(seen) < 24:
+            hour = moment.hour
+            seen.add(hour)
+            previous = rates[hour]
+            rates[hour] = rate if previous is None else self.smoothing * rate + (1 - self.smoothing) * previous
+            moment += timedelta(hours=1)
+        self.save()
+
+    def time_to_changes(self, yard, start, target, default_rate, limit):
+        """
+        Return the seconds from the epoch time start until target changes are expected at a yard.
+
+        Walks forward hour by hour through the learned rates, so a quiet hour
+        followed by a busy one gives an interval that ends early in the busy
+        hour. Hours without observations use default_rate. Returns limit if
+        the target isn't reached within limit seconds.
+        """
+        rates = self.rates(yard) or [None] * 24
+        moment = datetime.fromtimestamp(start)
+        end = moment + timedelta(seconds=limit)
+        expected = 0
+        while moment < end:
+            rate = rates[moment.hour]
+            rate = default_rate if rate is None else rate
+            span = (min(hour_start(moment) + timedelta(hours=1), end) - moment).total_seconds()
+            if rate > 0 and expected + rate * span / 3600 >= target:
+                reached = moment + timedelta(seconds=(target - expected) / rate * 3600)
+                return (reached - datetime.fromtimestamp(start)).total_seconds()
+            expected += rate * span / 3600
+            moment += timedelta(seconds=span)
+        return limit
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path, "w") as file:
+            json.dump(self._rates, file)
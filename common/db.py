@@ -0,0 +1,235 @@
+from datetime import datetime
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DeleteMany, InsertOne, MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
+import os
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.churn import count_changes
+from common.metrics import db_timer
+from common.targets import unique_by_stock_num
+
+# Load environment variables
+load_dotenv()
+
+# MongoDB connection details
+MONGO_URI = os.getenv('MONGO_URI')
+MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
+MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
+# Append-only log of inventory changes, next to the current-inventory collection
+MONGO_EVENTS_COLLECTION_NAME = os.getenv('MONGO_EVENTS_COLLECTION_NAME', f"{MONGO_COLLECTION_NAME}_events")
+# Events older than this are removed by MongoDB's TTL monitor
+EVENT_RETENTION = int(float(os.getenv('EVENT_RETENTION_DAYS', '365')) * 86400)
+
+# One client (and connection pool) shared by every scraper in the process
+_client = None
+_client_lock = threading.Lock()
+# Collections whose indexes were already ensured by this process
+_indexed = set()
+_indexed_lock = threading.Lock()
+# Fields the stale lookups scope a source's inventory by, one per yard
+SCOPE_FIELDS = ("location", "yard")
+# Name of the (source, stock_num) index built when duplicates keep it from being unique
+NON_UNIQUE_KEY_INDEX = "source_1_stock_num_1_non_unique"
+
+def get_collection():
+    """Return the inventory collection from the shared MongoDB client."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MongoClient(MONGO_URI)
+    return _client[MONGO_DB_NAME][MONGO_COLLECTION_NAME]
+
+def get_events_collection(collection):
+    """Return the event log collection that belongs to an inventory collection."""
+    return collection.database[MONGO_EVENTS_COLLECTION_NAME]
+
+def close_connection():
+    """Close the shared MongoDB client."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+def ensure_unique_key(collection):
+    """
+    Make (source, stock_num) the unique key of the inventory.
+
+    The non-unique index of older versions is replaced. If the stored records
+    already hold duplicates, a non-unique index is built under its own name
+    instead, so lookups stay indexed, and later starts keep it rather than
+    failing the unique build again. A warning is printed either way.
+    """
+    keys = [("source", ASCENDING), ("stock_num", ASCENDING)]
+    indexes = collection.index_information()
+    existing = indexes.get("source_1_stock_num_1")
+    if existing and existing.get("unique"):
+        return
+    if NON_UNIQUE_KEY_INDEX in indexes:
+        print(f"{str(datetime.now())} - Warning: duplicate (source, stock_num) records in {collection.name}, keeping the non-unique index. Remove the duplicates and drop {NON_UNIQUE_KEY_INDEX} to make the key unique.")
+        return
+    if existing:
+        collection.drop_index("source_1_stock_num_1")
+    try:
+        collection.create_index(keys, unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        print(f"{str(datetime.now())} - Warning: duplicate (source, stock_num) records in {collection.name}, indexing them without a unique constraint: {e}")
+        collection.create_index(keys, name=NON_UNIQUE_KEY_INDEX)
+
+def ensure_indexes(collection, source):
+    """Create the indexes the reconcile queries and event history queries rely on, once per process."""
+    key = (collection.database.name, collection.name)
+    # Yards that start together wait for the first one to build the indexes
+    with _indexed_lock:
+        if key in _indexed:
+            return
+        with db_timer(source, "create_index"):
+            ensure_unique_key(collection)
+            # The stale lookup of a yard scoped by location or yard scans only that yard's keys
+            for field in SCOPE_FIELDS:
+                collection.create_index([("source", ASCENDING), (field, ASCENDING), ("stock_num", ASCENDING)])
+
+            events = get_events_collection(collection)
+            events.create_index([("source", ASCENDING), ("stock_num", ASCENDING), ("at", ASCENDING)])
+            events.create_index([("model", ASCENDING), ("type", ASCENDING)])
+            try:
+                events.create_index("at", name="at_ttl", expireAfterSeconds=EVENT_RETENTION)
+            except OperationFailure:
+                # The retention period changed since the index was created
+                collection.database.command("collMod", events.name, index={"name": "at_ttl", "expireAfterSeconds": EVENT_RETENTION})
+        _indexed.add(key)
+
+def fetch_known_cars(collection, source, cars, projection=None):
+    """Fetch the stored records for the given cars in a single query, keyed by stock number."""
+    if projection is None:
+        projection = {"_id": 0, "stock_num": 1, "source": 1}
+    stock_nums = list({car['stock_num'] for car in cars})
+    if not stock_nums:
+        return {}
+    # Records written before the source field existed are matched too, so they can be tagged
+    query = {"source": {"$in": [source, None]}, "stock_num": {"$in": stock_nums}}
+    with db_timer(source, "find_known"):
+        return {doc['stock_num']: doc for doc in collection.find(query, projection)}
+
+def fetch_records(collection, source, stock_nums, projection=None):
+    """Fetch the full stored records (minus the Object ID) of the given stock numbers, keyed by stock number."""
+    if projection is None:
+        projection = {"_id": 0}
+    stock_nums = list(stock_nums)
+    if not stock_nums:
+        return {}
+    with db_timer(source, "find_records"):
+        return {doc['stock_num']: doc for doc in collection.find({"source": source, "stock_num": {"$in": stock_nums}}, projection)}
+
+def select_new_cars(cars, known_cars):
+    """Return the cars that are not stored yet, keeping only the first car for each stock number."""
+    return unique_by_stock_num(cars, known_cars)
+
+def stored_filter(source, scope=None, legacy=None):
+    """
+    Return the filter matching the records stored for this source (and scope).
+
+    Records written before the source field existed have no source, so they
+    are matched too when `legacy` (by default the scope) tells them apart as
+    this yard's. Without either, they can't be attributed and are left alone.
+    """
+    query = {"source": source, **(scope or {})}
+    legacy = scope if legacy is None else legacy
+    if not legacy:
+        return query
+    return {"$or": [query, {"source": None, **legacy}]}
+
+def fetch_stale_cars(collection, source, latest_cars, scope=None, legacy=None):
+    """
+    Return the records stored for this source (and scope) that are not in the latest search, keyed by stock number.
+
+    The stored stock numbers are streamed through the indexes that lead with
+    the source. Matching untagged legacy records means the records are read,
+    but only this yard's. Only the few stale records are then fetched in full
+    for their event details.
+    """
+    query = stored_filter(source, scope, legacy)
+    latest_stock_nums = {car['stock_num'] for car in latest_cars}
+    with db_timer(source, "find_stale"):
+        stale_stock_nums = [doc['stock_num'] for doc in collection.find(query, {"_id": 0, "stock_num": 1}) if doc['stock_num'] not in latest_stock_nums]
+        if not stale_stock_nums:
+            return {}
+        query["stock_num"] = {"$in": stale_stock_nums}
+        return {doc['stock_num']: doc for doc in collection.find(query, {"_id": 0, "stock_num": 1, "year": 1, "model": 1, "first_seen": 1})}
+
+def build_events(source, new_cars, updates, stale_cars, at):
+    """Return the added, changed and removed events of a run."""
+    events = [
+        {"type": "added", "source": source, "stock_num": car['stock_num'], "at": at, "year": car.get('year'), "model": car.get('model'), "car": car}
+        for car in new_cars
+    ]
+    events += [
+        {"type": "changed", "source": source, "stock_num": stock_num, "at": at, "fields": fields}
+        for stock_num, fields in updates
+    ]
+    # Removed events carry what history queries need, so "how long do cars stay" is a single query
+    events += [
+        {"type": "removed", "source": source, "stock_num": stock_num, "at": at, "year": car.get('year'), "model": car.get('model'), "first_seen": car.get('first_seen')}
+        for stock_num, car in stale_cars.items()
+    ]
+    return events
+
+def reconcile(collection, source, latest_cars, known_cars, new_cars=(), updates=(), scope=None, legacy=None, logging_prefix="", delete_stale=True):
+    """
+    Apply a run's inserts, updates and stale deletes in one bulk write, then record them in the event log.
+
+    `updates` holds (stock_num, fields) pairs, and stale records are matched
+    with stored_filter(source, scope, legacy). Pass delete_stale=False when
+    latest_cars is only part of the inventory. Returns the inserted, updated
+    and deleted counts, and whether the events were logged.
+    """
+    stale_cars = fetch_stale_cars(collection, source, latest_cars, scope, legacy) if delete_stale else {}
+    stale_stock_nums = list(stale_cars)
+    now = datetime.utcnow()
+
+    # Insert dict copies: pymongo sets the _id on the document it is given, which a
+    # Vehicle has no field for, and the caller's records shouldn't pick up an ObjectId
+    operations = [InsertOne(dict(car, source=source, first_seen=now)) for car in new_cars]
+    # Every filter leads with the source, so the writes are found through the unique key
+    operations += [UpdateOne({"source": {"$in": [source, None]}, "stock_num": stock_num}, {"$set": fields}) for stock_num, fields in updates]
+    operations += [
+        UpdateOne({"source": None, "stock_num": stock_num}, {"$set": {"source": source}})
+        for stock_num, car in known_cars.items()
+        if car.get('source') is None
+    ]
+    if stale_stock_nums:
+        operations.append(DeleteMany({**stored_filter(source, scope, legacy), "stock_num": {"$in": stale_stock_nums}}))
+
+    counts = {"inserted": 0, "updated": 0, "deleted": 0}
+    if operations:
+        with db_timer(source, "bulk_write"):
+            result = collection.bulk_write(operations, ordered=True)
+        counts = {
+            "inserted": result.inserted_count,
+            "updated": result.modified_count,
+            "deleted": result.deleted_count,
+        }
+
+    # The inventory is already written, so a failed event log mustn't keep its new cars from being notified
+    counts["events_logged"] = True
+    events = build_events(source, new_cars, updates, stale_cars, now)
+    if events:
+        try:
+            with db_timer(source, "insert_events"):
+                get_events_collection(collection).insert_many(events, ordered=False)
+        except Exception as e:
+            print(f"{str(datetime.now())} - {logging_prefix} Error recording {len(events)} inventory events: {str(e)}")
+            counts["events_logged"] = False
+
+    # Let the scheduler learn how busy this yard is
+    count_changes(source, counts['inserted'] + counts['deleted'])
+
+    for stock_num in stale_stock_nums:
+        print(f"{str(datetime.now())} - {logging_prefix} Deleted record with stock_num: {stock_num}")
+    print(f"{str(datetime.now())} - {logging_prefix} Reconciled inventory: {counts['inserted']} inserted, {counts['updated']} updated, {counts['deleted']} deleted.")
+    return counts
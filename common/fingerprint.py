@@ -0,0 +1,96 @@
+from dotenv import load_dotenv
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.interest import interest_rules
+
+# Load environment variables
+load_dotenv()
+
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', '/tmp/snapshots')
+# Snapshots older than this are ignored, so every source still does a full run at least this often
+SNAPSHOT_MAX_AGE = float(os.getenv('SNAPSHOT_MAX_AGE_HOURS', '24')) * 3600
+
+def fingerprint(cars):
+    """Return a stable hash of a list of car records, independent of their order."""
+    normalized = sorted(json.dumps(dict(car), sort_keys=True, default=str) for car in cars)
+    return hashlib.sha256("\n".join(normalized).encode()).hexdigest()
+
+class Snapshot:
+    """
+    Fingerprints of a source's last successfully reconciled inventory.
+
+    Holds the validators (ETag / Last-Modified) and body hash of each response
+    plus a hash of the normalized vehicle list, so an unchanged inventory can
+    be detected before parsing, or at least before any database traffic. New
+    values only replace the stored ones when save() is called after a
+    successful run.
+
+    The interest rules decide which cars are kept and how they are scored, so
+    a snapshot saved under other rules is ignored, as if it had expired.
+    """
+
+    def __init__(self, key):
+        self.path = os.path.join(SNAPSHOT_DIR, f"{key}.json")
+        self._stored = {}
+        self._pending = {"responses": {}, "rules": interest_rules.digest}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as file:
+                    stored = json.load(file)
+                if time.time() - stored.get('saved_at', 0) < SNAPSHOT_MAX_AGE and stored.get('rules') == interest_rules.digest:
+                    self._stored = stored
+            except ValueError:
+                pass
+
+    def is_fresh(self):
+        """Return whether a snapshot saved within SNAPSHOT_MAX_AGE was loaded."""
+        return bool(self._stored)
+
+    def request_headers(self, url):
+        """Return conditional request headers for a URL fetched in the last run."""
+        stored = self._stored.get('responses', {}).get(url, {})
+        headers = {}
+        if stored.get('etag'):
+            headers['If-None-Match'] = stored['etag']
+        if stored.get('last_modified'):
+            headers['If-Modified-Since'] = stored['last_modified']
+        return headers
+
+    def response_unchanged(self, url, response):
+        """Return whether a response is a 304 or has the same body as in the last run."""
+        stored = self._stored.get('responses', {}).get(url)
+        if response.status_code == 304 and stored:
+            self._pending['responses'][url] = stored
+            return True
+
+        current = {
+            "etag": response.headers.get('ETag'),
+            "last_modified": response.headers.get('Last-Modified'),
+            "body_hash": hashlib.sha256(response.content).hexdigest(),
+        }
+        self._pending['responses'][url] = current
+        return bool(stored) and stored.get('body_hash') == current['body_hash']
+
+    def vehicles_unchanged(self, cars):
+        """Return whether the parsed vehicle list is the same as in the last run."""
+        self._pending['vehicles_hash'] = fingerprint(cars)
+        return self._stored.get('vehicles_hash') == self._pending['vehicles_hash']
+
+    def save(self, reconciled=True):
+        """
+        Store the fingerprints of this run.
+
+        Pass reconciled=False when the run was skipped, so the snapshot keeps
+        its age and a full run still happens once it expires.
+        """
+        if not os.path.exists(SNAPSHOT_DIR):
+            os.makedirs(SNAPSHOT_DIR)
+        saved_at = time.time() if reconciled else self._stored.get('saved_at', time.time())
+        snapshot = dict(self._pending, saved_at=saved_at)
+        with open(self.path, "w") as file:
+            json.dump(snapshot, file)
@@ -0,0 +1,121 @@
+from collections import defaultdict
+from datetime import datetime
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+import os
+import random
+import requests
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.metrics import HTTP_REQUEST_SECONDS, HTTP_RESPONSE_BYTES, HTTP_RETRIES
+from common.profiling import PROFILE_TRACE, record_span
+
+# Load environment variables
+load_dotenv()
+
+LOGGING_PREFIX = "(HTTP)"
+
+# (connect, read) timeout in seconds applied to every request that doesn't set its own
+DEFAULT_TIMEOUT = (float(os.getenv('HTTP_CONNECT_TIMEOUT', '10')), float(os.getenv('HTTP_READ_TIMEOUT', '60')))
+# Maximum number of requests in flight to the same host
+MAX_PER_HOST = int(os.getenv('HTTP_MAX_PER_HOST', '4'))
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '1'))
+BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '60'))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Send every request to this base URL instead, with the original host as the first
+# path segment, e.g. to load-test against benchmarks/replay_server.py
+BASE_URL_OVERRIDE = os.getenv('HTTP_BASE_URL_OVERRIDE')
+
+def rewrite_url(url, base_url):
+    """Return the URL a request for url is sent to under a base URL override."""
+    parsed = urlparse(url)
+    query = f"?{parsed.query}" if parsed.query else ""
+    return f"{base_url.rstrip('/')}/{parsed.netloc}{parsed.path}{query}"
+
+class HttpClient:
+    """
+    requests.Session wrapper shared by every scraper.
+
+    Connections are pooled and kept alive per host, every request gets a
+    default timeout, connection errors, timeouts and retryable statuses are
+    retried with jittered exponential backoff, and the number of concurrent
+    requests to a single host is capped. With a base_url, requests are sent
+    there instead of to the yard sites (the host limits still apply per yard).
+    """
+
+    def __init__(self, max_per_host=MAX_PER_HOST, max_retries=MAX_RETRIES, timeout=DEFAULT_TIMEOUT, base_url=BASE_URL_OVERRIDE):
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.base_url = base_url
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=max_per_host, max_retries=0)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._host_limits = defaultdict(lambda: threading.BoundedSemaphore(self.max_per_host))
+        self._host_limits_lock = threading.Lock()
+
+    def _host_limit(self, url):
+        with self._host_limits_lock:
+            return self._host_limits[urlparse(url).netloc]
+
+    def _backoff(self, attempt, response):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX)
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    def _observe(self, host, method, status, start, response=None, stream=False):
+        end = time.perf_counter()
+        HTTP_REQUEST_SECONDS.labels(host=host, method=method, status=status).observe(end - start)
+        length = None
+        if response is not None:
+            # Streamed bodies are only read by the caller, so only their announced length is known
+            length = response.headers.get('Content-Length') if stream else len(response.content)
+            if length:
+                HTTP_RESPONSE_BYTES.labels(host=host).inc(int(length))
+        if PROFILE_TRACE:
+            record_span("http", f"{method} {host}", start, end, status=status, bytes=length)
+
+    def request(self, method, url, retries=None, **kwargs):
+        """Send a request, retrying failures with backoff. Raises the last error if every attempt fails."""
+        retries = self.max_retries if retries is None else retries
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlparse(url).netloc
+        host_limit = self._host_limit(url)
+        target = rewrite_url(url, self.base_url) if self.base_url else url
+
+        for attempt in range(retries + 1):
+            response = None
+            start = time.perf_counter()
+            try:
+                with host_limit:
+                    response = self._session.request(method, target, **kwargs)
+                self._observe(host, method, response.status_code, start, response, kwargs.get('stream'))
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    return response
+                reason = f"status {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._observe(host, method, type(e).__name__, start)
+                if attempt == retries:
+                    raise
+                reason = str(e)
+
+            HTTP_RETRIES.labels(host=host).inc()
+            delay = self._backoff(attempt, response)
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} {method} {url} failed ({reason}), retrying in {delay:.1f}s (attempt {attempt + 1}/{retries}).")
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+# One client shared by every scraper in the process, so connections to the same host are reused
+session = HttpClient()
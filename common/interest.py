@@ -0,0 +1,126 @@
+from collections import defaultdict
+from dotenv import load_dotenv
+import hashlib
+import json
+import os
+import re
+
+# Load environment variables
+load_dotenv()
+
+INTEREST_RULES_PATH = os.getenv('INTEREST_RULES_PATH', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'interest_rules.json'))
+
+class Rule:
+    """
+    One interest rule: the level given to cars within its year ranges whose make and model match its patterns.
+
+    Patterns are regular expressions searched in the car's make and model,
+    which Vehicle upper-cases. A rule without years matches every year, and
+    one without a pattern matches every make or model.
+    """
+
+    def __init__(self, name, level, years=(), model=None, make=None):
+        self.name = name
+        self.level = int(level)
+        self.years = [(int(low), int(high)) for low, high in years]
+        self.model = re.compile(model) if model else None
+        self.make = re.compile(make) if make else None
+
+    @classmethod
+    def from_config(cls, config):
+        unknown = set(config) - {"name", "level", "years", "model", "make"}
+        if unknown or "name" not in config or "level" not in config:
+            raise ValueError(f"Invalid interest rule {config}: needs a name and a level, and takes years, model and make")
+        return cls(**config)
+
+    def matches(self, make, model):
+        if self.model is not None and (model is None or self.model.search(model) is None):
+            return False
+        return self.make is None or (make is not None and self.make.search(make) is not None)
+
+class YardRules:
+    """
+    The rules of one yard, compiled into a lookup by model year.
+
+    Each year maps to the rules covering it, highest level first, so scoring
+    a car only tries the rules that can apply to it and stops at the first
+    match. An inventory repeats the same handful of cars, so the level of
+    every year, make and model seen is remembered, and most cars are scored
+    with a single dict lookup.
+    """
+
+    def __init__(self, rules, min_level=0):
+        self.rules = rules
+        self.min_level = min_level
+        every_year = [rule for rule in rules if not rule.years]
+        by_year = defaultdict(list)
+        for rule in rules:
+            for low, high in rule.years:
+                for year in range(low, high + 1):
+                    if rule not in by_year[year]:
+                        by_year[year].append(rule)
+        self._every_year = sorted(every_year, key=lambda rule: -rule.level)
+        self._by_year = {year: sorted(year_rules + every_year, key=lambda rule: -rule.level) for year, year_rules in by_year.items()}
+        self._levels = {}
+
+    def _match(self, year, make, model):
+        for rule in self._by_year.get(year, self._every_year):
+            if rule.matches(make, model):
+                return rule.level
+        return 0
+
+    def level(self, car):
+        """Return the interest level of a car: the level of the highest rule it matches, or 0."""
+        key = (car.get('year'), car.get('make'), car.get('model'))
+        level = self._levels.get(key)
+        if level is None:
+            level = self._levels[key] = self._match(*key)
+        return level
+
+    def score(self, cars):
+        """Set the interest level of every car, and return the ones at or above the yard's minimum level."""
+        kept = []
+        for car in cars:
+            level = self.level(car)
+            car['interest_level'] = level
+            if level >= self.min_level:
+                kept.append(car)
+        return kept
+
+class InterestRules:
+    """
+    The interest rules of every yard, loaded from a JSON config file.
+
+    The file holds default "rules" and optional per-yard overrides under
+    "yards". A yard's rules replace the default rule of the same name and
+    add the others, and its "min_level" drops cars scored below it (by
+    default every car is kept). Every yard's rules are compiled once, when
+    the file is loaded.
+    """
+
+    def __init__(self, config):
+        # Hash of the config the rules were compiled from, so saved results can tell the rules changed
+        self.digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        defaults = [Rule.from_config(rule) for rule in config.get('rules', [])]
+        self._default = YardRules(defaults)
+        self._yards = {}
+        for yard, override in config.get('yards', {}).items():
+            overrides = [Rule.from_config(rule) for rule in override.get('rules', [])]
+            names = {rule.name for rule in overrides}
+            rules = [rule for rule in defaults if rule.name not in names] + overrides
+            self._yards[yard] = YardRules(rules, int(override.get('min_level', 0)))
+
+    @classmethod
+    def from_file(cls, path=INTEREST_RULES_PATH):
+        with open(path) as file:
+            return cls(json.load(file))
+
+    def for_yard(self, yard):
+        return self._yards.get(yard, self._default)
+
+# Rules shared by every scraper in the process
+interest_rules = InterestRules.from_file()
+
+def score_vehicles(source, cars):
+    """Score a source's parsed cars with its interest rules, returning the ones it keeps."""
+    return interest_rules.for_yard(source).score(cars)
@@ -0,0 +1,239 @@
+from contextlib import contextmanager
+from datetime import datetime
+from dotenv import load_dotenv
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.profiling import PROFILE_TRACE, record_span
+
+# Load environment variables
+load_dotenv()
+
+LOGGING_PREFIX = "(Metrics)"
+
+# Serve the metrics on this port at /metrics while the scheduler runs. 0 disables the endpoint.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Write the metrics to this file after every run, for node_exporter's textfile collector
+METRICS_TEXTFILE_PATH = os.getenv('METRICS_TEXTFILE_PATH')
+
+# Histogram buckets in seconds, for single requests and for whole stages and runs
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+def format_value(value):
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+class Metric:
+    """A named family of samples, one series per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def labels(self, **labels):
+        """Return the series for these label values, creating it on first use."""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            if key not in self._series:
+                self._series[key] = self._new_series()
+            return self._series[key]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = list(self._series.items())
+        for key, child in sorted(series):
+            lines += child.render(self.name, dict(zip(self.labelnames, key)))
+        return lines
+
+class CounterSeries:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, labels):
+        return [f"{name}{format_labels(labels)} {format_value(self.value)}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_series(self):
+        return CounterSeries()
+
+class HistogramSeries:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the with block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, name, labels):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{format_labels(dict(labels, le=format_value(bound)))} {cumulative}")
+        lines.append(f"{name}_bucket{format_labels(dict(labels, le='+Inf'))} {count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+        lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return lines
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=REQUEST_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return HistogramSeries(self.buckets)
+
+# Every metric of the process, in the order they were defined
+registry = []
+
+HTTP_REQUEST_SECONDS = Histogram("junkyard_http_request_seconds", "Duration of single HTTP requests, retries counted separately.", ["host", "method", "status"])
+HTTP_RESPONSE_BYTES = Counter("junkyard_http_response_bytes_total", "Bytes of HTTP response bodies received.", ["host"])
+HTTP_RETRIES = Counter("junkyard_http_retries_total", "HTTP requests that failed and were retried.", ["host"])
+STAGE_SECONDS = Histogram("junkyard_stage_seconds", "Duration of each stage of a yard's run.", ["source", "stage"], buckets=STAGE_BUCKETS)
+ROWS_PARSED = Counter("junkyard_rows_parsed_total", "Inventory rows parsed from the yards' responses.", ["source"])
+DB_REQUEST_SECONDS = Histogram("junkyard_db_request_seconds", "Duration of MongoDB round trips.", ["source", "operation"])
+ENRICHMENT_REQUESTS = Counter("junkyard_enrichment_requests_total", "Lookups of vehicle details beyond the inventory listing.", ["service"])
+NOTIFICATION_SECONDS = Histogram("junkyard_notification_seconds", "Duration of Home Assistant webhook deliveries, retries included.")
+NOTIFICATIONS = Counter("junkyard_notifications_total", "Cars sent to Home Assistant.", ["outcome"])
+RUN_SECONDS = Histogram("junkyard_run_seconds", "Duration of whole yard runs.", ["source"], buckets=STAGE_BUCKETS)
+RUNS = Counter("junkyard_runs_total", "Yard runs started by the runtime.", ["source", "outcome"])
+
+class Stages:
+    """
+    Times the consecutive stages of a yard's run (fetch, parse, enrich, reconcile, ...).
+
+    start() ends the current stage and begins the next one, so a scraper
+    only marks where each stage begins. A stage that raises is not recorded.
+    """
+
+    def __init__(self, source, first="fetch"):
+        self.source = source
+        self.stage = None
+        self.started = None
+        self.start(first)
+
+    def start(self, stage):
+        now = time.perf_counter()
+        if self.stage is not None:
+            STAGE_SECONDS.labels(source=self.source, stage=self.stage).observe(now - self.started)
+            if PROFILE_TRACE:
+                record_span("stage", self.stage, self.started, now, source=self.source)
+        self.stage, self.started = stage, now
+
+    def stop(self):
+        self.start(None)
+
+@contextmanager
+def stage_timer(source, stage):
+    """Time the with block as a stage of a source's run, for stages that overlap the others."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        STAGE_SECONDS.labels(source=source, stage=stage).observe(end - start)
+        if PROFILE_TRACE:
+            record_span("stage", stage, start, end, source=source)
+
+@contextmanager
+def db_timer(source, operation):
+    """Time the MongoDB round trip made in the with block."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        DB_REQUEST_SECONDS.labels(source=source, operation=operation).observe(end - start)
+        if PROFILE_TRACE:
+            record_span("db", operation, start, end, source=source)
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+def write_textfile(path=METRICS_TEXTFILE_PATH):
+    """Write the metrics for the textfile collector, if a path is configured."""
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    # The collector must never read a partial file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as file:
+        file.write(render())
+    os.replace(temporary_path, path)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port=METRICS_PORT):
+    """Serve /metrics from a background thread, if a port is configured. Returns the server."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"{str(datetime.now())} - {LOGGING_PREFIX} Serving metrics on port {port}.")
+    return server
@@ -0,0 +1,77 @@
+import os
+import sqlite3
+import threading
+import time
+
+class NegativeCache:
+    """
+    On-disk record of lookups that found nothing, so they are only retried with exponential backoff.
+
+    Each key that misses waits base_interval before it is due again, and
+    the wait doubles with every further miss, up to max_interval. Like the
+    VIN cache it is a SQLite database in WAL mode, shared by every process
+    that scrapes the same yard.
+    """
+
+    def __init__(self, path, base_interval, max_interval):
+        self.path = path
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS misses (key TEXT PRIMARY KEY, misses INTEGER NOT NULL, next_check REAL NOT NULL)")
+            self._connection.commit()
+        return self._connection
+
+    def interval(self, misses):
+        """Return how long to wait before retrying a key that missed this many times in a row."""
+        return min(self.base_interval * 2 ** (misses - 1), self.max_interval)
+
+    def due(self, keys, now=None):
+        """Return the keys that never missed or whose wait is over, in the given order."""
+        now = time.time() if now is None else now
+        with self._lock:
+            waiting = {key for key, next_check in self._connect().execute("SELECT key, next_check FROM misses") if next_check > now}
+        return [key for key in keys if key not in waiting]
+
+    def record(self, found, missed, now=None):
+        """
+        Store the outcome of a batch of lookups in one transaction.
+
+        Found keys are forgotten, and missed keys have their count bumped and
+        their next check pushed back.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            connection = self._connect()
+            counts = dict(connection.execute("SELECT key, misses FROM misses"))
+            connection.executemany("DELETE FROM misses WHERE key = ?", [(key,) for key in found if key in counts])
+            rows = []
+            for key in missed:
+                misses = counts.get(key, 0) + 1
+                rows.append((key, misses, now + self.interval(misses)))
+            connection.executemany("INSERT OR REPLACE INTO misses (key, misses, next_check) VALUES (?, ?, ?)", rows)
+            connection.commit()
+
+    def retain(self, keys):
+        """Forget every key not in keys, e.g. the cars that left the yard."""
+        keys = set(keys)
+        with self._lock:
+            connection = self._connect()
+            stale = [(key,) for (key,) in connection.execute("SELECT key FROM misses") if key not in keys]
+            connection.executemany("DELETE FROM misses WHERE key = ?", stale)
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,131 @@
+from datetime import datetime
+from dotenv import load_dotenv
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.http_client import session
+from common.metrics import ENRICHMENT_REQUESTS
+
+# Load environment variables
+load_dotenv()
+
+VIN_CACHE_PATH = os.getenv('VIN_CACHE_PATH', '/tmp/nhtsa/vin_cache.sqlite3')
+NHTSA_BATCH_URL = "https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVINValuesBatch/"
+# vPIC accepts up to 50 VINs per batch request
+BATCH_SIZE = 50
+
+# vPIC fields merged into new car records, keyed by the car record field name
+DETAIL_FIELDS = {
+    "series": "Series",
+    "trim": "Trim",
+}
+
+class VinCache:
+    """
+    On-disk cache of decoded vPIC records, keyed by VIN.
+
+    A VIN decode never changes, so entries never expire. The cache is a SQLite
+    database in WAL mode, which lets separate processes read it while another
+    one writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS vin_decodes (vin TEXT PRIMARY KEY, record TEXT NOT NULL)")
+            self._connection.commit()
+        return self._connection
+
+    def get(self, vin):
+        """Return the cached record for a VIN, or None."""
+        with self._lock:
+            row = self._connect().execute("SELECT record FROM vin_decodes WHERE vin = ?", (vin,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put_many(self, records):
+        """Store decoded records, given as (vin, record) pairs, in one transaction."""
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                "INSERT OR REPLACE INTO vin_decodes (vin, record) VALUES (?, ?)",
+                [(vin, json.dumps(record)) for vin, record in records],
+            )
+            connection.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+vin_cache = VinCache(VIN_CACHE_PATH)
+
+def decode_vins(vins):
+    """
+    Return the full decoded vPIC records for the given VINs, keyed by VIN.
+
+    Cached VINs are served locally and the rest are decoded through the
+    DecodeVINValuesBatch endpoint in chunks of BATCH_SIZE.
+    """
+    records = {}
+    misses = []
+    for vin in dict.fromkeys(vins):
+        record = vin_cache.get(vin)
+        if record is None:
+            misses.append(vin)
+        else:
+            records[vin] = record
+    ENRICHMENT_REQUESTS.labels(service="vpic_cache").inc(len(records))
+
+    for start in range(0, len(misses), BATCH_SIZE):
+        chunk = misses[start:start + BATCH_SIZE]
+        ENRICHMENT_REQUESTS.labels(service="vpic").inc()
+        response = session.post(NHTSA_BATCH_URL, data={"format": "json", "data": ";".join(chunk)})
+        response.raise_for_status()
+        decoded = [(record['VIN'], record) for record in response.json()['Results'] if record.get('VIN') in chunk]
+        vin_cache.put_many(decoded)
+        records.update(decoded)
+    return records
+
+def add_vehicle_details(cars, logging_prefix="", on_failure=None):
+    """
+    Merge the decoded vPIC details into every car with a full 17 character VIN.
+
+    If the VINs can't be decoded the cars are left as they are, the error is
+    logged and on_failure is called.
+    """
+    try:
+        records = decode_vins([car['vin'] for car in cars if len(car['vin']) == 17])
+    except Exception as e:
+        print(f"{str(datetime.now())} - {logging_prefix} Error fetching vehicle details: {str(e)}")
+        if on_failure is not None:
+            on_failure()
+        return
+    for car in cars:
+        record = records.get(car['vin'])
+        if record:
+            for field, key in DETAIL_FIELDS.items():
+                if record.get(key):
+                    car[field] = record[key]
@@ -0,0 +1,195 @@
+from datetime import datetime
+from dotenv import load_dotenv
+from traceback import format_exc
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.http_client import session
+from common.metrics import NOTIFICATION_SECONDS, NOTIFICATIONS
+
+# Load environment variables
+load_dotenv()
+
+LOGGING_PREFIX = "(Home Assistant)"
+
+# Home Assistant webhook URL
+HOME_ASSISTANT_WEBHOOK_URL = f"https://ha.tsmcclel.top/api/webhook/{os.getenv('HOME_ASSISTANT_WEBHOOK_ID')}"
+# Maximum number of cars per webhook call. By default each car is posted on its own, which is
+# what the Home Assistant automations read. Larger batches are posted as {"vehicles": [...]}
+# and need an automation that loops over the list, so batching is opt-in.
+HA_MAX_BATCH = int(os.getenv('HA_MAX_BATCH', '1'))
+# Seconds to wait for more cars before sending a partial batch
+HA_FLUSH_INTERVAL = float(os.getenv('HA_FLUSH_INTERVAL', '2'))
+HA_MAX_RETRIES = int(os.getenv('HA_MAX_RETRIES', '5'))
+HA_SPOOL_PATH = os.getenv('HA_SPOOL_PATH', '/tmp/home_assistant/spool.jsonl')
+# How long the worker waits idle before it retries the spooled notifications
+HA_SPOOL_RETRY_INTERVAL = float(os.getenv('HA_SPOOL_RETRY_MINUTES', '5')) * 60
+
+class NotificationDispatcher:
+    """
+    Sends Home Assistant notifications from a background thread.
+
+    Cars queued with send() are coalesced into webhook payloads of up to
+    max_batch cars, posted with the shared HTTP client's retry and backoff
+    policy. Batches that still fail are appended to an on-disk spool, which is
+    sent again when the dispatcher starts and after every spool_retry_interval
+    seconds the worker sits idle. Spooled cars are only removed from the spool
+    once they have been delivered.
+    """
+
+    def __init__(self, url=HOME_ASSISTANT_WEBHOOK_URL, max_batch=HA_MAX_BATCH, flush_interval=HA_FLUSH_INTERVAL, spool_path=HA_SPOOL_PATH, spool_retry_interval=HA_SPOOL_RETRY_INTERVAL):
+        self.url = url
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.spool_retry_interval = spool_retry_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._closing = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the background sender, which first re-sends any spooled notifications."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._closing = False
+            self._thread = threading.Thread(target=self._run, name="notifications", daemon=True)
+            self._thread.start()
+
+    def send(self, data, logging_prefix="", on_failure=None):
+        """Queue a car for notification. on_failure is called if it can't be delivered."""
+        self.start()
+        self._queue.put((dict(data), logging_prefix, on_failure))
+
+    def flush(self):
+        """Block until every queued notification has been delivered or spooled."""
+        self._queue.join()
+
+    def close(self):
+        """Deliver what's queued and stop the background sender."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._closing = True
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        self._retry_spool()
+        stopping = False
+        while not stopping:
+            try:
+                event = self._queue.get(timeout=self.spool_retry_interval)
+            except queue.Empty:
+                # Retry what failed earlier, unless close() is waiting for the queue to drain
+                if not self._closing:
+                    self._retry_spool()
+                continue
+            if event is None:
+                self._queue.task_done()
+                break
+
+            batch = [event]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                try:
+                    event = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if event is None:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(event)
+
+            try:
+                self._deliver(batch)
+            except Exception:
+                # Nothing may end the worker thread, or flush() and close() would wait forever
+                print(f"{str(datetime.now())} - {LOGGING_PREFIX} Dropped {len(batch)} notifications that could not be delivered or spooled: {format_exc()}")
+                NOTIFICATIONS.labels(outcome="dropped").inc(len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _deliver(self, batch):
+        cars = [data for data, _, _ in batch]
+        prefixes = ", ".join(sorted({logging_prefix for _, logging_prefix, _ in batch}))
+        if self._post(cars, prefixes):
+            return
+
+        NOTIFICATIONS.labels(outcome="spooled").inc(len(cars))
+        self._write_spool(cars)
+        for on_failure in {on_failure for _, _, on_failure in batch if on_failure is not None}:
+            on_failure()
+
+    def _post(self, cars, prefixes):
+        """Post cars to the webhook. Returns whether Home Assistant accepted them."""
+        payload = cars[0] if self.max_batch == 1 else {"vehicles": cars}
+        start = time.perf_counter()
+        try:
+            # Records of stored cars carry datetimes (first_seen), which are sent as strings
+            response = session.post(self.url, data=json.dumps(payload, default=str), headers={'content-type': 'application/json'}, retries=HA_MAX_RETRIES)
+            status = response.status_code
+        except Exception as e:
+            status = str(e)
+        NOTIFICATION_SECONDS.labels().observe(time.perf_counter() - start)
+
+        if status == 200:
+            NOTIFICATIONS.labels(outcome="sent").inc(len(cars))
+            print(f"{str(datetime.now())} - {prefixes} Data for {len(cars)} cars sent to Home Assistant successfully.")
+            return True
+        print(f"{str(datetime.now())} - {prefixes} Failed to send data for {len(cars)} cars to Home Assistant: {status}")
+        return False
+
+    def _retry_spool(self):
+        """Re-send the spooled notifications, keeping the ones that still fail in the spool."""
+        try:
+            spooled = self._read_spool()
+            if not spooled:
+                return
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Re-sending {len(spooled)} spooled notifications.")
+            remaining = []
+            for index in range(0, len(spooled), self.max_batch):
+                cars = spooled[index:index + self.max_batch]
+                # Once a batch fails Home Assistant is still down, so keep the rest for the next retry
+                if remaining or not self._post(cars, LOGGING_PREFIX):
+                    remaining += cars
+            self._rewrite_spool(remaining)
+        except Exception:
+            # The spool stays on disk, so nothing is lost and the worker keeps running
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to re-send spooled notifications: {format_exc()}")
+
+    def _read_spool(self):
+        if not os.path.exists(self.spool_path):
+            return []
+        with open(self.spool_path) as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+    def _rewrite_spool(self, cars):
+        """Replace the spool with cars, or remove it when every spooled car was delivered."""
+        if not cars:
+            os.remove(self.spool_path)
+            return
+        temporary = f"{self.spool_path}.tmp"
+        with open(temporary, "w") as file:
+            for data in cars:
+                file.write(json.dumps(data, default=str) + "\n")
+        os.replace(temporary, self.spool_path)
+
+    def _write_spool(self, cars):
+        directory = os.path.dirname(self.spool_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.spool_path, "a") as file:
+            for data in cars:
+                file.write(json.dumps(data, default=str) + "\n")
+
+# One dispatcher shared by every scraper in the process
+notifier = NotificationDispatcher()
@@ -0,0 +1,37 @@
+from bs4 import BeautifulSoup, SoupStrainer
+from dotenv import load_dotenv
+import os
+
+# Load environment variables
+load_dotenv()
+
+try:
+    import lxml  # noqa: F401
+    DEFAULT_PARSER = "lxml"
+except ImportError:
+    DEFAULT_PARSER = "html.parser"
+
+# BeautifulSoup tree builder used by every HTML scraper
+HTML_PARSER = os.getenv('HTML_PARSER', DEFAULT_PARSER)
+
+def tags(*names):
+    """Strainer matching every <name> element of the given names (and their contents)."""
+    return SoupStrainer(list(names))
+
+def tag_with_id(name, id):
+    """Strainer matching only the <name> element with the given id (and its contents)."""
+    return SoupStrainer(name, id=id)
+
+def tags_with_class(name, *classes):
+    """Strainer matching <name> elements carrying any of the given classes (and their contents)."""
+    wanted = set(classes)
+    return SoupStrainer(name, class_=lambda value: value is not None and not wanted.isdisjoint(value.split()))
+
+def parse_html(markup, parse_only=None):
+    """
+    Parse markup with the configured parser.
+
+    When parse_only is given, only the matching elements and their contents
+    are built into the tree, which skips the rest of the page entirely.
+    """
+    return BeautifulSoup(markup, HTML_PARSER, parse_only=parse_only)
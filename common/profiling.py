@@ -0,0 +1,207 @@
+from datetime import datetime
+from dotenv import load_dotenv
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+# Load environment variables
+load_dotenv()
+
+LOGGING_PREFIX = "(Profiling)"
+
+# Record timing spans of every run's stages, HTTP requests and MongoDB round trips, and write them as a JSON trace
+PROFILE_TRACE = os.getenv('PROFILE_TRACE', 'false').lower() == 'true'
+# Comma-separated yards to also run under cProfile and tracemalloc
+PROFILE_YARDS = {name.strip() for name in os.getenv('PROFILE_YARDS', '').split(',') if name.strip()}
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/profiles')
+# Allocation sites listed in the tracemalloc report
+PROFILE_TOP_ALLOCATIONS = int(os.getenv('PROFILE_TOP_ALLOCATIONS', '25'))
+
+PROFILING = PROFILE_TRACE or bool(PROFILE_YARDS)
+
+# Runs being traced or profiled, by source
+_runs = {}
+_runs_lock = threading.Lock()
+# The source whose work the current thread is doing
+_thread = threading.local()
+# Profiled runs in progress, which share the process-wide tracemalloc
+_tracemalloc_users = 0
+
+class Run:
+    """The spans, and the profilers of every thread, of one yard's run."""
+
+    def __init__(self, source):
+        self.source = source
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.events = []
+        self.threads = {}
+        self.profilers = []
+        self._lock = threading.Lock()
+
+    def add_span(self, kind, name, start, end, attributes):
+        thread = threading.current_thread()
+        with self._lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append({
+                "name": name,
+                "cat": kind,
+                "ph": "X",
+                "ts": round((start - self.started) * 1e6),
+                "dur": round((end - start) * 1e6),
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": attributes,
+            })
+
+    def add_profiler(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows a single active profiler per process
+            return
+        with self._lock:
+            self.profilers.append(profiler)
+
+    def summary(self):
+        """Total milliseconds and count of the spans, by kind and name."""
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(f"{event['cat']}:{event['name']}", {"count": 0, "total_ms": 0.0})
+            total["count"] += 1
+            total["total_ms"] += event["dur"] / 1000
+        return {key: dict(total, total_ms=round(total["total_ms"], 3)) for key, total in sorted(totals.items())}
+
+    def path(self, suffix):
+        return os.path.join(PROFILE_DIR, f"{self.source}-{self.started_at.strftime('%Y%m%dT%H%M%S')}{suffix}")
+
+    def write_trace(self, duration):
+        """Write the spans in the Chrome trace event format, which chrome://tracing and Perfetto open."""
+        names = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}}
+            for ident, name in self.threads.items()
+        ]
+        trace = {
+            "traceEvents": names + sorted(self.events, key=lambda event: event["ts"]),
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "source": self.source,
+                "started_at": self.started_at.isoformat(),
+                "duration_ms": round(duration * 1000, 3),
+                "summary": self.summary(),
+            },
+        }
+        path = self.path(".trace.json")
+        with open(path, "w") as file:
+            json.dump(trace, file)
+        return path
+
+    def write_profile(self):
+        """Dump the merged cProfile statistics of every thread of the run, for pstats or snakeviz."""
+        for profiler in self.profilers:
+            profiler.disable()
+        profilers = [profiler for profiler in self.profilers if profiler.getstats()]
+        if not profilers:
+            return None
+        # Merge the threads into one set of statistics
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        path = self.path(".prof")
+        stats.dump_stats(path)
+        return path
+
+def write_memory_report(run, snapshot, peak):
+    """Write the allocation sites holding the most memory at the end of a run."""
+    path = run.path(".memory.txt")
+    with open(path, "w") as file:
+        file.write(f"Peak traced memory: {peak / 1024:.1f} KiB\n\n")
+        for statistic in snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]:
+            file.write(f"{statistic}\n")
+    return path
+
+def start_tracemalloc():
+    global _tracemalloc_users
+    with _runs_lock:
+        _tracemalloc_users += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+def stop_tracemalloc():
+    global _tracemalloc_users
+    with _runs_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+def current_source():
+    return getattr(_thread, "source", None)
+
+def trace_thread(source):
+    """
+    Attribute the calling thread's work to a source's run.
+
+    Scrapers pass this as the initializer of their own thread pools, so the
+    requests made from those threads land in the yard's trace and profile.
+    """
+    if not PROFILING:
+        return
+    _thread.source = source
+    with _runs_lock:
+        run = _runs.get(source)
+    if run is not None and source in PROFILE_YARDS:
+        run.add_profiler()
+
+def record_span(kind, name, start, end, source=None, **attributes):
+    """Add a span, timed with time.perf_counter(), to the trace of the source's run (or the current thread's)."""
+    with _runs_lock:
+        run = _runs.get(source or current_source())
+    if run is not None:
+        run.add_span(kind, name, start, end, attributes)
+
+def profiled(source, function):
+    """
+    Return function wrapped to trace and profile a run of the source, or function itself when profiling is off.
+
+    The trace is written to PROFILE_DIR as <source>-<time>.trace.json. Yards
+    listed in PROFILE_YARDS also get a .prof cProfile dump, merged across
+    the run's threads, and a .memory.txt tracemalloc report. tracemalloc
+    traces the whole process, so yards running at the same time show up in
+    each other's memory reports.
+    """
+    if not PROFILING:
+        return function
+
+    def run_profiled():
+        run = Run(source)
+        with _runs_lock:
+            _runs[source] = run
+        if source in PROFILE_YARDS:
+            start_tracemalloc()
+        previous_source = current_source()
+        trace_thread(source)
+        try:
+            return function()
+        finally:
+            _thread.source = previous_source
+            duration = time.perf_counter() - run.started
+            with _runs_lock:
+                _runs.pop(source, None)
+            if not os.path.exists(PROFILE_DIR):
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+            written = []
+            if PROFILE_TRACE:
+                written.append(run.write_trace(duration))
+            if source in PROFILE_YARDS:
+                written.append(run.write_profile())
+                _, peak = tracemalloc.get_traced_memory()
+                written.append(write_memory_report(run, tracemalloc.take_snapshot(), peak))
+                stop_tracemalloc()
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Wrote {', '.join(path for path in written if path)}.")
+
+    return run_profiled
@@ -0,0 +1,123 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from traceback import format_exc
+import asyncio
+import fcntl
+import importlib
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import close_connection, ensure_indexes, get_collection
+from common.metrics import RUN_SECONDS, RUNS, write_textfile
+from common.nhtsa import vin_cache
+from common.notify import notifier
+from common.profiling import profiled
+
+LOGGING_PREFIX = "(Runtime)"
+# Per-yard lock files, so two processes never scrape the same yard at once
+LOCK_DIR = os.getenv('RUNTIME_LOCK_DIR', '/tmp/locks')
+
+# Every yard adapter, by package name. Each one exposes a blocking run() function.
+ADAPTERS = [
+    "jacks",
+    "lkq",
+    "picknpull",
+    "pullapart",
+    "pullnsave",
+    "tearapart",
+    "upullandsave",
+    "utpap",
+]
+
+def load_adapters(names):
+    """Import the adapter modules, skipping any that fail to import."""
+    adapters = {}
+    for name in names:
+        try:
+            adapters[name] = importlib.import_module(f"{name}.main")
+        except Exception:
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to load adapter {name}: {format_exc()}")
+    return adapters
+
+def try_lock(name):
+    """Take a yard's run lock without blocking. Returns the open lock file, or None if another process holds it."""
+    if not os.path.exists(LOCK_DIR):
+        os.makedirs(LOCK_DIR, exist_ok=True)
+    lock_file = open(os.path.join(LOCK_DIR, f"{name}.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+async def run_adapter(name, adapter, executor):
+    """
+    Run one adapter, isolating its failures from the other yards.
+
+    Returns its duration in seconds, or None if the yard was skipped because
+    a run of it is still in progress elsewhere.
+    """
+    lock_file = try_lock(name)
+    if lock_file is None:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Adapter {name} is already running, skipping.")
+        RUNS.labels(source=name, outcome="skipped").inc()
+        return None
+
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    outcome = "completed"
+    try:
+        await loop.run_in_executor(executor, profiled(name, adapter.run))
+    except Exception:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Adapter {name} failed: {format_exc()}")
+        outcome = "failed"
+    finally:
+        lock_file.close()
+    duration = time.monotonic() - start
+    RUN_SECONDS.labels(source=name).observe(duration)
+    RUNS.labels(source=name, outcome=outcome).inc()
+    print(f"{str(datetime.now())} - {LOGGING_PREFIX} Adapter {name} finished in {duration:.1f}s.")
+    return duration
+
+def prepare_indexes():
+    """Build the MongoDB indexes once before the yards start, instead of in the first run of each."""
+    try:
+        # Labelled with the process rather than a yard, since it is built for all of them
+        ensure_indexes(get_collection(), "runtime")
+    except Exception:
+        # Each yard tries again when it reaches its reconcile
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to ensure the MongoDB indexes: {format_exc()}")
+
+async def run_all(names=ADAPTERS):
+    """Run all adapters concurrently, sharing the process-wide HTTP session and MongoDB client."""
+    adapters = load_adapters(names)
+    if not adapters:
+        return {}
+
+    start = time.monotonic()
+    notifier.start()
+    prepare_indexes()
+    # The HTTP and MongoDB clients are blocking but thread-safe, so each yard gets its own worker thread
+    with ThreadPoolExecutor(max_workers=len(adapters), thread_name_prefix="adapter") as executor:
+        durations = await asyncio.gather(*(run_adapter(name, adapter, executor) for name, adapter in adapters.items()))
+    print(f"{str(datetime.now())} - {LOGGING_PREFIX} Sweep of {len(adapters)} yards finished in {time.monotonic() - start:.1f}s.")
+    cache_stats = vin_cache.stats()
+    print(f"{str(datetime.now())} - {LOGGING_PREFIX} VIN decode cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses.")
+    write_textfile()
+    return dict(zip(adapters, durations))
+
+def main():
+    names = sys.argv[1:] or ADAPTERS
+    try:
+        asyncio.run(run_all(names))
+    finally:
+        # Deliver the notifications queued during the sweep before exiting
+        notifier.close()
+        close_connection()
+        vin_cache.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+import asyncio
+import json
+import os
+import random
+import signal
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.churn import ChurnHistory, take_changes
+from common.db import close_connection
+from common.metrics import start_http_server, write_textfile
+from common.nhtsa import vin_cache
+from common.notify import notifier
+from common.runtime import ADAPTERS, load_adapters, prepare_indexes, run_adapter
+
+# Load environment variables
+load_dotenv()
+
+LOGGING_PREFIX = "(Scheduler)"
+
+# Default minutes between two runs of a yard. SCHEDULE_INTERVAL_MINUTES_<YARD> overrides it per yard.
+SCHEDULE_INTERVAL = float(os.getenv('SCHEDULE_INTERVAL_MINUTES', '60')) * 60
+# Up to this many seconds are added at random to every interval, so the yards drift apart
+SCHEDULE_JITTER = float(os.getenv('SCHEDULE_JITTER_SECONDS', '300'))
+# The first runs are spread over this many seconds after startup
+SCHEDULE_STARTUP_SPREAD = float(os.getenv('SCHEDULE_STARTUP_SPREAD_SECONDS', '60'))
+# Learn each yard's interval from its churn by hour of day, within these bounds
+SCHEDULE_ADAPTIVE = os.getenv('SCHEDULE_ADAPTIVE', 'true').lower() == 'true'
+SCHEDULE_MIN_INTERVAL = float(os.getenv('SCHEDULE_MIN_INTERVAL_MINUTES', '15')) * 60
+SCHEDULE_MAX_INTERVAL = float(os.getenv('SCHEDULE_MAX_INTERVAL_MINUTES', '240')) * 60
+# Number of added or removed cars an adaptive interval aims to find per run
+SCHEDULE_TARGET_CHANGES = float(os.getenv('SCHEDULE_TARGET_CHANGES', '1'))
+SCHEDULER_STATUS_PATH = os.getenv('SCHEDULER_STATUS_PATH', '/tmp/scheduler/status.json')
+
+def interval_for(name):
+    """Return the configured number of seconds between two runs of a yard."""
+    minutes = os.getenv(f"SCHEDULE_INTERVAL_MINUTES_{name.upper()}")
+    return float(minutes) * 60 if minutes else SCHEDULE_INTERVAL
+
+def timestamp(epoch):
+    return datetime.fromtimestamp(epoch).isoformat(timespec='seconds') if epoch else None
+
+class Scheduler:
+    """
+    Runs every yard from one long-lived process, each in its own loop with a jittered interval.
+
+    With adaptive set, a yard's interval is learned from its churn by hour of
+    the day. Each yard's schedule is written to status_path as it changes.
+    """
+
+    def __init__(self, adapters, status_path=SCHEDULER_STATUS_PATH, adaptive=SCHEDULE_ADAPTIVE, churn=None):
+        self.adapters = adapters
+        self.status_path = status_path
+        self.adaptive = adaptive
+        self.churn = churn if churn is not None else ChurnHistory()
+        self.yards = {
+            name: {
+                "interval": interval_for(name),
+                "next_run": None,
+                "last_started": None,
+                "last_duration": None,
+                "last_changes": None,
+                # Start of the last run that reached reconcile, which its changes are counted from
+                "last_reconciled": None,
+                "running": False,
+                "runs": 0,
+            }
+            for name in adapters
+        }
+
+    def status(self):
+        """Return the schedule of every yard, with times as ISO strings."""
+        return {
+            name: dict(
+                state,
+                next_run=timestamp(state["next_run"]),
+                last_started=timestamp(state["last_started"]),
+                last_reconciled=timestamp(state["last_reconciled"]),
+            )
+            for name, state in self.yards.items()
+        }
+
+    def write_status(self):
+        directory = os.path.dirname(self.status_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Write to a temporary file first so readers never see a partial document
+        temporary_path = f"{self.status_path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(self.status(), file, indent=2)
+        os.replace(temporary_path, self.status_path)
+
+    def next_interval(self, name, reconciled=True):
+        """Return the seconds to wait between the start of this run and the next one."""
+        state = self.yards[name]
+        interval = interval_for(name)
+        if not reconciled:
+            # A run that failed before reconcile says nothing about churn, so the yard isn't stretched
+            # past the interval it already had, nor past its configured one
+            interval = min(state["interval"], interval)
+        elif self.adaptive and self.churn.rates(name) is not None:
+            # Hours without history fall back to the rate that gives the configured interval
+            default_rate = SCHEDULE_TARGET_CHANGES / (interval / 3600)
+            interval = self.churn.time_to_changes(name, state["last_started"], SCHEDULE_TARGET_CHANGES, default_rate, SCHEDULE_MAX_INTERVAL)
+            interval = min(max(interval, SCHEDULE_MIN_INTERVAL), SCHEDULE_MAX_INTERVAL)
+        state["interval"] = round(interval)
+        return interval + random.uniform(0, SCHEDULE_JITTER)
+
+    async def run_yard(self, name, executor):
+        state = self.yards[name]
+        state["next_run"] = time.time() + random.uniform(0, SCHEDULE_STARTUP_SPREAD)
+        while True:
+            self.write_status()
+            await asyncio.sleep(max(0, state["next_run"] - time.time()))
+
+            state["running"] = True
+            state["last_started"] = time.time()
+            self.write_status()
+            # Drop changes counted by runs outside the scheduler
+            take_changes(name)
+            duration = await run_adapter(name, self.adapters[name], executor)
+            state["running"] = False
+            # Failed and skipped runs count no changes, and aren't learned from
+            changes = take_changes(name)
+            if duration is not None:
+                state["last_duration"] = round(duration, 1)
+                state["last_changes"] = changes
+                state["runs"] += 1
+                write_textfile()
+            if changes is not None:
+                # The first run's changes piled up over an unknown time, so only later runs are learned from
+                if state["last_reconciled"] is not None:
+                    self.churn.record(name, changes, state["last_reconciled"], state["last_started"])
+                state["last_reconciled"] = state["last_started"]
+
+            next_run = state["last_started"] + self.next_interval(name, reconciled=changes is not None)
+            if next_run < time.time():
+                print(f"{str(datetime.now())} - {LOGGING_PREFIX} {name} overran its interval, running it again right away.")
+            state["next_run"] = max(next_run, time.time())
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Next run of {name} at {timestamp(state['next_run'])}.")
+
+    async def run(self):
+        """Run the yards until cancelled."""
+        notifier.start()
+        start_http_server()
+        prepare_indexes()
+        # The HTTP and MongoDB clients are blocking but thread-safe, so each yard gets its own worker thread
+        with ThreadPoolExecutor(max_workers=len(self.adapters), thread_name_prefix="adapter") as executor:
+            await asyncio.gather(*(self.run_yard(name, executor) for name in self.adapters))
+
+async def run_daemon(names=ADAPTERS):
+    adapters = load_adapters(names)
+    if not adapters:
+        return
+
+    print(f"{str(datetime.now())} - {LOGGING_PREFIX} Scheduling {len(adapters)} yards: {', '.join(adapters)}.")
+    task = asyncio.ensure_future(Scheduler(adapters).run())
+    # Stop cleanly on docker stop
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Stopping.")
+
+def main():
+    names = sys.argv[1:] or ADAPTERS
+    try:
+        asyncio.run(run_daemon(names))
+    finally:
+        # Deliver the queued notifications before exiting
+        notifier.close()
+        close_connection()
+        vin_cache.close()
+
+if __name__ == "__main__":
+    main()
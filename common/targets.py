@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.profiling import trace_thread
+
+# Load environment variables
+load_dotenv()
+
+SEARCH_TARGETS_PATH = os.getenv('SEARCH_TARGETS_PATH', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'search_targets.json'))
+# Number of a yard's searches run at the same time (the HTTP client still caps the requests per host)
+SEARCH_CONCURRENCY = int(os.getenv('SEARCH_CONCURRENCY', '4'))
+
+class SearchTarget:
+    """One search a yard runs: the make it finds, and the value the yard's search takes for that make."""
+
+    def __init__(self, make, query):
+        self.make = make.upper()
+        self.query = query
+
+    def __repr__(self):
+        return f"SearchTarget({self.make!r}, {self.query!r})"
+
+def load_search_targets(path=SEARCH_TARGETS_PATH):
+    """
+    Read the searches of every yard from a JSON config file.
+
+    The file maps each source to a list of {"make", "query"} objects. The
+    query is whatever the yard's search takes: a make ID for Pick-n-Pull and
+    Pull-a-Part, a make name or filter text for the others.
+    """
+    with open(path) as file:
+        config = json.load(file)
+    targets = {}
+    for source, searches in config.items():
+        for search in searches:
+            if set(search) != {"make", "query"}:
+                raise ValueError(f"Invalid search target for {source} {search}: needs a make and a query")
+        targets[source] = [SearchTarget(**search) for search in searches]
+    return targets
+
+# Searches of every yard in the process
+_targets = load_search_targets()
+
+def search_targets(source):
+    """Return a yard's searches. A yard without any would reconcile its whole inventory away, so that is an error."""
+    targets = _targets.get(source)
+    if not targets:
+        raise ValueError(f"No search targets configured for {source} in {SEARCH_TARGETS_PATH}")
+    return targets
+
+def fan_out(source, search, targets):
+    """
+    Run search(target) for every target at once, returning the results in target order.
+
+    The searches share the process-wide HTTP session, so they reuse its
+    pooled connections. A single target is searched on the calling thread.
+    """
+    if len(targets) == 1:
+        return [search(targets[0])]
+    with ThreadPoolExecutor(max_workers=min(SEARCH_CONCURRENCY, len(targets)), initializer=trace_thread, initargs=(source,)) as executor:
+        return list(executor.map(search, targets))
+
+def unique_by_stock_num(cars, known=()):
+    """Return the cars whose stock number isn't in known, keeping the first car for each stock number."""
+    unique = []
+    seen = set(known)
+    for car in cars:
+        if car['stock_num'] not in seen:
+            seen.add(car['stock_num'])
+            unique.append(car)
+    return unique
@@ -0,0 +1,102 @@
+from collections.abc import MutableMapping
+
+def to_int(value):
+    return value if isinstance(value, int) else int(str(value).strip())
+
+def to_str(value):
+    return value.strip() if isinstance(value, str) else str(value)
+
+def to_upper(value):
+    return to_str(value).upper()
+
+# Every field a yard's record can carry, with the type its values are normalized to.
+# stock_num keeps each yard's own type, so stored records keep matching the latest search.
+FIELDS = {
+    "source": to_str,
+    "stock_num": None,
+    "year": to_int,
+    "make": to_upper,
+    "model": to_upper,
+    "location": to_str,
+    "location_id": None,
+    "yard": None,
+    "vin": to_str,
+    "color": to_str,
+    "engine": to_str,
+    "trim": to_str,
+    "series": to_str,
+    "transmission": to_str,
+    "style": to_str,
+    "section": to_str,
+    "row": to_str,
+    "space": to_str,
+    "date": to_str,
+    "reference": None,
+    "image": None,
+    "image_urls": None,
+    "interest_level": to_int,
+}
+
+class Vehicle(MutableMapping):
+    """
+    One car in a yard's inventory, in the shape every source shares.
+
+    Fields are slots, so a record costs a fraction of the equivalent dict,
+    and values are normalized as they are set: year and interest_level to
+    int, make and model to upper case and the other text fields to stripped strings
+    (None is kept as is). Fields that were never set are absent, exactly like a
+    missing dict key.
+
+    A Vehicle is a mapping, so the reconcile stage, the fingerprints and the
+    notifications take it wherever they take a dict. It has no _id slot, so
+    reconcile inserts a dict copy of each new car for pymongo to add the _id
+    to. to_document() returns the plain dict, for JSON.
+    """
+
+    __slots__ = tuple(FIELDS)
+
+    def __init__(self, **fields):
+        for field, value in fields.items():
+            self[field] = value
+
+    def __getitem__(self, field):
+        # Only fields are keys, never the methods and attributes of the class
+        if field not in FIELDS:
+            raise KeyError(field)
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def get(self, field, default=None):
+        # Read the slot directly rather than catching the KeyError of an unset field
+        return getattr(self, field, default) if field in FIELDS else default
+
+    def __setitem__(self, field, value):
+        if field not in FIELDS:
+            raise KeyError(f"Vehicle has no field {field!r}")
+        normalize = FIELDS[field]
+        setattr(self, field, normalize(value) if normalize and value is not None else value)
+
+    def __delitem__(self, field):
+        if field not in FIELDS:
+            raise KeyError(field)
+        try:
+            delattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def __iter__(self):
+        return (field for field in FIELDS if hasattr(self, field))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Vehicle({', '.join(f'{field}={value!r}' for field, value in self.items())})"
+
+    def to_document(self, **extra):
+        """Return the record as a plain dict, with extra fields added."""
+        document = {field: getattr(self, field) for field in self}
+        document.update(extra)
+        return document
@@ -1,8 +1,10 @@
 #!/bin/sh
 
 # Check if all health status files contain only the word "healthy"
-if [ "$(cat /tmp/jacks/health_status.txt)" = "healthy" ] && [ "$(cat /tmp/LKQ/health_status.txt)" = "healthy" ] && [ "$(cat /tmp/picknpull/health_status.txt)" = "healthy" ] && [ "$(cat /tmp/pullapart/health_status.txt)" = "healthy" ] && [ "$(cat /tmp/upullandsave/health_status.txt)" = "healthy" ]; then
-  exit 0
-else
-  exit 1
-fi
+for directory in jacks LKQ picknpull pullapart pullnsave tearapart upullandsave UTPAP; do
+  if [ "$(cat /tmp/$directory/health_status.txt)" != "healthy" ]; then
+    exit 1
+  fi
+done
+
+exit 0
@@ -1,49 +1,35 @@
-import requests
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from pymongo import MongoClient
 from datetime import datetime
 from traceback import format_exc
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.churn import count_changes
+from common.db import close_connection, ensure_indexes, fetch_known_cars, get_collection, reconcile, select_new_cars
+from common.fingerprint import Snapshot
+from common.http_client import session
+from common.interest import score_vehicles
+from common.metrics import ROWS_PARSED, Stages
+from common.notify import notifier
+from common.parsing import parse_html, tag_with_id
+from common.targets import search_targets
+from common.vehicle import Vehicle
 
 # Load environment variables
 load_dotenv()
 
 LOGGING_PREFIX = "(Jack's Used Auto Parts)"
-
-# MongoDB connection details
-MONGO_URI = os.getenv('MONGO_URI')
-MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
-MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB_NAME]
-collection = db[MONGO_COLLECTION_NAME]
-
-# Home Assistant webhook URL
-home_assistant_webhook_url = f"https://ha.tsmcclel.top/api/webhook/{os.getenv('HOME_ASSISTANT_WEBHOOK_ID')}"
+SOURCE = "jacks"
+# Records stored before the source field existed, told apart by the fields only this yard wrote.
+# Only Jack's stored cars without a location.
+LEGACY_RECORDS = {"location": {"$exists": False}}
+# Only the inventory table is built into the parse tree
+INVENTORY_STRAINER = tag_with_id('table', 'vehicles')
 
 def send_to_home_assistant(data):
-    response = requests.post(home_assistant_webhook_url, json=data)
-    if response.status_code == 200:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Data sent to Home Assistant successfully.")
-    else:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to send data to Home Assistant: {response.status_code}")
-        update_health_status("unhealthy")
-
-def fetch_all_records():
-    """Fetch all records from MongoDB collection."""
-    return list(collection.find())
-
-def delete_old_records(existing_cars, latest_cars):
-    """Delete records from MongoDB that are not found in the latest search."""
-    latest_stock_nums = [car['stock_num'] for car in latest_cars]
-
-    for car in existing_cars:
-        if car['stock_num'] not in latest_stock_nums:
-            collection.delete_one({"stock_num": car['stock_num']})
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Deleted record: {car}")
+    """Queue a notification, which is sent to Home Assistant in the background."""
+    notifier.send(data, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
 
 def update_health_status(status):
     directory = "/tmp/jacks"
@@ -53,83 +39,133 @@ def update_health_status(status):
         file.write(status)
 
 
-try:
-    url = "https://jacksusedautoparts.com/vehicleInventory.php"
-    payload = {}
-    headers = {}
-
-    response = requests.get(url, headers=headers, data=payload)
-    response.raise_for_status()  # Raise an error for bad responses
-    soup = BeautifulSoup(response.text, 'html.parser')
-    table = soup.find('table', {'id': 'vehicles'})
-
-    cars_of_interest = []
-
-    health = "healthy"
-
-    # Check if the table was found
-    if table:
-        # Find all rows in the table
-        rows = table.find('tbody').find_all('tr')
-        print(f"{str(datetime.now())} - Successully fetched {len(rows)} cars from Jack's.")
+def run():
+    """Scrape Jack's inventory and reconcile it with the database."""
+    try:
+        collection = get_collection()
+        snapshot = Snapshot(SOURCE)
+        stages = Stages(SOURCE)
+        # Jack's lists every make on one page, so each make searched for is only a filter on its rows
+        targets = search_targets(SOURCE)
+        url = "https://jacksusedautoparts.com/vehicleInventory.php"
+        payload = {}
+        headers = {}
+
+        # The page is remembered along with the makes it was filtered for, so adding a make reparses it
+        snapshot_key = f"{url}#{','.join(target.make for target in targets)}"
+        headers.update(snapshot.request_headers(snapshot_key))
+        response = session.get(url, headers=headers, data=payload)
+        response.raise_for_status()  # Raise an error for bad responses
+        # Skip parsing entirely if the page hasn't changed since the last run
+        if snapshot.response_unchanged(snapshot_key, response):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Inventory page unchanged since the last run, skipping.")
+            # An unchanged inventory is a run without changes, which the scheduler learns from too
+            count_changes(SOURCE, 0)
+            update_health_status("healthy")
+            return
+        stages.start("parse")
+        soup = parse_html(response.text, INVENTORY_STRAINER)
+        table = soup.find('table', {'id': 'vehicles'})
+
+        cars_of_interest = []
+
+        health = "healthy"
+
+        # Check if the table was found
+        if table:
+            # Find all rows in the table
+            rows = table.find('tbody').find_all('tr')
+            ROWS_PARSED.labels(source=SOURCE).inc(len(rows))
+            print(f"{str(datetime.now())} - Successully fetched {len(rows)} cars from Jack's.")
         
-        for row in rows:
-            # Get all the columns in the row
-            cols = row.find_all('td')
-            # Extract text from each column and strip any extra whitespace
-            col_data = [col.text.strip() for col in cols]
-            if col_data:
-                try:
-                    year = int(col_data[0])
-                    make = col_data[1].upper()
-                    if not "MERCEDES" in make:
-                        continue
-                    model = col_data[2].upper()
-                    color = col_data[3]
-                    engine = col_data[4]
-                    row = col_data[5]
-                    date = col_data[6]
-
-                    stock_num = col_data[0] + col_data[1] + col_data[2] + col_data[3] + col_data[4] + col_data[5] + col_data[6]
-
-                    car_data = {
-                        "year": year,
-                        "model": model,
-                        "color": color,
-                        "engine": engine,
-                        "stock_num": stock_num,
-                        "row": row,
-                        "date": date,
-                        "interest_level": 0,
-                    }
-
-                    if (year >= 1976 and year <= 1985) or (year >= 1996 and year <= 2002 and model == "E-CLASS"):
-                        car_data["interest_level"] = 1
-                    
-                    cars_of_interest.append(car_data)
-                    # Check if the car is already in the database
-                    existing_car = collection.find_one({"stock_num": stock_num})
-                    if existing_car is None:
-                        # Send the notification
-                        send_to_home_assistant(car_data)
-                        # Add the car to the database
-                        collection.insert_one(car_data)
-                except ValueError:
-                    # Handle the case where conversion to int fails (e.g., year is not a number)
-                    print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {col_data}")
-                    update_health_status("unhealthy")
-    else:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Table not found.")
-        health = "unhealthy"
-
-    # Fetch all records from MongoDB
-    existing_cars = fetch_all_records()
-
-    # Delete old records not found in the latest search
-    delete_old_records(existing_cars, cars_of_interest)
-
-    # If everything is successful, set the status to healthy
-    update_health_status(health)
-except Exception as e:
-    print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in Jack's: {format_exc()}")
-    update_health_status("unhealthy")
+            for row in rows:
+                # Get all the columns in the row
+                cols = row.find_all('td')
+                # Extract text from each column and strip any extra whitespace
+                col_data = [col.text.strip() for col in cols]
+                if col_data:
+                    try:
+                        year = int(col_data[0])
+                        make = col_data[1].upper()
+                        target = next((target for target in targets if target.query in make), None)
+                        if target is None:
+                            continue
+                        model = col_data[2].upper()
+                        color = col_data[3]
+                        engine = col_data[4]
+                        row = col_data[5]
+                        date = col_data[6]
+
+                        stock_num = col_data[0] + col_data[1] + col_data[2] + col_data[3] + col_data[4] + col_data[5] + col_data[6]
+
+                        car_data = Vehicle(
+                            source=SOURCE,
+                            year=year,
+                            make=target.make,
+                            model=model,
+                            color=color,
+                            engine=engine,
+                            stock_num=stock_num,
+                            row=row,
+                            date=date,
+                        )
+
+                        cars_of_interest.append(car_data)
+                    except ValueError:
+                        # Handle the case where conversion to int fails (e.g., year is not a number)
+                        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {col_data}")
+                        update_health_status("unhealthy")
+        else:
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Table not found.")
+            health = "unhealthy"
+
+        cars_of_interest = score_vehicles(SOURCE, cars_of_interest)
+        # Sold cars can only be told apart when the page was read, otherwise a
+        # broken page would make every car look sold
+        complete = health == "healthy"
+
+        # Skip the database entirely if the parsed inventory hasn't changed
+        if complete and snapshot.vehicles_unchanged(cars_of_interest):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Inventory unchanged since the last run, skipping reconcile.")
+            # An unchanged inventory is a run without changes, which the scheduler learns from too
+            count_changes(SOURCE, 0)
+            snapshot.save(reconciled=False)
+            update_health_status(health)
+            return
+
+        stages.start("lookup")
+        # Make sure the reconcile queries are indexed
+        ensure_indexes(collection, SOURCE)
+
+        # Look up which cars are already in the database in one query
+        known_cars = fetch_known_cars(collection, SOURCE, cars_of_interest)
+        new_cars = select_new_cars(cars_of_interest, known_cars)
+
+        # Add new cars and delete old records not found in the latest search
+        stages.start("reconcile")
+        counts = reconcile(collection, SOURCE, cars_of_interest, known_cars, new_cars=new_cars, legacy=LEGACY_RECORDS, logging_prefix=LOGGING_PREFIX, delete_stale=complete)
+        # The new cars are stored either way, so they are still notified
+        if not counts["events_logged"]:
+            health = "unhealthy"
+
+        # Send the notifications
+        stages.start("notify")
+        for car_data in new_cars:
+            send_to_home_assistant(car_data)
+        stages.stop()
+
+        # Remember this inventory so unchanged runs can be skipped. Incomplete runs
+        # leave the snapshot alone, so the next run reads the page again.
+        if complete:
+            snapshot.save()
+
+        # If everything is successful, set the status to healthy
+        update_health_status(health)
+    except Exception as e:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in Jack's: {format_exc()}")
+        update_health_status("unhealthy")
+
+if __name__ == "__main__":
+    run()
+    notifier.close()
+    close_connection()
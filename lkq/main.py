@@ -1,28 +1,35 @@
-import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from pymongo import MongoClient
 from datetime import datetime
 from traceback import format_exc
+from urllib.parse import quote_plus
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.churn import count_changes
+from common.db import close_connection, ensure_indexes, fetch_known_cars, get_collection, reconcile, select_new_cars
+from common.fingerprint import Snapshot
+from common.http_client import session
+from common.interest import score_vehicles
+from common.metrics import ROWS_PARSED, Stages, stage_timer
+from common.notify import notifier
+from common.parsing import parse_html, tags_with_class
+from common.profiling import trace_thread
+from common.targets import fan_out, search_targets, unique_by_stock_num
+from common.vehicle import Vehicle
 
 # Load environment variables
 load_dotenv()
 
 LOGGING_PREFIX = "(LKQ)"
-
-# MongoDB connection details
-MONGO_URI = os.getenv('MONGO_URI')
-MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
-MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB_NAME]
-collection = db[MONGO_COLLECTION_NAME]
-
-# Home Assistant webhook URL
-home_assistant_webhook_url = f"https://ha.tsmcclel.top/api/webhook/{os.getenv('HOME_ASSISTANT_WEBHOOK_ID')}"
+SOURCE = "lkq"
+# Only the result rows and the end-of-results marker are built into the parse tree
+INVENTORY_STRAINER = tags_with_class('div', 'pypvi_resultRow', 'pypvi_end')
+# Number of result pages requested at once after the first one
+PAGE_CONCURRENCY = int(os.getenv('LKQ_PAGE_CONCURRENCY', '4'))
+# Safety limit, in case the site never reports the end of the results
+MAX_PAGES = int(os.getenv('LKQ_MAX_PAGES', '50'))
 
 yard_ids = {
     "dayton": "1257",
@@ -30,25 +37,8 @@ yard_ids = {
 }
 
 def send_to_home_assistant(data):
-    response = requests.post(home_assistant_webhook_url, json=data)
-    if response.status_code == 200:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Data sent to Home Assistant successfully.")
-    else:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to send data to Home Assistant: {response.status_code}")
-        update_health_status("unhealthy")
-
-def fetch_all_records(yard):
-    """Fetch all records from MongoDB collection."""
-    return list(collection.find({"location": yard}))
-
-def delete_old_records(existing_cars, latest_cars):
-    """Delete records from MongoDB that are not found in the latest search."""
-    latest_stock_nums = [car['stock_num'] for car in latest_cars]
-
-    for car in existing_cars:
-        if car['stock_num'] not in latest_stock_nums:
-            collection.delete_one({"stock_num": car['stock_num']})
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Deleted record: {car}")
+    """Queue a notification, which is sent to Home Assistant in the background."""
+    notifier.send(data, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
 
 def update_health_status(status):
     directory = "/tmp/LKQ"
@@ -57,157 +47,261 @@ def update_health_status(status):
     with open(f"{directory}/health_status.txt", "w") as file:
         file.write(status)
 
-def fetch_page(page, location):
+def fetch_page(page, location, target):
     yard = location.lower()
     yard_id = yard_ids.get(yard)
-    yard = yard.lower()
-    yard_id = yard_ids.get(yard)
-    url = f"https://www.pyp.com/DesktopModules/pyp_vehicleInventory/getVehicleInventory.aspx?page=1&filter=mercedes&store={yard_id}"
+    query = quote_plus(str(target.query))
+    url = f"https://www.pyp.com/DesktopModules/pyp_vehicleInventory/getVehicleInventory.aspx?page={page}&filter={query}&store={yard_id}"
     payload = {}
     headers = {
-        'referer': f'https://www.pyp.com/inventory/{yard}-{yard_id}/?search=mercedes'
+        'referer': f'https://www.pyp.com/inventory/{yard}-{yard_id}/?search={query}'
     }
 
-    response = requests.get(url, headers=headers, data=payload)
+    response = session.get(url, headers=headers, data=payload)
     response.raise_for_status()  # Raise an error for bad responses
     return response.text
 
-def search_yard(yard):
-    try:
-        cars_of_interest = []
-        page_num = 1
-
-        while True:
-            page = fetch_page(page_num, yard)
-            page_num += 1
-            soup = BeautifulSoup(page, 'html.parser')
-            rows = soup.find_all('div', {'class': 'pypvi_resultRow'})
-
-
-            health = "healthy"
-
-            # Check if the rows were found
-            if rows:
-                print(f"{str(datetime.now())} - Successully fetched {len(rows)} cars from LKQ.")
-                for row in rows:
-                    car_data = {
-                        "location": yard,
-                        "interest_level": 0,
-                    }
-                    # Extract the year and model from the row
-                    ymm_tag = row.find('a', {'class': 'pypvi_ymm'})
-                    if ymm_tag:
-                        # Get all the text, join with spaces to remove HTML artifacts like <wbr>
-                        ymm_text = ' '.join(ymm_tag.stripped_strings)  # E.g. '2014 MERCEDES-BENZ GL450'
-                        parts = ymm_text.split(maxsplit=2)
-
-                        if len(parts) == 3:
-                            year, make, model = parts
-                            car_data['year'] = int(year)
-                            car_data['make'] = make.upper()
-                            car_data['model'] = model.upper()
-                        else:
-                            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with unexpected YMM format: {ymm_text}")
-                            update_health_status("unhealthy")
-                            continue
-                    else:
-                        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row without YMM tag: {row}")
-                        update_health_status("unhealthy")
-                        continue
-                    # Get all the details in the row with the class 'pypvi_detailItem'
-                    details = row.find_all('div', {'class': 'pypvi_detailItem'})
-                    for detail in details:
-                        try:
-                            for b_tag in detail.find_all('b'):
-                                key = b_tag.get_text(strip=True).rstrip(':')
-                                
-                                # Value is usually a direct sibling
-                                value = ''
-                                next_node = b_tag.next_sibling
-
-                                # If value is plain text (string or NavigableString)
-                                while next_node and (next_node.name is None or next_node.name == 'br'):
-                                    if isinstance(next_node, str):
-                                        value += next_node.strip()
-                                    next_node = next_node.next_sibling
-
-                                # Special case: "Available" uses a <time> tag
-                                if key == "Available":
-                                    time_tag = b_tag.find_next('time')
-                                    if time_tag and time_tag.has_attr('datetime'):
-                                        value = time_tag['datetime']
-                                    elif time_tag:
-                                        value = time_tag.get_text(strip=True)
-
-                                # Store in dictionary
-                                if key == "Color":
-                                    car_data['color'] = value
-                                elif key == "VIN":
-                                    car_data['vin'] = value
-                                elif key == "Stock #":
-                                    car_data['stock_num'] = value
-                                elif key == "Available":
-                                    car_data['date'] = value
-                                elif key == "Section":
-                                    car_data['section'] = value
-                                elif key == "Row":
-                                    car_data['row'] = value
-                                elif key == "Space":
-                                    car_data['space'] = value
-
-                        except ValueError:
-                            # Handle the case where conversion to int fails (e.g., year is not a number)
-                            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {detail.get_text(strip=True)}")
-                            update_health_status("unhealthy")
-
-                    # Extract the main image URL from the row
-                    main_image = row.find('a', {'class': 'pypvi_image'})
-                    if main_image and 'href' in main_image.attrs:
-                        car_data['image'] = main_image['href']
-                    else:
-                        print(f"{str(datetime.now())} - {LOGGING_PREFIX} No main image found for row: {row}")
-                        update_health_status("unhealthy")
-
-                    # Extract all image URLs from the row
-                    image_urls = []
-                    images_div = row.find('div', {'class': 'pypvi_images'})
-                    if images_div:
-                        image_urls = [a['href'] for a in images_div.find_all('a', href=True)]
-                        if image_urls:
-                            car_data['image_urls'] = image_urls
-                    else:
-                        print(f"{str(datetime.now())} - {LOGGING_PREFIX} No images found for row: {row}")
-                        update_health_status("unhealthy")
-
-
-                    year = car_data['year']
-                    model = car_data['model']
-                    if (year >= 1976 and year <= 1985) or (year >= 1996 and year <= 2002 and model.startswith('E')):
-                        car_data['interest_level'] = 1  # Set interest level for cars of interest
-
-                    cars_of_interest.append(car_data)
-                    # Check if the car is already in the database
-                    existing_car = collection.find_one({"stock_num": car_data['stock_num']})
-                    if existing_car is None:
-                        # Send the notification
-                        send_to_home_assistant(car_data)
-                        # Add the car to the database
-                        collection.insert_one(car_data)
-
-                end = soup.find('div', {'class': 'pypvi_end'})
-                if end:
-                    break
-                    
+def parse_page(page, yard):
+    """
+    Parse one inventory page into car records.
+
+    Returns the cars on the page and whether it is the last page of results,
+    or None if the page has no result rows at all.
+    """
+    soup = parse_html(page, INVENTORY_STRAINER)
+    rows = soup.find_all('div', {'class': 'pypvi_resultRow'})
+    if not rows:
+        return None
+
+    print(f"{str(datetime.now())} - Successully fetched {len(rows)} cars from LKQ.")
+    ROWS_PARSED.labels(source=SOURCE).inc(len(rows))
+    cars = []
+    for row in rows:
+        car_data = Vehicle(source=SOURCE, location=yard)
+        # Extract the year and model from the row
+        ymm_tag = row.find('a', {'class': 'pypvi_ymm'})
+        if ymm_tag:
+            # Get all the text, join with spaces to remove HTML artifacts like <wbr>
+            ymm_text = ' '.join(ymm_tag.stripped_strings)  # E.g. '2014 MERCEDES-BENZ GL450'
+            parts = ymm_text.split(maxsplit=2)
+
+            if len(parts) == 3:
+                year, make, model = parts
+                car_data['year'] = int(year)
+                car_data['make'] = make.upper()
+                car_data['model'] = model.upper()
             else:
-                print(f"{str(datetime.now())} - {LOGGING_PREFIX} pypvi_resultRow div not found: {page}")
+                print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with unexpected YMM format: {ymm_text}")
+                update_health_status("unhealthy")
+                continue
+        else:
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row without YMM tag: {row}")
+            update_health_status("unhealthy")
+            continue
+        # Get all the details in the row with the class 'pypvi_detailItem'
+        details = row.find_all('div', {'class': 'pypvi_detailItem'})
+        for detail in details:
+            try:
+                for b_tag in detail.find_all('b'):
+                    key = b_tag.get_text(strip=True).rstrip(':')
+                    
+                    # Value is usually a direct sibling
+                    value = ''
+                    next_node = b_tag.next_sibling
+
+                    # If value is plain text (string or NavigableString)
+                    while next_node and (next_node.name is None or next_node.name == 'br'):
+                        if isinstance(next_node, str):
+                            value += next_node.strip()
+                        next_node = next_node.next_sibling
+
+                    # Special case: "Available" uses a <time> tag
+                    if key == "Available":
+                        time_tag = b_tag.find_next('time')
+                        if time_tag and time_tag.has_attr('datetime'):
+                            value = time_tag['datetime']
+                        elif time_tag:
+                            value = time_tag.get_text(strip=True)
+
+                    # Store in dictionary
+                    if key == "Color":
+                        car_data['color'] = value
+                    elif key == "VIN":
+                        car_data['vin'] = value
+                    elif key == "Stock #":
+                        car_data['stock_num'] = value
+                    elif key == "Available":
+                        car_data['date'] = value
+                    elif key == "Section":
+                        car_data['section'] = value
+                    elif key == "Row":
+                        car_data['row'] = value
+                    elif key == "Space":
+                        car_data['space'] = value
+
+            except ValueError:
+                # Handle the case where conversion to int fails (e.g., year is not a number)
+                print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {detail.get_text(strip=True)}")
                 update_health_status("unhealthy")
-                return
 
-        # Fetch all records from MongoDB
-        existing_cars = fetch_all_records(yard)
+        # Extract the main image URL from the row
+        main_image = row.find('a', {'class': 'pypvi_image'})
+        if main_image and 'href' in main_image.attrs:
+            car_data['image'] = main_image['href']
+        else:
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} No main image found for row: {row}")
+            update_health_status("unhealthy")
+
+        # Extract all image URLs from the row
+        image_urls = []
+        images_div = row.find('div', {'class': 'pypvi_images'})
+        if images_div:
+            image_urls = [a['href'] for a in images_div.find_all('a', href=True)]
+            if image_urls:
+                car_data['image_urls'] = image_urls
+        else:
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} No images found for row: {row}")
+            update_health_status("unhealthy")
+
+        cars.append(car_data)
+
+    end = soup.find('div', {'class': 'pypvi_end'})
+    return cars, end is not None
+
+def fetch_remaining_pages(yard, target, first_page_cars):
+    """
+    Fetch and parse every page of a make's results after the first.
+
+    Pages are requested PAGE_CONCURRENCY at a time and parsed as they arrive.
+    A window that reaches the end of the results (the end marker, an empty
+    page, or a page repeating cars already seen) is the last one requested.
+
+    Returns the cars and whether they are the whole of the results. They
+    aren't when a page before the end had no result rows, or when the
+    MAX_PAGES limit was reached first.
+    """
+    pages = {1: first_page_cars}
+    seen = {car.get('stock_num') for car in first_page_cars}
+    failed = set()
+    last_page = None
+    next_page = 2
+    with ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY, initializer=trace_thread, initargs=(SOURCE,)) as executor:
+        while last_page is None and next_page <= MAX_PAGES:
+            window = range(next_page, min(next_page + PAGE_CONCURRENCY, MAX_PAGES + 1))
+            next_page = window.stop
+            futures = {executor.submit(fetch_page, page_num, yard, target): page_num for page_num in window}
+            parsed_pages = {}
+            for future in as_completed(futures):
+                with stage_timer(SOURCE, "parse"):
+                    parsed_pages[futures[future]] = parse_page(future.result(), yard)
+
+            # Pages arrive out of order, so each is compared with every page before it in page order
+            for page_num in window:
+                parsed = parsed_pages[page_num]
+                if parsed is None:
+                    # Nothing after a page that failed can be trusted either
+                    cars, at_end = [], True
+                    failed.add(page_num)
+                else:
+                    cars, at_end = parsed
+                    stock_nums = {car.get('stock_num') for car in cars}
+                    # A page made only of cars already seen means the site ran out of pages
+                    if cars and stock_nums <= seen:
+                        cars, at_end = [], True
+                    seen.update(stock_nums)
+                pages[page_num] = cars
+                if at_end:
+                    last_page = page_num
+                    break
 
-        # Delete old records not found in the latest search
-        delete_old_records(existing_cars, cars_of_interest)
+    complete = True
+    if last_page is None:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Stopped at the {MAX_PAGES} page limit for {target.make} in {yard}.")
+        last_page = MAX_PAGES
+        complete = False
+    elif last_page in failed:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} pypvi_resultRow div not found on page {last_page} of {target.make} in {yard}.")
+        update_health_status("unhealthy")
+        complete = False
+    return [car for page_num in sorted(pages) if page_num <= last_page for car in pages[page_num]], complete
+
+def search(yard, target):
+    """
+    Fetch and parse every page of one make's results in a yard.
+
+    Returns the cars and whether they are all of the results, or None if
+    there were no results.
+    """
+    # The first page tells us whether there are any more
+    page = fetch_page(1, yard, target)
+    with stage_timer(SOURCE, "parse"):
+        parsed = parse_page(page, yard)
+    if parsed is None:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} pypvi_resultRow div not found for {target.make}: {page}")
+        update_health_status("unhealthy")
+        return None
+
+    cars, at_end = parsed
+    if at_end:
+        return cars, True
+    return fetch_remaining_pages(yard, target, cars)
+
+def search_yard(yard):
+    try:
+        collection = get_collection()
+        snapshot = Snapshot(f"{SOURCE}-{yard}")
+        health = "healthy"
+        # Pages are parsed while the next ones download, so the fetch stage includes the parse time
+        stages = Stages(SOURCE)
+
+        # Every make is searched at once, and the run stops if any search failed so
+        # its cars aren't taken for sold
+        results = fan_out(SOURCE, lambda target: search(yard, target), search_targets(SOURCE))
+        if any(result is None for result in results):
+            return
+
+        # A car listed by more than one search is kept once
+        cars_of_interest = unique_by_stock_num(car for cars, _ in results for car in cars)
+        cars_of_interest = score_vehicles(SOURCE, cars_of_interest)
+        # Sold cars can only be told apart when every search read all of its pages
+        complete = all(search_complete for _, search_complete in results)
+        if not complete:
+            health = "unhealthy"
+
+        # Skip the database entirely if the parsed inventory hasn't changed
+        if complete and snapshot.vehicles_unchanged(cars_of_interest):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Inventory unchanged since the last run, skipping reconcile.")
+            # An unchanged inventory is a run without changes, which the scheduler learns from too
+            count_changes(SOURCE, 0)
+            snapshot.save(reconciled=False)
+            update_health_status(health)
+            return
+
+        stages.start("lookup")
+        # Make sure the reconcile queries are indexed
+        ensure_indexes(collection, SOURCE)
+
+        # Look up which cars are already in the database in one query
+        known_cars = fetch_known_cars(collection, SOURCE, cars_of_interest)
+        new_cars = select_new_cars(cars_of_interest, known_cars)
+
+        # Add new cars and delete old records not found in the latest search
+        stages.start("reconcile")
+        counts = reconcile(collection, SOURCE, cars_of_interest, known_cars, new_cars=new_cars, scope={"location": yard}, logging_prefix=LOGGING_PREFIX, delete_stale=complete)
+        # The new cars are stored either way, so they are still notified
+        if not counts["events_logged"]:
+            health = "unhealthy"
+
+        # Send the notifications
+        stages.start("notify")
+        for car_data in new_cars:
+            send_to_home_assistant(car_data)
+        stages.stop()
+
+        # Remember this inventory so unchanged runs can be skipped. Incomplete runs
+        # leave the snapshot alone, so the next run reads every page again.
+        if complete:
+            snapshot.save()
 
         # If everything is successful, set the status to healthy
         update_health_status(health)
@@ -215,5 +309,12 @@ def search_yard(yard):
         print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in LKQ: {format_exc()}")
         update_health_status("unhealthy")
 
-search_yard("Dayton")
-search_yard("Cincinnati")
\ No newline at end of file
+def run():
+    """Scrape both LKQ yards in parallel and reconcile them with the database."""
+    with ThreadPoolExecutor(max_workers=2, initializer=trace_thread, initargs=(SOURCE,)) as executor:
+        list(executor.map(search_yard, ["Dayton", "Cincinnati"]))
+
+if __name__ == "__main__":
+    run()
+    notifier.close()
+    close_connection()
@@ -1,57 +1,39 @@
-import requests
 from dotenv import load_dotenv
 import os
-from pymongo import MongoClient
 from datetime import datetime
 from traceback import format_exc
 import sys
-import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.churn import count_changes
+from common.db import close_connection, ensure_indexes, fetch_known_cars, get_collection, reconcile, select_new_cars
+from common.fingerprint import Snapshot
+from common.http_client import session
+from common.interest import score_vehicles
+from common.metrics import ENRICHMENT_REQUESTS, ROWS_PARSED, Stages
+from common.notify import notifier
+from common.targets import fan_out, search_targets, unique_by_stock_num
+from common.vehicle import Vehicle
 
 # Load environment variables
 load_dotenv()
 
 LOGGING_PREFIX = "(Pick-n-Pull)"
-MAX_RETRIES = 3
-
-# MongoDB connection details
-MONGO_URI = os.getenv('MONGO_URI')
-MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
-MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB_NAME]
-collection = db[MONGO_COLLECTION_NAME]
-
-# Home Assistant webhook URL
-home_assistant_webhook_url = f"https://ha.tsmcclel.top/api/webhook/{os.getenv('HOME_ASSISTANT_WEBHOOK_ID')}"
+SOURCE = "picknpull"
+# Records stored before the source field existed, told apart by the fields only this yard wrote.
+# Pick-n-Pull and Pull-a-Part stored trims, and only Pull-a-Part a location ID.
+LEGACY_RECORDS = {"trim": {"$exists": True}, "location_id": {"$exists": False}}
 
 def send_to_home_assistant(data):
-    response = requests.post(home_assistant_webhook_url, json=data)
-    if response.status_code == 200:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Data sent to Home Assistant successfully.")
-    else:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to send data to Home Assistant: {response.status_code}")
-        update_health_status("unhealthy")
-
-def fetch_all_records():
-    """Fetch all records from MongoDB collection."""
-    return list(collection.find())
-
-def delete_old_records(existing_cars, latest_cars):
-    """Delete records from MongoDB that are not found in the latest search."""
-    latest_stock_nums = [car['stock_num'] for car in latest_cars]
-
-    for car in existing_cars:
-        if car['stock_num'] not in latest_stock_nums:
-            collection.delete_one({"stock_num": car['stock_num']})
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Deleted record: {car}")
+    """Queue a notification, which is sent to Home Assistant in the background."""
+    notifier.send(data, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
 
 def fetch_vehicle_details(vin):
     """Fetch vehicle details from picknpull using VIN."""
     try:
+        ENRICHMENT_REQUESTS.labels(service="picknpull_details").inc()
         url = f"https://www.picknpull.com/api/vehicle/{vin}"
-        response = requests.get(url)
+        response = session.get(url)
         if response.status_code == 200:
             data = response.json()
             return data["vehicle"]
@@ -71,106 +53,134 @@ def update_health_status(status):
     with open(f"{directory}/health_status.txt", "w") as file:
         file.write(status)
 
-try:
-    # Pick-n-Pull API endpoint
-    url = "https://www.picknpull.com/api/vehicle/search?&makeId=182&modelId=0&year=&distance=10&zip=43207&language=english"
+def search(target):
+    """Run one make's inventory search. Returns its cars, or None if the search failed."""
+    url = f"https://www.picknpull.com/api/vehicle/search?&makeId={target.query}&modelId=0&year=&distance=10&zip=43207&language=english"
     payload = {}
     headers = {'accept': 'application/json, text/plain, */*'}
-    cars = []
 
-    # Retry loop
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            response = requests.post(url, headers=headers, data=payload)
-            response.raise_for_status()  # Check for HTTP errors
-            data = response.json()
-
-            data = data[0]
-            if 'vehicles' in data:
-                cars = data['vehicles']
-                print(f"{str(datetime.now())} - Successfully fetched {len(cars)} cars from Pick-n-Pull.")
-                break  # Exit retry loop on success
-            else:
-                print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: 'vehicles' key not found in response - {response.text}")
-                update_health_status("unhealthy")
-                sys.exit(1)
-
-        except Exception as e:
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: Request failed (attempt {attempt}/{MAX_RETRIES}) - {e}")
-
-            if attempt < MAX_RETRIES:
-                print(f"{str(datetime.now())} - {LOGGING_PREFIX} Retrying in 60 seconds...")
-                time.sleep(60)
-            else:
-                print(f"{str(datetime.now())} - {LOGGING_PREFIX} Max retries reached. Exiting.")
-                update_health_status("unhealthy")
-                sys.exit(1)
-
-    # List to store cars of interest
-    cars_of_interest = []
-
-    # Iterate through each car in the response
-    for car in cars:
-        try:
-            location = car['locationName']
-            year = int(car['year'])
-            model = (car['model']).upper()
-            vin = car['vin']
-            stock_num = car['barCodeNumber']
-            row = car['row']
-            date = car['dateAdded']
-            image_url = car['imageName']
-            interest_level = 0  # Default interest level
-
-            # Apply filter criteria
-            if (1976 <= year <= 1985) or (1996 <= year <= 2002 and model == "E-CLASS"):
-                interest_level = 1
-
-            car_data = {
-                "location": location,
-                "year": year,
-                "model": model,
-                "vin": vin,
-                "stock_num": stock_num,
-                "row": row,
-                "date": date,
-                "image": image_url,
-                "interest_level": interest_level
-            }
-
-            # Check if the car is already in the database
-            existing_car = collection.find_one({"stock_num": stock_num})
-            if existing_car is None:
-                details = fetch_vehicle_details(vin)
-                car_data["trim"] = details.get("trim", "Unknown") if details else "Unknown"
-                car_data["engine"] = details.get("engine", "Unknown") if details else "Unknown"
-                car_data["transmission"] = details.get("transmission", "Unknown") if details else "Unknown"
-                car_data["color"] = details.get("color", "Unknown") if details else "Unknown"
-
-                # Send the notification
-                send_to_home_assistant(car_data)
-                # Add the car to the database
-                collection.insert_one(car_data)
-
-            cars_of_interest.append(car_data)
-
-        except ValueError:
-            # Handle cases where conversion to int fails
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {car}")
-            update_health_status("unhealthy")
-
-    # Fetch all records from MongoDB
-    existing_cars = fetch_all_records()
+    # Transient failures are retried with backoff by the shared HTTP client
+    try:
+        response = session.post(url, headers=headers, data=payload)
+        response.raise_for_status()  # Check for HTTP errors
+        data = response.json()[0]
+    except Exception as e:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: Request failed - {e}")
+        update_health_status("unhealthy")
+        return None
 
-    # Delete old records not found in the latest search
-    delete_old_records(existing_cars, cars_of_interest)
+    if 'vehicles' not in data:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: 'vehicles' key not found in response - {response.text}")
+        update_health_status("unhealthy")
+        return None
+    print(f"{str(datetime.now())} - Successfully fetched {len(data['vehicles'])} {target.make} cars from Pick-n-Pull.")
+    return data['vehicles']
 
-    # If everything is successful, set the status to healthy
-    update_health_status("healthy")
+def run():
+    """Scrape the Pick-n-Pull inventory and reconcile it with the database."""
+    try:
+        collection = get_collection()
+        snapshot = Snapshot(SOURCE)
+        stages = Stages(SOURCE)
+        targets = search_targets(SOURCE)
+
+        # Every make is searched at once, and the run stops if any search failed so
+        # its cars aren't taken for sold
+        results = fan_out(SOURCE, search, targets)
+        if any(cars is None for cars in results):
+            return
+
+        stages.start("parse")
+        ROWS_PARSED.labels(source=SOURCE).inc(sum(len(cars) for cars in results))
+
+        # List to store cars of interest
+        cars_of_interest = []
+
+        # Iterate through each car in the responses
+        for target, cars in zip(targets, results):
+            for car in cars:
+                try:
+                    location = car['locationName']
+                    year = int(car['year'])
+                    model = (car['model']).upper()
+                    vin = car['vin']
+                    stock_num = car['barCodeNumber']
+                    row = car['row']
+                    date = car['dateAdded']
+                    image_url = car['imageName']
+
+                    car_data = Vehicle(
+                        source=SOURCE,
+                        location=location,
+                        year=year,
+                        make=target.make,
+                        model=model,
+                        vin=vin,
+                        stock_num=stock_num,
+                        row=row,
+                        date=date,
+                        image=image_url,
+                    )
+
+                    cars_of_interest.append(car_data)
+
+                except ValueError:
+                    # Handle cases where conversion to int fails
+                    print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {car}")
+                    update_health_status("unhealthy")
+
+        # A car listed by more than one search is kept once
+        cars_of_interest = unique_by_stock_num(cars_of_interest)
+        cars_of_interest = score_vehicles(SOURCE, cars_of_interest)
+
+        # Skip the database entirely if the parsed inventory hasn't changed
+        if snapshot.vehicles_unchanged(cars_of_interest):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Inventory unchanged since the last run, skipping reconcile.")
+            # An unchanged inventory is a run without changes, which the scheduler learns from too
+            count_changes(SOURCE, 0)
+            snapshot.save(reconciled=False)
+            update_health_status("healthy")
+            return
+
+        stages.start("lookup")
+        # Make sure the reconcile queries are indexed
+        ensure_indexes(collection, SOURCE)
+
+        # Look up which cars are already in the database in one query
+        known_cars = fetch_known_cars(collection, SOURCE, cars_of_interest)
+        new_cars = select_new_cars(cars_of_interest, known_cars)
+
+        stages.start("enrich")
+        for car_data in new_cars:
+            details = fetch_vehicle_details(car_data["vin"])
+            car_data["trim"] = details.get("trim", "Unknown") if details else "Unknown"
+            car_data["engine"] = details.get("engine", "Unknown") if details else "Unknown"
+            car_data["transmission"] = details.get("transmission", "Unknown") if details else "Unknown"
+            car_data["color"] = details.get("color", "Unknown") if details else "Unknown"
+
+        # Add new cars and delete old records not found in the latest search
+        stages.start("reconcile")
+        counts = reconcile(collection, SOURCE, cars_of_interest, known_cars, new_cars=new_cars, legacy=LEGACY_RECORDS, logging_prefix=LOGGING_PREFIX)
+        # The new cars are stored either way, so they are still notified
+        health = "healthy" if counts["events_logged"] else "unhealthy"
+
+        # Send the notifications
+        stages.start("notify")
+        for car_data in new_cars:
+            send_to_home_assistant(car_data)
+        stages.stop()
+
+        # Remember this inventory so unchanged runs can be skipped
+        snapshot.save()
+
+        # If everything is successful, set the status to healthy
+        update_health_status(health)
 
-except Exception as e:
-    print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in picknpull: {format_exc()}")
-    update_health_status("unhealthy")
+    except Exception as e:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in picknpull: {format_exc()}")
+        update_health_status("unhealthy")
 
-# Close MongoDB connection
-client.close()
+if __name__ == "__main__":
+    run()
+    notifier.close()
+    close_connection()
@@ -1,60 +1,55 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
-from pymongo import MongoClient
 from datetime import datetime
 from traceback import format_exc
 from urllib.parse import urlparse
 import sys
 import json
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import close_connection, ensure_indexes, fetch_known_cars, fetch_records, get_collection, reconcile, select_new_cars
+from common.http_client import session
+from common.interest import score_vehicles
+from common.metrics import ENRICHMENT_REQUESTS, ROWS_PARSED, Stages
+from common.negative_cache import NegativeCache
+from common.notify import notifier
+from common.profiling import trace_thread
+from common.targets import fan_out, search_targets, unique_by_stock_num
+from common.vehicle import Vehicle
+
 # Load environment variables
 load_dotenv()
 
 LOGGING_PREFIX = "(Pull-a-Part)"
-
-# MongoDB connection details
-MONGO_URI = os.getenv('MONGO_URI')
-MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
-MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB_NAME]
-collection = db[MONGO_COLLECTION_NAME]
-
-# Home Assistant webhook URL
-home_assistant_webhook_url = f"https://ha.tsmcclel.top/api/webhook/{os.getenv('HOME_ASSISTANT_WEBHOOK_ID')}"
+SOURCE = "pullapart"
+# Records stored before the source field existed, told apart by the fields only this yard wrote.
+# Only Pull-a-Part stored a location ID.
+LEGACY_RECORDS = {"location_id": {"$exists": True}}
+# Number of image and extended info lookups run in parallel
+ENRICHMENT_WORKERS = int(os.getenv('PULLAPART_ENRICHMENT_WORKERS', '8'))
+# Cars without a photo are checked again after this long, twice as long after every further miss, up to the maximum
+IMAGE_CACHE_PATH = os.getenv('PULLAPART_IMAGE_CACHE_PATH', '/tmp/pullapart/missing_images.sqlite3')
+IMAGE_RECHECK_INTERVAL = float(os.getenv('PULLAPART_IMAGE_RECHECK_MINUTES', '60')) * 60
+IMAGE_RECHECK_MAX_INTERVAL = float(os.getenv('PULLAPART_IMAGE_RECHECK_MAX_HOURS', '24')) * 3600
+
+image_misses = NegativeCache(IMAGE_CACHE_PATH, IMAGE_RECHECK_INTERVAL, IMAGE_RECHECK_MAX_INTERVAL)
+# Returned by fetch_vehicle_image when the image service couldn't be asked, as opposed to a car without a photo
+IMAGE_LOOKUP_FAILED = object()
 
 def send_to_home_assistant(data):
-    response = requests.post(home_assistant_webhook_url, json=data)
-    if response.status_code == 200:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Data sent to Home Assistant successfully.")
-    else:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to send data to Home Assistant: {response.status_code}")
-        update_health_status("unhealthy")
-
-def fetch_all_records():
-    """Fetch all records from MongoDB collection."""
-    return list(collection.find())
-
-def delete_old_records(existing_cars, latest_cars):
-    """Delete records from MongoDB that are not found in the latest search."""
-    latest_stock_nums = [car['stock_num'] for car in latest_cars]
-
-    for car in existing_cars:
-        if car['stock_num'] not in latest_stock_nums:
-            collection.delete_one({"stock_num": car['stock_num']})
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Deleted record: {car}")
+    """Queue a notification, which is sent to Home Assistant in the background."""
+    notifier.send(data, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
 
 def fetch_vehicle_details(vehicle):
     """Fetch extended vehicle details."""
     try:
+        ENRICHMENT_REQUESTS.labels(service="pullapart_details").inc()
         locID = vehicle["locID"]
         ticketID = vehicle["ticketID"]
         lineID = vehicle["lineID"]
         url = f"https://inventoryservice.pullapart.com/VehicleExtendedInfo/{locID}/{ticketID}/{lineID}"
-        response = requests.get(url)
+        response = session.get(url)
         if response.status_code == 200:
             data = response.json()
             return data
@@ -68,24 +63,29 @@ def fetch_vehicle_details(vehicle):
         return None
     
 def fetch_vehicle_image(vehicle):
-    """Fetch vehicle image """
+    """Fetch vehicle image. Returns its URL, None if the car has no photo, or IMAGE_LOOKUP_FAILED if the lookup failed."""
     try:
+        ENRICHMENT_REQUESTS.labels(service="pullapart_images").inc()
         locID = vehicle["locID"]
         ticketID = vehicle["ticketID"]
         lineID = vehicle["lineID"]
         url = f"https://imageservice.pullapart.com/img/retrieveimage/?locID={locID}&ticketID={ticketID}&lineID={lineID}&programID=35&imageIndex=1"
-        response = requests.get(url)
+        response = session.get(url)
         if response.status_code == 200:
             data = response.json()
-            return data["webPath"]
+            return data.get("webPath")
         else:
             print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to fetch vehicle image for vehicle {vehicle}.")
             update_health_status("unhealthy")
-            return None
+            return IMAGE_LOOKUP_FAILED
     except Exception as e:
         print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error fetching vehicle image for vehicle {vehicle}: {str(e)}")
         update_health_status("unhealthy")
-        return None
+        return IMAGE_LOOKUP_FAILED
+
+def image_key(vehicle):
+    """The image service identifies a car's photos by its location, ticket and line."""
+    return f"{vehicle['locID']}/{vehicle['ticketID']}/{vehicle['lineID']}"
 
 def update_health_status(status):
     directory = "/tmp/pullapart"
@@ -101,7 +101,8 @@ def is_url(string):
     except ValueError:
         return False
 
-try:
+def search(target):
+    """Run one make's inventory search across every location. Returns its cars, or None if the search failed."""
     # Pull-a-Part API endpoint
     url = "https://inventoryservice.pullapart.com/Vehicle/Search"
 
@@ -112,7 +113,7 @@ try:
             8,
             35
         ],
-        "MakeID": 37,
+        "MakeID": target.query,
         "Models": [],
         "Years": []
     })
@@ -124,7 +125,7 @@ try:
     cars = []
 
     try:
-        response = requests.post(url, headers=headers, data=payload)
+        response = session.post(url, headers=headers, data=payload)
         response.raise_for_status()  # Check for HTTP errors
 
         try:
@@ -132,104 +133,164 @@ try:
             for location in data:
                 if 'exact' in location:
                     cars.extend(location['exact'])
-                    print(f"{str(datetime.now())} - Succesfully fetched {len(location['exact'])} cars from Pull-a-Part.")
+                    print(f"{str(datetime.now())} - Succesfully fetched {len(location['exact'])} {target.make} cars from Pull-a-Part.")
                 else:
                     print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: 'exact' key not found in the response: {location}")
                     update_health_status("unhealthy")
-                    sys.exit(1)
+                    return None
         except Exception as e:
             print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error parsing JSON response: {e} - {response.text}")
             update_health_status("unhealthy")
-            sys.exit(1)
+            return None
 
     except Exception as e:
         print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: Request failed - {e}")
         update_health_status("unhealthy")
-        sys.exit(1)
-
-    # List to store cars of interest
-    cars_of_interest = []
-
-    # Iterate through each car in the response
-    for car in cars:
-        try:
-            location = car['locName']
-            location_id = car['locID']
-            year = int(car['modelYear'])
-            model = (car['modelName']).upper()
-            vin = car['vin']
-            stock_num = car['vinID']
-            row = car['row']
-            date = car['dateYardOn']
-            interest_level = 0  # Default interest level
-
-            # Apply filter criteria
-            if (year >= 1976 and year <= 1985) or (year >= 1996 and year <= 2002 and model == "E-CLASS"):
-                interest_level = 1
-                
-            car_data = {
-                "location": location,
-                "location_id": location_id,
-                "year": year,
-                "model": model,
-                "vin": vin,
-                "stock_num": stock_num,
-                "row": row,
-                "date": date,
-                "interest_level": interest_level
-            }
-
-            # Check if the car is already in the database
-            existing_car = collection.find_one({"stock_num": stock_num})
-            if existing_car is None:
-                # Fetch vehicle image
-                image_url = fetch_vehicle_image(car)
-                car_data["image"] = image_url
-
-                details = fetch_vehicle_details(car)
-                if details:
-                    car_data["trim"] = details["trim"] if details["trim"] else None
-                    car_data["engine"] = str(details["engineSize"]) + "L " + details["engineBlock"] + str(details["engineCylinders"]) if details["engineBlock"] else None
-                    car_data["transmission"] = str(details["transSpeeds"]) + " speed " + details["transType"] if details["transType"] else None
-                    car_data["color"] = details["color"] if details["color"] else None
-                    car_data["style"] = details["style"] if details["style"] else None
-                
-                # Send the notification
-                send_to_home_assistant(car_data)
-                # Add the car to the database
-                collection.insert_one(car_data)
-
-            # Check if image has been added for an existing car if not already present
-            elif existing_car.get("image") is None or not is_url(existing_car["image"]):
-                # Fetch vehicle image if not already present
-                image_url = fetch_vehicle_image(car)
-                if image_url and image_url != existing_car.get("image"):
-                    print(f"{str(datetime.now())} - {LOGGING_PREFIX} Updating image for existing car: {stock_num}")
-                    existing_car["image"] = image_url
-                    collection.update_one({"stock_num": stock_num}, {"$set": {"image": image_url}})
-                    # Send to Home Assistant minus the Object ID
-                    existing_car.pop("_id", None)
-                    send_to_home_assistant(existing_car)
-
-            cars_of_interest.append(car_data)
-
-        except ValueError:
-            # Handle cases where conversion to int fails
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {car}")
-            update_health_status("unhealthy")
+        return None
 
-    # Fetch all records from MongoDB
-    existing_cars = fetch_all_records()
+    return cars
 
-    # Delete old records not found in the latest search
-    delete_old_records(existing_cars, cars_of_interest)
+def run():
+    """Scrape the Pull-a-Part inventory and reconcile it with the database."""
+    try:
+        collection = get_collection()
+        stages = Stages(SOURCE)
+        targets = search_targets(SOURCE)
+
+        # Every make is searched at once, and the run stops if any search failed so
+        # its cars aren't taken for sold
+        results = fan_out(SOURCE, search, targets)
+        if any(cars is None for cars in results):
+            return
+
+        stages.start("parse")
+        ROWS_PARSED.labels(source=SOURCE).inc(sum(len(cars) for cars in results))
+        # List to store cars of interest
+        cars_of_interest = []
+        # Raw search results keyed by stock number, needed for the image and details lookups
+        vehicles = {}
+
+        # Iterate through each car in the responses
+        for target, cars in zip(targets, results):
+            for car in cars:
+                try:
+                    location = car['locName']
+                    location_id = car['locID']
+                    year = int(car['modelYear'])
+                    model = (car['modelName']).upper()
+                    vin = car['vin']
+                    stock_num = car['vinID']
+                    row = car['row']
+                    date = car['dateYardOn']
+
+                    car_data = Vehicle(
+                        source=SOURCE,
+                        location=location,
+                        location_id=location_id,
+                        year=year,
+                        make=target.make,
+                        model=model,
+                        vin=vin,
+                        stock_num=stock_num,
+                        row=row,
+                        date=date,
+                    )
+
+                    vehicles.setdefault(stock_num, car)
+                    cars_of_interest.append(car_data)
+
+                except ValueError:
+                    # Handle cases where conversion to int fails
+                    print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {car}")
+                    update_health_status("unhealthy")
 
-    # If everything is successful, set the status to healthy
-    update_health_status("healthy")
+        # A car listed by more than one search is kept once
+        cars_of_interest = unique_by_stock_num(cars_of_interest)
+        cars_of_interest = score_vehicles(SOURCE, cars_of_interest)
+
+        stages.start("lookup")
+        # Make sure the reconcile queries are indexed
+        ensure_indexes(collection, SOURCE)
+
+        # Look up which cars are already in the database in one query, with just the fields needed to find missing images
+        known_cars = fetch_known_cars(collection, SOURCE, cars_of_interest, projection={"_id": 0, "stock_num": 1, "source": 1, "image": 1})
+        new_cars = select_new_cars(cars_of_interest, known_cars)
+
+        # Cars already stored whose image hasn't been added yet
+        missing_images = [
+            stock_num for stock_num, existing_car in known_cars.items()
+            if existing_car.get("image") is None or not is_url(existing_car["image"])
+        ]
+        # Only the ones whose last check is far enough in the past are checked again
+        image_keys = {stock_num: image_key(vehicles[stock_num]) for stock_num in missing_images}
+        due = set(image_misses.due(image_keys.values()))
+        recheck_images = [stock_num for stock_num in missing_images if image_keys[stock_num] in due]
+        ENRICHMENT_REQUESTS.labels(service="pullapart_images_cached").inc(len(missing_images) - len(recheck_images))
+
+        stages.start("enrich")
+        # Fetch the images and extended details for every car in parallel. The shared
+        # HTTP client caps how many of these requests are in flight to each service.
+        with ThreadPoolExecutor(max_workers=ENRICHMENT_WORKERS, initializer=trace_thread, initargs=(SOURCE,)) as executor:
+            new_images = executor.map(lambda car_data: fetch_vehicle_image(vehicles[car_data["stock_num"]]), new_cars)
+            new_details = executor.map(lambda car_data: fetch_vehicle_details(vehicles[car_data["stock_num"]]), new_cars)
+            existing_images = executor.map(lambda stock_num: fetch_vehicle_image(vehicles[stock_num]), recheck_images)
+            new_images, new_details, existing_images = list(new_images), list(new_details), list(existing_images)
+
+        # Only lookups the image service answered say whether a car has a photo. Failed
+        # ones are neither backed off from nor stored, so they are simply tried again.
+        checked = [(image_key(vehicles[car_data["stock_num"]]), image_url) for car_data, image_url in zip(new_cars, new_images)]
+        checked += [(image_keys[stock_num], image_url) for stock_num, image_url in zip(recheck_images, existing_images)]
+        checked = [(key, image_url) for key, image_url in checked if image_url is not IMAGE_LOOKUP_FAILED]
+        new_images = [None if image_url is IMAGE_LOOKUP_FAILED else image_url for image_url in new_images]
+        existing_images = [None if image_url is IMAGE_LOOKUP_FAILED else image_url for image_url in existing_images]
+
+        for car_data, image_url, details in zip(new_cars, new_images, new_details):
+            car_data["image"] = image_url
+            if details:
+                car_data["trim"] = details["trim"] if details["trim"] else None
+                car_data["engine"] = str(details["engineSize"]) + "L " + details["engineBlock"] + str(details["engineCylinders"]) if details["engineBlock"] else None
+                car_data["transmission"] = str(details["transSpeeds"]) + " speed " + details["transType"] if details["transType"] else None
+                car_data["color"] = details["color"] if details["color"] else None
+                car_data["style"] = details["style"] if details["style"] else None
+
+        # Check if image has been added for existing cars if not already present
+        image_updates = []
+        for stock_num, image_url in zip(recheck_images, existing_images):
+            existing_car = known_cars[stock_num]
+            if image_url and image_url != existing_car.get("image"):
+                print(f"{str(datetime.now())} - {LOGGING_PREFIX} Updating image for existing car: {stock_num}")
+                existing_car["image"] = image_url
+                image_updates.append((stock_num, {"image": image_url}))
+
+        # Back off from the cars that still have no photo, and forget the ones that got one or left the yard
+        missed = [key for key, image_url in checked if not (image_url and is_url(image_url))]
+        image_misses.record(found=[key for key, image_url in checked if image_url and is_url(image_url)], missed=missed)
+        image_misses.retain(set(image_keys.values()) | set(missed))
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Checked {len(recheck_images)} of {len(missing_images)} stored cars without an image, {len(missed)} lookups found none.")
+
+        # Add new cars, update images and delete old records not found in the latest search
+        stages.start("reconcile")
+        counts = reconcile(collection, SOURCE, cars_of_interest, known_cars, new_cars=new_cars, updates=image_updates, legacy=LEGACY_RECORDS, logging_prefix=LOGGING_PREFIX)
+        # The new cars are stored either way, so they are still notified
+        health = "healthy" if counts["events_logged"] else "unhealthy"
+        # The whole record is only read for the cars that got an image
+        updated_cars = list(fetch_records(collection, SOURCE, [stock_num for stock_num, _ in image_updates]).values())
+
+        # Send the notifications
+        stages.start("notify")
+        for car_data in new_cars + updated_cars:
+            send_to_home_assistant(car_data)
+        stages.stop()
+
+        # If everything is successful, set the status to healthy
+        update_health_status(health)
 
-except Exception as e:
-    print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in pullapart: {format_exc()}")
-    update_health_status("unhealthy")
+    except Exception as e:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in pullapart: {format_exc()}")
+        update_health_status("unhealthy")
 
-# Close MongoDB connection
-client.close()
+if __name__ == "__main__":
+    run()
+    notifier.close()
+    close_connection()
+    image_misses.close()
@@ -1,65 +1,35 @@
-import requests
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from pymongo import MongoClient
 from datetime import datetime
 from traceback import format_exc
+from urllib.parse import quote_plus
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.churn import count_changes
+from common.db import close_connection, ensure_indexes, fetch_known_cars, get_collection, reconcile, select_new_cars
+from common.fingerprint import Snapshot
+from common.http_client import session
+from common.interest import score_vehicles
+from common.metrics import ROWS_PARSED, Stages
+from common.nhtsa import add_vehicle_details
+from common.notify import notifier
+from common.parsing import parse_html, tags
+from common.targets import fan_out, search_targets, unique_by_stock_num
+from common.vehicle import Vehicle
 
 # Load environment variables
 load_dotenv()
 
-# MongoDB connection details
-MONGO_URI = os.getenv('MONGO_URI')
-MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
-MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB_NAME]
-collection = db[MONGO_COLLECTION_NAME]
-
-# Home Assistant webhook URL
-home_assistant_webhook_url = f"https://ha.tsmcclel.top/api/webhook/{os.getenv('HOME_ASSISTANT_WEBHOOK_ID')}"
+LOGGING_PREFIX = "(Pull-n-Save)"
+SOURCE = "pullnsave"
+# Only tables and the h2 carrying the "no matching vehicles" message are built into the parse tree
+INVENTORY_STRAINER = tags('table', 'h2')
+SEARCH_URL = "https://pullnsave.com/wp-admin/admin-ajax.php"
 
 def send_to_home_assistant(data):
-    response = requests.post(home_assistant_webhook_url, json=data)
-    if response.status_code == 200:
-        print(f"{str(datetime.now())} - Data sent to Home Assistant successfully.")
-    else:
-        print(f"{str(datetime.now())} - Failed to send data to Home Assistant: {response.status_code}")
-        update_health_status("unhealthy")
-
-def fetch_all_records(yard):
-    """Fetch all records from MongoDB collection."""
-    return list(collection.find({"yard": yard}))
-
-def delete_old_records(existing_cars, latest_cars):
-    """Delete records from MongoDB that are not found in the latest search."""
-    latest_stock_nums = [car['stock_num'] for car in latest_cars]
-
-    for car in existing_cars:
-        if car['stock_num'] not in latest_stock_nums:
-            collection.delete_one({"stock_num": car['stock_num']})
-            print(f"{str(datetime.now())} - Deleted record with stock_num: {car['stock_num']}")
-
-def fetch_vehicle_details(vin):
-    """Fetch vehicle details from NHTSA API using VIN."""
-    try:
-        nhtsa_api_url = f"https://vpic.nhtsa.dot.gov/api/vehicles/decodevinvalues/{vin}?format=json"
-        response = requests.get(nhtsa_api_url)
-        if response.status_code == 200:
-            data = response.json()
-            series = data['Results'][0]['Series']
-            return series
-        else:
-            print(f"{str(datetime.now())} - Failed to fetch vehicle details for VIN {vin}.")
-            update_health_status("unhealthy")
-            return None
-    except Exception as e:
-        print(f"{str(datetime.now())} - Error fetching vehicle details for VIN {vin}: {str(e)}")
-        update_health_status("unhealthy")
-        return None
+    """Queue a notification, which is sent to Home Assistant in the background."""
+    notifier.send(data, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
 
 def update_health_status(status):
     directory = "/tmp/pullnsave"
@@ -68,108 +38,177 @@ def update_health_status(status):
     with open(f"{directory}/health_status.txt", "w") as file:
         file.write(status)
 
-def search_yard(yard):
-    try:
-        url = "https://pullnsave.com/wp-admin/admin-ajax.php"
-
-        payload = f"makes=Mercedes-Benz&models=0&years=1976&endYears=2002&store={yard}&beginDate=&endDate=&action=getVehicles"
-        headers = {
-            'accept': '*/*',
-            'accept-language': 'en-US,en;q=0.9',
-            'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36'
-        }
-
-        response = requests.post(url, headers=headers, data=payload)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        table = soup.find('table', {'class': 'table', 'id': 'vehicletable1'})
-
-        cars_of_interest = []
-
-        health = "healthy"
-
-        # Check if the table was found
-        if table:
-            # Find all rows in the table body
-            rows = table.find('tbody').find_all('tr')
-            print(f"{str(datetime.now())} - Successully fetched {len(rows)} cars from Pull-n-Save.")
-            
-            for row in rows:
-                # Get all the columns in the row
-                cols = row.find_all('td')
-
-                # Extract the image URL
-                img_tag = cols[0].find('img')
-            
-                # Extract the image URL from the 'src' attribute
-                if img_tag and 'src' in img_tag.attrs:
-                    image = img_tag['src']
-                else:
-                    image = None  # Handle case where no image is found
-
-                # Extract text from each column and strip any extra whitespace
-                col_data = [col.text.strip() for col in cols]
-                if col_data:
-                    try:
-                        year = int(col_data[1])
-                        model = col_data[2].upper()
-                        date = col_data[3]
-                        row = col_data[4]
-                        yard_name = col_data[5]
-                        color = col_data[6]
-                        stock_num = col_data[7]
-                        vin = col_data[8]
-
-                        car_data = {
-                            "yard": yard,
-                            "location": yard_name,
-                            "year": year,
-                            "model": model,
-                            "color": color,
-                            "vin": vin,
-                            "stock_num": stock_num,
-                            "row": row,
-                            "date": date,
-                            "image": image
-                        }
-
-                        if (year >= 1976 and year <= 1985) or (year >= 1996 and year <= 2002 and "E-CLASS" in model):
-                            cars_of_interest.append(car_data)
-                            # Check if the car is already in the database
-                            existing_car = collection.find_one({"stock_num": stock_num})
-                            if existing_car is None:
-                                # Fetch additional details from NHTSA API
-                                if len(vin) == 17:  # Check if VIN is 17 characters
-                                    series = fetch_vehicle_details(vin)
-                                    if series:
-                                        car_data['series'] = series
-
-                                # Send the notification
-                                send_to_home_assistant(car_data)
-                                # Add the car to the database
-                                collection.insert_one(car_data)
-                    except ValueError:
-                        # Handle the case where conversion to int fails (e.g., year is not a number)
-                        print(f"{str(datetime.now())} - Skipping row with invalid data: {col_data}")
-                        update_health_status("unhealthy")
-        else:
-            print(f"{str(datetime.now())} - Table not found.")
-            h2 = soup.find('h2')
-            if h2:
-                if "I'm sorry but there are no matching vehicles at" in h2.text:
-                    print(f"{str(datetime.now())} - No vehicles found in Pull-n-Save.")
-                else:
-                    print(f"{str(datetime.now())} - Unexpected text found: {h2.text}")
-                    health = "unhealthy"
+def response_key(target):
+    """Every make is posted to the same URL, so their responses are remembered under the URL and the make."""
+    return f"{SEARCH_URL}#{target.query}"
+
+def fetch_inventory(yard, target, snapshot=None):
+    """Search one store for one make and return the response, made conditional on the snapshot's validators if given."""
+    payload = f"makes={quote_plus(str(target.query))}&models=0&years=1976&endYears=2002&store={yard}&beginDate=&endDate=&action=getVehicles"
+    headers = {
+        'accept': '*/*',
+        'accept-language': 'en-US,en;q=0.9',
+        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36'
+    }
+
+    if snapshot is not None:
+        headers.update(snapshot.request_headers(response_key(target)))
+    return session.post(SEARCH_URL, headers=headers, data=payload)
+
+def parse_inventory(yard, target, response):
+    """Parse one make's search results. Returns the cars and the health of the page."""
+    soup = parse_html(response.text, INVENTORY_STRAINER)
+    table = soup.find('table', {'class': 'table', 'id': 'vehicletable1'})
+
+    cars = []
+
+    health = "healthy"
+
+    # Check if the table was found
+    if table:
+        # Find all rows in the table body
+        rows = table.find('tbody').find_all('tr')
+        ROWS_PARSED.labels(source=SOURCE).inc(len(rows))
+        print(f"{str(datetime.now())} - Successully fetched {len(rows)} {target.make} cars from Pull-n-Save.")
+        
+        for row in rows:
+            # Get all the columns in the row
+            cols = row.find_all('td')
+
+            # Extract the image URL
+            img_tag = cols[0].find('img')
+        
+            # Extract the image URL from the 'src' attribute
+            if img_tag and 'src' in img_tag.attrs:
+                image = img_tag['src']
             else:
-                print(f"{str(datetime.now())} - h2 text not found.")
+                image = None  # Handle case where no image is found
+
+            # Extract text from each column and strip any extra whitespace
+            col_data = [col.text.strip() for col in cols]
+            if col_data:
+                try:
+                    year = int(col_data[1])
+                    model = col_data[2].upper()
+                    date = col_data[3]
+                    row = col_data[4]
+                    yard_name = col_data[5]
+                    color = col_data[6]
+                    stock_num = col_data[7]
+                    vin = col_data[8]
+
+                    car_data = Vehicle(
+                        source=SOURCE,
+                        yard=yard,
+                        location=yard_name,
+                        year=year,
+                        make=target.make,
+                        model=model,
+                        color=color,
+                        vin=vin,
+                        stock_num=stock_num,
+                        row=row,
+                        date=date,
+                        image=image,
+                    )
+
+                    cars.append(car_data)
+                except ValueError:
+                    # Handle the case where conversion to int fails (e.g., year is not a number)
+                    print(f"{str(datetime.now())} - Skipping row with invalid data: {col_data}")
+                    update_health_status("unhealthy")
+    else:
+        print(f"{str(datetime.now())} - Table not found.")
+        h2 = soup.find('h2')
+        if h2:
+            if "I'm sorry but there are no matching vehicles at" in h2.text:
+                print(f"{str(datetime.now())} - No {target.make} vehicles found in Pull-n-Save.")
+            else:
+                print(f"{str(datetime.now())} - Unexpected text found: {h2.text}")
                 health = "unhealthy"
+        else:
+            print(f"{str(datetime.now())} - h2 text not found.")
+            health = "unhealthy"
 
-        # Fetch all records from MongoDB
-        existing_cars = fetch_all_records(yard)
+    return cars, health
 
-        # Delete old records not found in the latest search
-        delete_old_records(existing_cars, cars_of_interest)
+def search_yard(yard):
+    try:
+        collection = get_collection()
+        snapshot = Snapshot(f"{SOURCE}-{yard}")
+        stages = Stages(SOURCE)
+        targets = search_targets(SOURCE)
+
+        # Every make is searched at once
+        responses = fan_out(SOURCE, lambda target: fetch_inventory(yard, target, snapshot), targets)
+        # Skip parsing entirely if none of the pages changed since the last run
+        unchanged = [snapshot.response_unchanged(response_key(target), response) for target, response in zip(targets, responses)]
+        if all(unchanged):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Inventory page unchanged since the last run, skipping.")
+            # An unchanged inventory is a run without changes, which the scheduler learns from too
+            count_changes(SOURCE, 0)
+            update_health_status("healthy")
+            return
+        # A 304 has no page to parse, so those makes are searched again in full
+        responses = [fetch_inventory(yard, target) if response.status_code == 304 else response for target, response in zip(targets, responses)]
+
+        stages.start("parse")
+        cars_of_interest = []
+        health = "healthy"
+        for target, response in zip(targets, responses):
+            cars, page_health = parse_inventory(yard, target, response)
+            cars_of_interest.extend(cars)
+            if page_health != "healthy":
+                health = page_health
+        # Sold cars can only be told apart when every page was read, otherwise a
+        # broken page would make all its cars look sold
+        complete = health == "healthy"
+
+        # A car listed by more than one search is kept once
+        cars_of_interest = unique_by_stock_num(cars_of_interest)
+
+        # Keep only the cars of interest
+        cars_of_interest = score_vehicles(SOURCE, cars_of_interest)
+
+        # Skip the database entirely if the parsed inventory hasn't changed
+        if complete and snapshot.vehicles_unchanged(cars_of_interest):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Inventory unchanged since the last run, skipping reconcile.")
+            # An unchanged inventory is a run without changes, which the scheduler learns from too
+            count_changes(SOURCE, 0)
+            snapshot.save(reconciled=False)
+            update_health_status(health)
+            return
+
+        stages.start("lookup")
+        # Make sure the reconcile queries are indexed
+        ensure_indexes(collection, SOURCE)
+
+        # Look up which cars are already in the database in one query
+        known_cars = fetch_known_cars(collection, SOURCE, cars_of_interest)
+        new_cars = select_new_cars(cars_of_interest, known_cars)
+
+        # Fetch additional details for the new cars from NHTSA API
+        stages.start("enrich")
+        add_vehicle_details(new_cars, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
+
+        # Add new cars and delete old records not found in the latest search
+        stages.start("reconcile")
+        counts = reconcile(collection, SOURCE, cars_of_interest, known_cars, new_cars=new_cars, scope={"yard": yard}, logging_prefix=LOGGING_PREFIX, delete_stale=complete)
+        # The new cars are stored either way, so they are still notified
+        if not counts["events_logged"]:
+            health = "unhealthy"
+
+        # Send the notifications
+        stages.start("notify")
+        for car_data in new_cars:
+            send_to_home_assistant(car_data)
+        stages.stop()
+
+        # Remember this inventory so unchanged runs can be skipped. Incomplete runs
+        # leave the snapshot alone, so the next run reads every page again.
+        if complete:
+            snapshot.save()
 
         # If everything is successful, set the status to healthy
         update_health_status(health)
@@ -177,5 +216,12 @@ def search_yard(yard):
         print(f"{str(datetime.now())} - An error occurred in pullnsave: {format_exc()}")
         update_health_status("unhealthy")
 
-search_yard(1)
-search_yard(6)
\ No newline at end of file
+def run():
+    """Scrape both Pull-n-Save yards and reconcile them with the database."""
+    search_yard(1)
+    search_yard(6)
+
+if __name__ == "__main__":
+    run()
+    notifier.close()
+    close_connection()
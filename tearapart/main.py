@@ -1,108 +1,109 @@
-import requests
 from dotenv import load_dotenv
 import os
-from pymongo import MongoClient
-from bs4 import BeautifulSoup
 from datetime import datetime
 from traceback import format_exc
+import json
 import re
 import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.churn import count_changes
+from common.db import close_connection, ensure_indexes, fetch_known_cars, get_collection, reconcile, select_new_cars
+from common.fingerprint import Snapshot
+from common.http_client import session
+from common.interest import score_vehicles
+from common.metrics import ROWS_PARSED, Stages
+from common.nhtsa import add_vehicle_details
+from common.notify import notifier
+from common.targets import fan_out, search_targets, unique_by_stock_num
+from common.vehicle import Vehicle
 
 # Load environment variables
 load_dotenv()
 
-# MongoDB connection details
-MONGO_URI = os.getenv('MONGO_URI')
-MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
-MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB_NAME]
-collection = db[MONGO_COLLECTION_NAME]
-
-# Home Assistant webhook URL
-home_assistant_webhook_url = f"https://ha.tsmcclel.top/api/webhook/{os.getenv('HOME_ASSISTANT_WEBHOOK_ID')}"
+LOGGING_PREFIX = "(Tear-A-Part)"
+SOURCE = "tearapart"
+# Records stored before the source field existed, told apart by the fields only this yard wrote.
+# Only Tear-A-Part stored a reference.
+LEGACY_RECORDS = {"reference": {"$exists": True}}
+SEARCH_URL = "https://tearapart.com/wp-admin/admin-ajax.php"
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
+
+# The search nonce is reused across runs until it is this old or the search rejects it
+NONCE_CACHE_PATH = os.getenv('TEARAPART_NONCE_CACHE_PATH', '/tmp/tearapart/nonce.json')
+NONCE_TTL = float(os.getenv('TEARAPART_NONCE_TTL_HOURS', '12')) * 3600
+NONCE_PATTERN = re.compile(rb'sif_ajax_nonce"\s*:\s*"(\w+)"')
+# Bytes carried over between chunks, so a nonce split across two chunks is still found
+NONCE_OVERLAP = 64
+# Searches for different makes run at once and share the cached nonce
+_nonce_lock = threading.Lock()
 
 def send_to_home_assistant(data):
-    response = requests.post(home_assistant_webhook_url, json=data)
-    if response.status_code == 200:
-        print(f"{str(datetime.now())} - Data sent to Home Assistant successfully.")
-    else:
-        print(f"{str(datetime.now())} - Failed to send data to Home Assistant: {response.status_code}")
-        update_health_status("unhealthy")
+    """Queue a notification, which is sent to Home Assistant in the background."""
+    notifier.send(data, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
 
 def fetch_nonce():
+    """Scan the inventory page for the search nonce as it downloads, without parsing the HTML."""
     try:
         url = "https://tearapart.com/used-auto-parts/inventory/"
         headers = {
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
+            'user-agent': USER_AGENT
         }
 
-        response = requests.get(url, headers=headers)
-        html_content = response.text
+        with session.get(url, headers=headers, stream=True) as response:
+            tail = b""
+            for chunk in response.iter_content(chunk_size=16384):
+                window = tail + chunk
+                nonce_match = NONCE_PATTERN.search(window)
+                if nonce_match:
+                    return nonce_match.group(1).decode()
+                tail = window[-NONCE_OVERLAP:]
 
-        soup = BeautifulSoup(html_content, 'html.parser')
-        script_tag = soup.find('script', {'id': 'sif_plugin js frontend main-js-extra'})
-        script_content = script_tag.string
-
-        nonce_match = re.search(r'sif_ajax_nonce":"(\w+)"', script_content)
-        return nonce_match.group(1) if nonce_match else None
-    except Exception as e:
-        print(f"{str(datetime.now())} - Error fetching nonce: {str(e)}")
-        update_health_status("unhealthy")
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Nonce not found on the inventory page.")
         return None
-
-def fetch_all_records():
-    """Fetch all records from MongoDB collection."""
-    return list(collection.find())
-
-def delete_old_records(existing_cars, latest_cars):
-    """Delete records from MongoDB that are not found in the latest search."""
-    latest_stock_nums = [car['stock_num'] for car in latest_cars]
-
-    for car in existing_cars:
-        if car['stock_num'] not in latest_stock_nums:
-            collection.delete_one({"stock_num": car['stock_num']})
-            print(f"{str(datetime.now())} - Deleted record with stock_num: {car['stock_num']}")
-
-def fetch_vehicle_details(vin):
-    """Fetch vehicle details from NHTSA API using VIN."""
-    try:
-        nhtsa_api_url = f"https://vpic.nhtsa.dot.gov/api/vehicles/decodevinvalues/{vin}?format=json"
-        response = requests.get(nhtsa_api_url)
-        if response.status_code == 200:
-            data = response.json()
-            series = data['Results'][0]['Series']
-            return series
-        else:
-            print(f"{str(datetime.now())} - Failed to fetch vehicle details for VIN {vin}.")
-            update_health_status("unhealthy")
-            return None
     except Exception as e:
-        print(f"{str(datetime.now())} - Error fetching vehicle details for VIN {vin}: {str(e)}")
+        print(f"{str(datetime.now())} - Error fetching nonce: {str(e)}")
         update_health_status("unhealthy")
         return None
 
-def update_health_status(status):
-    directory = "/tmp/tearapart"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    with open(f"{directory}/health_status.txt", "w") as file:
-        file.write(status)
-
-try:
-    # Tear A Part API endpoint
-    url = "https://tearapart.com/wp-admin/admin-ajax.php"
-
+def get_nonce(rejected=None):
+    """
+    Return the cached search nonce, fetching a new one if it is missing, expired or the one the search just rejected.
+
+    A search that lost the race to replace a rejected nonce gets the one
+    another search already fetched.
+    """
+    with _nonce_lock:
+        if os.path.exists(NONCE_CACHE_PATH):
+            try:
+                with open(NONCE_CACHE_PATH) as file:
+                    cached = json.load(file)
+                if cached.get('nonce') and cached['nonce'] != rejected and time.time() - cached.get('fetched_at', 0) < NONCE_TTL:
+                    return cached['nonce']
+            except ValueError:
+                pass
+
+        nonce = fetch_nonce()
+        if nonce:
+            directory = os.path.dirname(NONCE_CACHE_PATH)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(NONCE_CACHE_PATH, "w") as file:
+                json.dump({"nonce": nonce, "fetched_at": time.time()}, file)
+        return nonce
+
+def search_inventory(nonce, target):
+    """Run one make's inventory search with the given nonce and return the response."""
     # Payload for the POST request
     payload = {
         # "sif_form_field_store": "SALT LAKE CITY",
-        "sif_form_field_make": "MERCEDES-BENZ",
+        "sif_form_field_make": target.query,
         "makes-sorting-order": "0",
         "models-sorting-order": "0",
         "action": "sif_search_products",
-        "sif_verify_request": fetch_nonce(),
+        "sif_verify_request": nonce,
         "sorting[key]": "iyear",
         "sorting[state]": "0",
         "sorting[type]": "int"
@@ -110,99 +111,158 @@ try:
 
     headers = {
         'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
+        'user-agent': USER_AGENT
     }
 
-    cars = []
+    return session.post(SEARCH_URL, headers=headers, data=payload)
+
+def nonce_rejected(response):
+    """Return whether the search refused the nonce. WordPress answers -1 (or 403) to an expired one."""
+    body = response.text.strip()
+    return response.status_code == 403 or body == "-1" or ('nonce' in body.lower() and 'products' not in body)
 
+def update_health_status(status):
+    directory = "/tmp/tearapart"
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(f"{directory}/health_status.txt", "w") as file:
+        file.write(status)
+
+def search(target):
+    """Run one make's inventory search. Returns its cars, or None if the search failed."""
     try:
-        response = requests.post(url, headers=headers, data=payload)
+        nonce = get_nonce()
+        response = search_inventory(nonce, target)
+        if nonce_rejected(response):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Search rejected the cached nonce, fetching a new one and retrying.")
+            response = search_inventory(get_nonce(rejected=nonce), target)
         response.raise_for_status()  # Check for HTTP errors
 
         try:
             data = response.json()  # Attempt to parse JSON response
             if 'products' in data:
-                cars = data['products']
-                print(f"{str(datetime.now())} - Succesfully fetched {len(cars)} cars from Tear-A-Part.")
+                print(f"{str(datetime.now())} - Succesfully fetched {len(data['products'])} {target.make} cars from Tear-A-Part.")
+                return data['products']
             else:
                 print("Error: 'products' key not found in the response")
                 update_health_status("unhealthy")
-                sys.exit(1)
+                return None
         except Exception as e:
             print("Error: Failed to parse JSON response")
             update_health_status("unhealthy")
-            sys.exit(1)
+            return None
 
     except Exception as e:
         print(f"{str(datetime.now())} - Error: Request failed - {e}")
         update_health_status("unhealthy")
-        sys.exit(1)
-
-    # List to store cars of interest
-    cars_of_interest = []
-
-    # Iterate through each car in the response
-    for car in cars:
-        try:
-            yard_name = car['yard_name']
-            year = int(car['iyear'])
-            model = (car['model'] or car['hol_model']).upper()
-            color = car['color']
-            vin = car['vin'].strip()
-            stock_num = car['stocknumber']
-            reference = car['reference']
-            row = car['vehicle_row']
-            date = car['yard_date']
-            image_url = car['image_url'].strip().split('"')[1]  # Extract image URL from HTML string
-
-            # Apply filter criteria
-            if (year >= 1976 and year <= 1985) or (year >= 1996 and year <= 2002 and model == "E-CLASS"):
-                car_data = {
-                    "location": yard_name,
-                    "year": year,
-                    "model": model,
-                    "color": color,
-                    "vin": vin,
-                    "stock_num": stock_num,
-                    "reference": reference,
-                    "row": row,
-                    "date": date,
-                    "image": image_url
-                }
-
-                # Check if the car is already in the database
-                existing_car = collection.find_one({"stock_num": stock_num})
-                if existing_car is None:
-                    # Fetch additional details from NHTSA API
-                    if len(vin) == 17:  # Check if VIN is 17 characters
-                        series = fetch_vehicle_details(vin)
-                        if series:
-                            car_data['series'] = series
-                    
-                    # Send the notification
-                    send_to_home_assistant(car_data)
-                    # Add the car to the database
-                    collection.insert_one(car_data)
-
-                cars_of_interest.append(car_data)
-
-        except ValueError:
-            # Handle cases where conversion to int fails
-            print(f"{str(datetime.now())} - Skipping row with invalid data: {car}")
-            update_health_status("unhealthy")
-
-    # Fetch all records from MongoDB
-    existing_cars = fetch_all_records()
-
-    # Delete old records not found in the latest search
-    delete_old_records(existing_cars, cars_of_interest)
+        return None
 
-    # If everything is successful, set the status to healthy
-    update_health_status("healthy")
+def run():
+    """Scrape the Tear-A-Part inventory and reconcile it with the database."""
+    try:
+        collection = get_collection()
+        snapshot = Snapshot(SOURCE)
+        stages = Stages(SOURCE)
+        targets = search_targets(SOURCE)
+
+        # Every make is searched at once, and the run stops if any search failed so
+        # its cars aren't taken for sold
+        results = fan_out(SOURCE, search, targets)
+        if any(cars is None for cars in results):
+            return
+
+        stages.start("parse")
+        ROWS_PARSED.labels(source=SOURCE).inc(sum(len(cars) for cars in results))
+        # List to store cars of interest
+        cars_of_interest = []
+
+        # Iterate through each car in the responses
+        for target, cars in zip(targets, results):
+            for car in cars:
+                try:
+                    yard_name = car['yard_name']
+                    year = int(car['iyear'])
+                    model = (car['model'] or car['hol_model']).upper()
+                    color = car['color']
+                    vin = car['vin'].strip()
+                    stock_num = car['stocknumber']
+                    reference = car['reference']
+                    row = car['vehicle_row']
+                    date = car['yard_date']
+                    image_url = car['image_url'].strip().split('"')[1]  # Extract image URL from HTML string
+
+                    car_data = Vehicle(
+                        source=SOURCE,
+                        location=yard_name,
+                        year=year,
+                        make=target.make,
+                        model=model,
+                        color=color,
+                        vin=vin,
+                        stock_num=stock_num,
+                        reference=reference,
+                        row=row,
+                        date=date,
+                        image=image_url,
+                    )
+
+                    cars_of_interest.append(car_data)
+
+                except ValueError:
+                    # Handle cases where conversion to int fails
+                    print(f"{str(datetime.now())} - Skipping row with invalid data: {car}")
+                    update_health_status("unhealthy")
+
+        # A car listed by more than one search is kept once
+        cars_of_interest = unique_by_stock_num(cars_of_interest)
+
+        # Keep only the cars of interest
+        cars_of_interest = score_vehicles(SOURCE, cars_of_interest)
+
+        # Skip the database entirely if the parsed inventory hasn't changed
+        if snapshot.vehicles_unchanged(cars_of_interest):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Inventory unchanged since the last run, skipping reconcile.")
+            # An unchanged inventory is a run without changes, which the scheduler learns from too
+            count_changes(SOURCE, 0)
+            snapshot.save(reconciled=False)
+            update_health_status("healthy")
+            return
+
+        stages.start("lookup")
+        # Make sure the reconcile queries are indexed
+        ensure_indexes(collection, SOURCE)
+
+        # Look up which cars are already in the database in one query
+        known_cars = fetch_known_cars(collection, SOURCE, cars_of_interest)
+        new_cars = select_new_cars(cars_of_interest, known_cars)
+
+        # Fetch additional details for the new cars from NHTSA API
+        stages.start("enrich")
+        add_vehicle_details(new_cars, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
+
+        # Add new cars and delete old records not found in the latest search
+        stages.start("reconcile")
+        counts = reconcile(collection, SOURCE, cars_of_interest, known_cars, new_cars=new_cars, legacy=LEGACY_RECORDS, logging_prefix=LOGGING_PREFIX)
+        # The new cars are stored either way, so they are still notified
+        health = "healthy" if counts["events_logged"] else "unhealthy"
+
+        # Send the notifications
+        stages.start("notify")
+        for car_data in new_cars:
+            send_to_home_assistant(car_data)
+        stages.stop()
+
+        # Remember this inventory so unchanged runs can be skipped
+        snapshot.save()
+
+        # If everything is successful, set the status to healthy
+        update_health_status(health)
 
-except Exception as e:
-    print(f"{str(datetime.now())} - An error occurred in tearapart: {format_exc()}")
-    update_health_status("unhealthy")
+    except Exception as e:
+        print(f"{str(datetime.now())} - An error occurred in tearapart: {format_exc()}")
+        update_health_status("unhealthy")
 
-# Close MongoDB connection
-client.close()
+if __name__ == "__main__":
+    run()
+    notifier.close()
+    close_connection()
@@ -0,0 +1,193 @@
+"""
+Query plans of the reconcile queries on a real MongoDB server.
+
+mongomock and the benchmarks' in-memory stand-in have no query planner, so
+these tests need a real server: the mongod at TEST_MONGO_URI (default
+mongodb://localhost:27017), or else a throwaway one started from the mongod
+binary on the PATH. Without either they are skipped, so the plans are only
+checked where MongoDB is installed or reachable. Set TEST_MONGO_REQUIRED=true
+to fail instead, e.g. in CI. They seed a throwaway database, build the
+indexes with common.db.ensure_indexes and check with explain() that every
+lookup reconcile sends, with the scope or legacy filter each adapter passes,
+is an index scan that only reads that adapter's records.
+"""
+from datetime import datetime
+import importlib
+import os
+import shutil
+import socket
+import subprocess
+import sys
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import db
+from common.runtime import ADAPTERS
+
+TEST_MONGO_URI = os.getenv('TEST_MONGO_URI', 'mongodb://localhost:27017')
+TEST_MONGO_REQUIRED = os.getenv('TEST_MONGO_REQUIRED', 'false').lower() == 'true'
+DATABASE = "junkyard_index_test"
+SIZE = 20000
+SOURCES = len(ADAPTERS)
+YARDS = 4
+# Untagged records from before the source field, which the legacy filters attribute to a yard
+LEGACY = 400
+LEGACY_FIELDS = [{"reference": "1"}, {"location_id": 1}, {"trim": "E320"}, {"location": "Hebron", "image_urls": []}]
+
+def build_inventory():
+    """Return synthetic inventory records, with the fields the scrapers store, and untagged legacy records."""
+    now = datetime.utcnow()
+    records = [
+        {
+            "source": ADAPTERS[index % SOURCES],
+            "location": f"yard{index // SOURCES % YARDS}",
+            "yard": f"yard{index // SOURCES % YARDS}",
+            "stock_num": f"{index:08d}",
+            "year": 1970 + index % 50,
+            "model": "E-CLASS",
+            "image": None if index % 10 == 0 else f"https://images.example.com/{index}.jpg",
+            "first_seen": now,
+        }
+        for index in range(SIZE)
+    ]
+    records += [
+        {"location": f"yard{index % YARDS}", "stock_num": f"L{index:07d}", "year": 1990, "model": "E-CLASS", **LEGACY_FIELDS[index % len(LEGACY_FIELDS)]}
+        for index in range(LEGACY)
+    ]
+    return records
+
+def connect(uri, timeout_ms):
+    """Return a client of the server at uri, or None if it doesn't answer a ping in time."""
+    client = MongoClient(uri, serverSelectionTimeoutMS=timeout_ms)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        client.close()
+        return None
+    return client
+
+def start_mongod(directory):
+    """Start a throwaway mongod on a free port, logging to directory/mongod.log. Returns the process and its URI, or None if mongod isn't installed."""
+    binary = shutil.which("mongod")
+    if binary is None:
+        return None
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [binary, "--dbpath", str(directory), "--port", str(port), "--bind_ip", "127.0.0.1", "--logpath", str(directory / "mongod.log")],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return process, f"mongodb://127.0.0.1:{port}"
+
+@pytest.fixture(scope="module")
+def collection(tmp_path_factory):
+    client = connect(TEST_MONGO_URI, 1000)
+    process = None
+    directory = tmp_path_factory.mktemp("mongod")
+    if client is None:
+        started = start_mongod(directory)
+        if started is not None:
+            process, uri = started
+            client = connect(uri, 20000)
+    try:
+        if client is None:
+            message = f"no MongoDB server reachable at {TEST_MONGO_URI}, and {'the mongod started from the PATH never answered' if process else 'no mongod on the PATH to start one'}"
+            if process is not None:
+                # Say why it didn't come up, e.g. an unsupported CPU or a missing library
+                log = directory / "mongod.log"
+                tail = log.read_text().splitlines()[-5:] if log.exists() else []
+                message += f" (exit code {process.poll()}): " + " | ".join(tail)
+            if TEST_MONGO_REQUIRED:
+                pytest.fail(message)
+            pytest.skip(message)
+        client.drop_database(DATABASE)
+        collection = client[DATABASE]["inventory"]
+        collection.insert_many(build_inventory(), ordered=False)
+        db.ensure_indexes(collection, "test")
+        yield collection
+        client.drop_database(DATABASE)
+        client.close()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+def plan_stages(plan):
+    """Return the stages of a winning plan from the root down."""
+    # Servers running the slot-based engine nest the classic plan one level deeper
+    plan = plan.get("queryPlan", plan)
+    stages = [plan["stage"]]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages += plan_stages(child)
+    return stages
+
+def explain(collection, query, projection=None):
+    explained = collection.find(query, projection).explain()
+    return plan_stages(explained["queryPlanner"]["winningPlan"]), explained["executionStats"]
+
+# The stale lookup filter of every adapter, as its run() passes scope or legacy to reconcile
+SCOPED = {"lkq": {"location": "yard0"}, "utpap": {"location": "yard0"}, "pullnsave": {"yard": "yard0"}}
+STALE_FILTERS = {
+    name: db.stored_filter(name, SCOPED[name]) if name in SCOPED else db.stored_filter(name, legacy=importlib.import_module(f"{name}.main").LEGACY_RECORDS)
+    for name in ADAPTERS
+}
+
+# The yard every other query is sent for, its latest search and its stale cars
+SOURCE = "lkq"
+LATEST = [f"{index:08d}" for index in range(ADAPTERS.index(SOURCE), 800, SOURCES * YARDS)]
+STALE = [f"{index:08d}" for index in range(800 + ADAPTERS.index(SOURCE), 1200, SOURCES * YARDS)]
+
+QUERIES = {
+    "known cars": ({"source": {"$in": [SOURCE, None]}, "stock_num": {"$in": LATEST}}, {"_id": 0, "stock_num": 1, "source": 1}),
+    "stale details": ({**STALE_FILTERS[SOURCE], "stock_num": {"$in": STALE}}, {"_id": 0, "stock_num": 1, "year": 1, "model": 1, "first_seen": 1}),
+    "update": ({"source": {"$in": [SOURCE, None]}, "stock_num": LATEST[0]}, None),
+    "updated records": ({"source": SOURCE, "stock_num": {"$in": LATEST[:5]}}, {"_id": 0}),
+}
+
+@pytest.mark.parametrize("name", list(QUERIES))
+def test_reconcile_queries_use_an_index(collection, name):
+    query, projection = QUERIES[name]
+
+    stages, stats = explain(collection, query, projection)
+
+    assert "IXSCAN" in stages
+    assert "COLLSCAN" not in stages
+    # Never more than the records of the one source, however the plan is shaped
+    assert stats["totalDocsExamined"] <= SIZE // SOURCES + LEGACY
+
+@pytest.mark.parametrize("name", ADAPTERS)
+def test_stale_ids_scan_an_index_for_each_branch(collection, name):
+    query = STALE_FILTERS[name]
+
+    stages, stats = explain(collection, query, {"_id": 0, "stock_num": 1})
+
+    # Both the tagged and the untagged records of the yard are found through an index
+    assert "$or" in query
+    assert stages.count("IXSCAN") >= 2
+    assert "COLLSCAN" not in stages
+    # The untagged branch has to read its records to check the legacy filter, but
+    # nothing outside this source and the untagged records is ever read
+    own = collection.count_documents({"source": name, **SCOPED.get(name, {})})
+    assert stats["nReturned"] >= own
+    assert stats["totalDocsExamined"] <= own + LEGACY
+
+def test_non_unique_key_is_kept_across_starts_when_duplicates_exist(collection):
+    duplicates = collection.database["inventory_duplicates"]
+    duplicates.insert_many([{"source": "jacks", "stock_num": "1"}, {"source": "jacks", "stock_num": "1"}])
+    duplicates.create_index([("source", 1), ("stock_num", 1)])
+
+    db.ensure_unique_key(duplicates)
+    indexes = duplicates.index_information()
+    db.ensure_unique_key(duplicates)
+
+    assert db.NON_UNIQUE_KEY_INDEX in indexes
+    assert "source_1_stock_num_1" not in indexes
+    # The second start changed nothing
+    assert duplicates.index_information() == indexes
+    duplicates.drop()
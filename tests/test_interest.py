@@ -0,0 +1,31 @@
+"""Tests of the default interest rules in interest_rules.json."""
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.interest import InterestRules
+from common.vehicle import Vehicle
+
+@pytest.fixture(scope="module")
+def rules():
+    return InterestRules.from_file()
+
+@pytest.mark.parametrize("yard", ["tearapart", "utpap", "pullnsave", "jacks"])
+def test_classic_years_of_another_make_are_not_of_interest(rules, yard):
+    car = Vehicle(source=yard, year=1980, make="Toyota", model="Corolla", stock_num="1")
+
+    assert rules.for_yard(yard).level(car) == 0
+
+@pytest.mark.parametrize("yard", ["tearapart", "utpap", "pullnsave"])
+def test_yards_with_a_minimum_level_keep_only_the_mercedes_classics(rules, yard):
+    cars = [
+        Vehicle(source=yard, year=1980, make="MERCEDES-BENZ", model="300D", stock_num="1"),
+        Vehicle(source=yard, year=1980, make="TOYOTA", model="COROLLA", stock_num="2"),
+        Vehicle(source=yard, year=1999, make="FORD", model="E-CLASS", stock_num="3"),
+    ]
+
+    kept = rules.for_yard(yard).score(cars)
+
+    assert [car['stock_num'] for car in kept] == ["1"]
@@ -0,0 +1,44 @@
+"""Tests of the LKQ pagination, with the page fetches and parsing replaced by canned pages."""
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.targets import SearchTarget
+from lkq import main as lkq
+
+TARGET = SearchTarget(make="MERCEDES-BENZ", query="mercedes")
+
+def cars(*stock_nums):
+    return [{"stock_num": stock_num} for stock_num in stock_nums]
+
+@pytest.fixture
+def site(monkeypatch):
+    """Serve canned pages by number. Pages past the last one repeat it, like the site does."""
+    requested = []
+    pages = {}
+
+    def fetch_page(page_num, yard, target):
+        requested.append(page_num)
+        return page_num
+
+    def parse_page(page_num, yard):
+        return pages[min(page_num, max(pages))], False
+
+    monkeypatch.setattr(lkq, "fetch_page", fetch_page)
+    monkeypatch.setattr(lkq, "parse_page", parse_page)
+    monkeypatch.setattr(lkq, "MAX_PAGES", 20)
+    return pages, requested
+
+@pytest.mark.parametrize("concurrency", [1, 2, 4])
+def test_a_repeat_of_a_later_page_ends_the_results(site, monkeypatch, concurrency):
+    pages, requested = site
+    pages.update({1: cars("1", "2"), 2: cars("3", "4")})
+    monkeypatch.setattr(lkq, "PAGE_CONCURRENCY", concurrency)
+
+    found, complete = lkq.fetch_remaining_pages("1581", TARGET, pages[1])
+
+    assert [car["stock_num"] for car in found] == ["1", "2", "3", "4"]
+    assert complete
+    assert max(requested) < 3 + concurrency
@@ -0,0 +1,110 @@
+"""Tests of the batched vPIC decoding, against a local stub of DecodeVINValuesBatch."""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import nhtsa
+from common.http_client import session
+
+def vin(index):
+    return f"WDBJF65J1YB{index:06d}"
+
+class StubVpic(BaseHTTPRequestHandler):
+    """Answers DecodeVINValuesBatch with a Series and Trim for every VIN, except the VINs given no trim."""
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['content-length'])).decode())
+        vins = form['data'][0].split(";")
+        self.server.chunks.append(vins)
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.end_headers()
+            return
+        results = [
+            {"VIN": vin, "Series": f"E320 {vin[-3:]}", "Trim": "" if vin in self.server.no_trim else "Sport"}
+            for vin in vins
+        ]
+        body = json.dumps({"Count": len(results), "Results": results}).encode()
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def vpic(monkeypatch, tmp_path):
+    """Serve the stub, and point the decoder and its cache at it and a fresh cache file."""
+    server = HTTPServer(("127.0.0.1", 0), StubVpic)
+    server.chunks = []
+    server.no_trim = set()
+    server.status = 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(nhtsa, "NHTSA_BATCH_URL", f"http://127.0.0.1:{server.server_port}/api/vehicles/DecodeVINValuesBatch/")
+    monkeypatch.setattr(nhtsa, "vin_cache", nhtsa.VinCache(str(tmp_path / "vin_cache.sqlite3")))
+    monkeypatch.setattr(session, "base_url", None)
+    monkeypatch.setattr(session, "max_retries", 0)
+    yield server
+    nhtsa.vin_cache.close()
+    server.shutdown()
+    server.server_close()
+
+def test_vins_are_decoded_in_chunks_of_batch_size(vpic):
+    cars = [{"vin": vin(index)} for index in range(2 * nhtsa.BATCH_SIZE + 20)]
+
+    nhtsa.add_vehicle_details(cars)
+
+    assert [len(chunk) for chunk in vpic.chunks] == [nhtsa.BATCH_SIZE, nhtsa.BATCH_SIZE, 20]
+    assert [vin for chunk in vpic.chunks for vin in chunk] == [car["vin"] for car in cars]
+    assert all(car["series"] and car["trim"] == "Sport" for car in cars)
+
+def test_cached_vins_skip_the_request(vpic):
+    nhtsa.add_vehicle_details([{"vin": vin(index)} for index in range(10)])
+    assert len(vpic.chunks) == 1
+
+    cars = [{"vin": vin(index)} for index in range(10)]
+    nhtsa.add_vehicle_details(cars)
+
+    assert len(vpic.chunks) == 1
+    assert nhtsa.vin_cache.stats()["hits"] == 10
+    assert all(car["series"] == f"E320 {car['vin'][-3:]}" for car in cars)
+
+    nhtsa.add_vehicle_details([{"vin": vin(index)} for index in range(5, 15)])
+
+    assert vpic.chunks[1:] == [[vin(index) for index in range(10, 15)]]
+
+def test_series_and_trim_are_merged_when_decoded(vpic):
+    vpic.no_trim.add(vin(1))
+    cars = [
+        {"vin": vin(0)},
+        {"vin": vin(1), "trim": "E320"},
+        {"vin": "WDB12345", "trim": "Unknown"},
+    ]
+
+    nhtsa.add_vehicle_details(cars)
+
+    assert cars[0] == {"vin": vin(0), "series": "E320 000", "trim": "Sport"}
+    # An empty vPIC field doesn't overwrite what the yard listed
+    assert cars[1] == {"vin": vin(1), "series": "E320 001", "trim": "E320"}
+    # Partial VINs are never sent
+    assert cars[2] == {"vin": "WDB12345", "trim": "Unknown"}
+    assert vpic.chunks == [[vin(0), vin(1)]]
+
+def test_failed_decode_leaves_the_cars_and_calls_on_failure(vpic):
+    vpic.status = 500
+    failures = []
+    cars = [{"vin": vin(0)}]
+
+    nhtsa.add_vehicle_details(cars, "(Test)", on_failure=lambda: failures.append(True))
+
+    assert cars == [{"vin": vin(0)}]
+    assert failures == [True]
+    assert nhtsa.vin_cache.get(vin(0)) is None
@@ -0,0 +1,105 @@
+"""Tests of the notification spool, against a local stub of the Home Assistant webhook."""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.http_client import session
+from common.notify import NotificationDispatcher
+
+class StubWebhook(BaseHTTPRequestHandler):
+    """Records every posted payload and answers with the server's status."""
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        if self.server.status == 200:
+            self.server.payloads.append(payload)
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def webhook(monkeypatch):
+    server = HTTPServer(("127.0.0.1", 0), StubWebhook)
+    server.payloads = []
+    server.status = 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(session, "base_url", None)
+    monkeypatch.setattr(session, "max_retries", 0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def dispatcher(webhook, tmp_path, monkeypatch):
+    monkeypatch.setattr("common.notify.HA_MAX_RETRIES", 0)
+    return NotificationDispatcher(
+        url=f"http://127.0.0.1:{webhook.server_port}/api/webhook/test",
+        max_batch=1,
+        flush_interval=0,
+        spool_path=str(tmp_path / "spool.jsonl"),
+        spool_retry_interval=0.05,
+    )
+
+def write_spool(dispatcher, *cars):
+    with open(dispatcher.spool_path, "w") as file:
+        for car in cars:
+            file.write(json.dumps(car) + "\n")
+
+def test_spooled_cars_are_delivered_when_the_dispatcher_starts(webhook, dispatcher):
+    write_spool(dispatcher, {"stock_num": "spooled"})
+
+    dispatcher.send({"stock_num": "new"})
+    dispatcher.close()
+
+    assert sorted(payload["stock_num"] for payload in webhook.payloads) == ["new", "spooled"]
+    assert not os.path.exists(dispatcher.spool_path)
+
+def test_spooled_cars_survive_close(webhook, dispatcher):
+    dispatcher.spool_retry_interval = 60
+    webhook.status = 500
+    dispatcher.send({"stock_num": "failed"})
+    dispatcher.flush()
+
+    webhook.status = 200
+    dispatcher.send({"stock_num": "new"})
+    dispatcher.close()
+
+    assert [payload["stock_num"] for payload in webhook.payloads] == ["new"]
+    with open(dispatcher.spool_path) as file:
+        assert [json.loads(line)["stock_num"] for line in file] == ["failed"]
+
+def test_cars_stay_spooled_until_they_are_delivered(webhook, dispatcher):
+    webhook.status = 500
+    write_spool(dispatcher, {"stock_num": "spooled"})
+
+    dispatcher.send({"stock_num": "new"})
+    dispatcher.close()
+
+    assert webhook.payloads == []
+    with open(dispatcher.spool_path) as file:
+        assert sorted(json.loads(line)["stock_num"] for line in file) == ["new", "spooled"]
+
+def test_idle_worker_retries_the_spool(webhook, dispatcher):
+    webhook.status = 500
+    dispatcher.send({"stock_num": "failed"})
+    dispatcher.flush()
+    assert os.path.exists(dispatcher.spool_path)
+
+    webhook.status = 200
+    for _ in range(100):
+        if webhook.payloads:
+            break
+        time.sleep(0.05)
+    dispatcher.close()
+
+    assert [payload["stock_num"] for payload in webhook.payloads] == ["failed"]
+    assert not os.path.exists(dispatcher.spool_path)
@@ -0,0 +1,94 @@
+"""Tests of the adaptive scheduler, driving Jack's adapter with its page fetch and snapshot replaced."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import runtime, scheduler
+from common.churn import ChurnHistory
+from jacks import main as jacks
+
+class UnchangedSnapshot:
+    """A snapshot that reports every page as unchanged since the last run."""
+
+    def __init__(self, key):
+        pass
+
+    def request_headers(self, key):
+        return {}
+
+    def response_unchanged(self, key, response):
+        return True
+
+class Page:
+    def raise_for_status(self):
+        pass
+
+@pytest.fixture
+def yard(monkeypatch, tmp_path):
+    """Schedule only Jack's, with quiet learned churn, and record the interval picked after every run."""
+    monkeypatch.setattr(runtime, "LOCK_DIR", str(tmp_path / "locks"))
+    monkeypatch.setattr(scheduler, "SCHEDULE_JITTER", 0)
+    monkeypatch.setattr(scheduler, "SCHEDULE_STARTUP_SPREAD", 0)
+    monkeypatch.setattr(scheduler, "write_textfile", lambda: None)
+    monkeypatch.setattr(jacks, "Snapshot", UnchangedSnapshot)
+    monkeypatch.setattr(jacks, "get_collection", lambda: None)
+    monkeypatch.setattr(jacks, "update_health_status", lambda status: None)
+    monkeypatch.setattr(jacks.session, "get", lambda *args, **kwargs: Page())
+
+    churn = ChurnHistory(path=str(tmp_path / "churn.json"))
+    # A full day without changes, so the yard is due for the longest interval
+    now = time.time()
+    churn.record("jacks", 0, now - 86400, now)
+    schedule = scheduler.Scheduler({"jacks": jacks}, status_path=str(tmp_path / "status.json"), adaptive=True, churn=churn)
+
+    intervals = []
+    schedule.runs_wanted = 0
+    next_interval = schedule.next_interval
+
+    def record_interval(name, reconciled=True):
+        next_interval(name, reconciled)
+        intervals.append(schedule.yards[name]["interval"])
+        # Run the yard again right away until the test has seen enough runs
+        return -86400 if len(intervals) < schedule.runs_wanted else 86400
+
+    monkeypatch.setattr(schedule, "next_interval", record_interval)
+    return schedule, intervals
+
+def run_scheduler(schedule, intervals, runs):
+    schedule.runs_wanted = runs
+
+    async def main():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            task = asyncio.ensure_future(schedule.run_yard("jacks", executor))
+            while len(intervals) < runs:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(main())
+
+def test_unchanged_inventory_runs_stretch_the_interval(yard):
+    schedule, intervals = yard
+
+    run_scheduler(schedule, intervals, 3)
+
+    assert intervals == [round(scheduler.SCHEDULE_MAX_INTERVAL)] * 3
+    assert schedule.yards["jacks"]["last_changes"] == 0
+
+def test_a_failed_run_falls_back_to_the_configured_interval(yard, monkeypatch):
+    schedule, intervals = yard
+    run_scheduler(schedule, intervals, 1)
+
+    def unreachable(*args, **kwargs):
+        raise ConnectionError("yard unreachable")
+
+    monkeypatch.setattr(jacks.session, "get", unreachable)
+    run_scheduler(schedule, intervals, 2)
+
+    assert intervals == [round(scheduler.SCHEDULE_MAX_INTERVAL), round(scheduler.interval_for("jacks"))]
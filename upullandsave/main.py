@@ -1,68 +1,46 @@
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
-from pymongo import MongoClient
 from datetime import datetime
+from itertools import islice
 from traceback import format_exc
-from urllib.parse import urlparse
+from urllib.parse import quote_plus, urlparse
 import sys
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.churn import count_changes
+from common.db import close_connection, ensure_indexes, fetch_known_cars, fetch_records, get_collection, reconcile, select_new_cars
+from common.fingerprint import Snapshot
+from common.http_client import session
+from common.interest import score_vehicles
+from common.metrics import ROWS_PARSED, Stages, stage_timer
+from common.nhtsa import add_vehicle_details
+from common.notify import notifier
+from common.profiling import trace_thread
+from common.targets import fan_out, search_targets, unique_by_stock_num
+from common.vehicle import Vehicle
+
 # Load environment variables
 load_dotenv()
 
 LOGGING_PREFIX = "(U Pull & Save)"
-
-# MongoDB connection details
-MONGO_URI = os.getenv('MONGO_URI')
-MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
-MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB_NAME]
-collection = db[MONGO_COLLECTION_NAME]
-
-# Home Assistant webhook URL
-home_assistant_webhook_url = f"https://ha.tsmcclel.top/api/webhook/{os.getenv('HOME_ASSISTANT_WEBHOOK_ID')}"
+SOURCE = "upullandsave"
+# Records stored before the source field existed, told apart by the fields only this yard wrote.
+# LKQ and U Pull & Save stored image URLs, and only U Pull & Save is in Hebron.
+LEGACY_RECORDS = {"location": "Hebron", "image_urls": {"$exists": True}}
+# Number of inventory rows requested per window, and how many windows are in flight at once
+WINDOW_SIZE = int(os.getenv('UPULLANDSAVE_WINDOW_SIZE', '100'))
+WINDOW_CONCURRENCY = int(os.getenv('UPULLANDSAVE_WINDOW_CONCURRENCY', '4'))
+# Stop paging at the first window made only of known cars. Sold cars are then only
+# removed by the full sweep done whenever the inventory snapshot has expired.
+INCREMENTAL = os.getenv('UPULLANDSAVE_INCREMENTAL', 'false').lower() == 'true'
+# Fields of the stored cars needed to find the ones whose image was added
+KNOWN_PROJECTION = {"_id": 0, "stock_num": 1, "source": 1, "image": 1}
 
 def send_to_home_assistant(data):
-    response = requests.post(home_assistant_webhook_url, json=data)
-    if response.status_code == 200:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Data sent to Home Assistant successfully.")
-    else:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to send data to Home Assistant: {response.status_code}")
-        update_health_status("unhealthy")
-
-def fetch_all_records():
-    """Fetch all records from MongoDB collection."""
-    return list(collection.find())
-
-def delete_old_records(existing_cars, latest_cars):
-    """Delete records from MongoDB that are not found in the latest search."""
-    latest_stock_nums = [car['stock_num'] for car in latest_cars]
-
-    for car in existing_cars:
-        if car['stock_num'] not in latest_stock_nums:
-            collection.delete_one({"stock_num": car['stock_num']})
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Deleted record: {car}")
-
-def fetch_vehicle_details(vin):
-    """Fetch vehicle details from NHTSA API using VIN."""
-    try:
-        nhtsa_api_url = f"https://vpic.nhtsa.dot.gov/api/vehicles/decodevinvalues/{vin}?format=json"
-        response = requests.get(nhtsa_api_url)
-        if response.status_code == 200:
-            data = response.json()
-            series = data['Results'][0]['Series']
-            return series
-        else:
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Failed to fetch vehicle details for VIN {vin}.")
-            update_health_status("unhealthy")
-            return None
-    except Exception as e:
-        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error fetching vehicle details for VIN {vin}: {str(e)}")
-        update_health_status("unhealthy")
-        return None
+    """Queue a notification, which is sent to Home Assistant in the background."""
+    notifier.send(data, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
 
 def update_health_status(status):
     directory = "/tmp/upullandsave"
@@ -78,131 +56,233 @@ def is_url(string):
     except ValueError:
         return False
 
-def fetch_page(req_start, req_length):
+def fetch_page(req_start, req_length, target):
     url = "https://upullandsave.com/wp-admin/admin-ajax.php"
 
     # Payload for the POST request
-    payload = f"draw=1&columns%5B0%5D%5Bdata%5D=false&columns%5B0%5D%5Bname%5D=&columns%5B0%5D%5Bsearchable%5D=true&columns%5B0%5D%5Borderable%5D=false&columns%5B0%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B0%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B1%5D%5Bdata%5D=&columns%5B1%5D%5Bname%5D=&columns%5B1%5D%5Bsearchable%5D=true&columns%5B1%5D%5Borderable%5D=true&columns%5B1%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B1%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B2%5D%5Bdata%5D=year&columns%5B2%5D%5Bname%5D=&columns%5B2%5D%5Bsearchable%5D=true&columns%5B2%5D%5Borderable%5D=true&columns%5B2%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B2%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B3%5D%5Bdata%5D=make&columns%5B3%5D%5Bname%5D=&columns%5B3%5D%5Bsearchable%5D=true&columns%5B3%5D%5Borderable%5D=true&columns%5B3%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B3%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B4%5D%5Bdata%5D=model&columns%5B4%5D%5Bname%5D=&columns%5B4%5D%5Bsearchable%5D=true&columns%5B4%5D%5Borderable%5D=true&columns%5B4%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B4%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B5%5D%5Bdata%5D=stock_number&columns%5B5%5D%5Bname%5D=&columns%5B5%5D%5Bsearchable%5D=true&columns%5B5%5D%5Borderable%5D=true&columns%5B5%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B5%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B6%5D%5Bdata%5D=color&columns%5B6%5D%5Bname%5D=&columns%5B6%5D%5Bsearchable%5D=true&columns%5B6%5D%5Borderable%5D=true&columns%5B6%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B6%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B7%5D%5Bdata%5D=yard_row&columns%5B7%5D%5Bname%5D=&columns%5B7%5D%5Bsearchable%5D=true&columns%5B7%5D%5Borderable%5D=true&columns%5B7%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B7%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B8%5D%5Bdata%5D=date_set&columns%5B8%5D%5Bname%5D=&columns%5B8%5D%5Bsearchable%5D=true&columns%5B8%5D%5Borderable%5D=true&columns%5B8%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B8%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B9%5D%5Bdata%5D=vin&columns%5B9%5D%5Bname%5D=&columns%5B9%5D%5Bsearchable%5D=true&columns%5B9%5D%5Borderable%5D=true&columns%5B9%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B9%5D%5Bsearch%5D%5Bregex%5D=false&order%5B0%5D%5Bcolumn%5D=8&order%5B0%5D%5Bdir%5D=desc&order%5B0%5D%5Bname%5D=&start={req_start}&length={req_length}&search%5Bvalue%5D=&search%5Bregex%5D=false&action=yardsmart_integration&api_call=getInventoryDatatablesArray&params%5Byard_id%5D=232&params%5Byear%5D=false&params%5Bmake%5D=MERCEDES-BENZ&params%5Bmodel%5D=false&params%5Blog%5D=true"
+    payload = f"draw=1&columns%5B0%5D%5Bdata%5D=false&columns%5B0%5D%5Bname%5D=&columns%5B0%5D%5Bsearchable%5D=true&columns%5B0%5D%5Borderable%5D=false&columns%5B0%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B0%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B1%5D%5Bdata%5D=&columns%5B1%5D%5Bname%5D=&columns%5B1%5D%5Bsearchable%5D=true&columns%5B1%5D%5Borderable%5D=true&columns%5B1%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B1%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B2%5D%5Bdata%5D=year&columns%5B2%5D%5Bname%5D=&columns%5B2%5D%5Bsearchable%5D=true&columns%5B2%5D%5Borderable%5D=true&columns%5B2%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B2%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B3%5D%5Bdata%5D=make&columns%5B3%5D%5Bname%5D=&columns%5B3%5D%5Bsearchable%5D=true&columns%5B3%5D%5Borderable%5D=true&columns%5B3%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B3%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B4%5D%5Bdata%5D=model&columns%5B4%5D%5Bname%5D=&columns%5B4%5D%5Bsearchable%5D=true&columns%5B4%5D%5Borderable%5D=true&columns%5B4%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B4%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B5%5D%5Bdata%5D=stock_number&columns%5B5%5D%5Bname%5D=&columns%5B5%5D%5Bsearchable%5D=true&columns%5B5%5D%5Borderable%5D=true&columns%5B5%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B5%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B6%5D%5Bdata%5D=color&columns%5B6%5D%5Bname%5D=&columns%5B6%5D%5Bsearchable%5D=true&columns%5B6%5D%5Borderable%5D=true&columns%5B6%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B6%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B7%5D%5Bdata%5D=yard_row&columns%5B7%5D%5Bname%5D=&columns%5B7%5D%5Bsearchable%5D=true&columns%5B7%5D%5Borderable%5D=true&columns%5B7%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B7%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B8%5D%5Bdata%5D=date_set&columns%5B8%5D%5Bname%5D=&columns%5B8%5D%5Bsearchable%5D=true&columns%5B8%5D%5Borderable%5D=true&columns%5B8%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B8%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B9%5D%5Bdata%5D=vin&columns%5B9%5D%5Bname%5D=&columns%5B9%5D%5Bsearchable%5D=true&columns%5B9%5D%5Borderable%5D=true&columns%5B9%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B9%5D%5Bsearch%5D%5Bregex%5D=false&order%5B0%5D%5Bcolumn%5D=8&order%5B0%5D%5Bdir%5D=desc&order%5B0%5D%5Bname%5D=&start={req_start}&length={req_length}&search%5Bvalue%5D=&search%5Bregex%5D=false&action=yardsmart_integration&api_call=getInventoryDatatablesArray&params%5Byard_id%5D=232&params%5Byear%5D=false&params%5Bmake%5D={quote_plus(str(target.query))}&params%5Bmodel%5D=false&params%5Blog%5D=true"
     headers = {
     'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
     'referer': 'https://upullandsave.com/hebron-ky/besslers-u-pull-and-save/inventory/'
     }
 
     try:
-        response = requests.post(url, headers=headers, data=payload)
+        response = session.post(url, headers=headers, data=payload)
         response.raise_for_status()  # Check for HTTP errors
         return response.json()  # Return JSON response directly
 
     except Exception as e:
         print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: Request failed - {e}")
         update_health_status("unhealthy")
-        sys.exit(1)
-    
-
-try:
-    cars = []
-    first_page_length = 10  # Number of records to fetch per page
-    data = fetch_page(0, first_page_length)
+        return None
 
-    if 'data' in data:
-        cars = data['data']
-    else:
+def fetch_window(start, target):
+    """Fetch one window of a make's inventory rows. Returns the response, or None if it failed."""
+    data = fetch_page(start, WINDOW_SIZE, target)
+    if data is not None and 'data' not in data:
         print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: 'data' key not found in the response: {data}")
         update_health_status("unhealthy")
-        sys.exit(1)
-
-    records_total = data.get('recordsTotal', 0)
-    if records_total > first_page_length:
-        data = fetch_page(first_page_length, records_total - first_page_length)
-        if 'data' in data:
-            cars.extend(data['data'])
-        else:
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Error: 'data' key not found in the response: {data}")
-            update_health_status("unhealthy")
-            sys.exit(1)
-        
-    print(f"{str(datetime.now())} - Succesfully fetched {len(cars)} cars from U Pull & Save.")
-
-    # List to store cars of interest
-    cars_of_interest = []
-
-    # Iterate through each car in the response
-    for car in cars:
+        return None
+    return data
+
+def iter_windows(target):
+    """
+    Yield a make's inventory one window response at a time, newest first.
+
+    The first window tells us the total number of records. The rest are
+    requested WINDOW_CONCURRENCY at a time and yielded in order as they
+    arrive. Yields None and stops if a window can't be fetched. Closing the
+    generator early cancels the windows that haven't been requested yet.
+    """
+    data = fetch_window(0, target)
+    if data is None:
+        yield None
+        return
+    yield data
+
+    starts = iter(range(WINDOW_SIZE, data.get('recordsTotal', 0), WINDOW_SIZE))
+    with ThreadPoolExecutor(max_workers=WINDOW_CONCURRENCY, initializer=trace_thread, initargs=(SOURCE,)) as executor:
+        in_flight = deque(executor.submit(fetch_window, start, target) for start in islice(starts, WINDOW_CONCURRENCY))
         try:
-            year = int(car['year'])
-            model = (car['model']).upper()
-            vin = car['vin']
-            stock_num = car['stock_number']
-            color = car['color']
-            row = car['yard_row']
-            date = car['date_set']
-            image_url = car['images'][0]['url'] if car['images'] else None
-            image_urls = [image['url'] for image in car['images']] if car['images'] else []
-            interest_level = 0  # Default interest level
-
-            # Apply filter criteria
-            if (year >= 1976 and year <= 1985) or (year >= 1996 and year <= 2002 and model == "E-CLASS"):
-                interest_level = 1
-                
-            car_data = {
-                "location": "Hebron",
-                "year": year,
-                "model": model,
-                "vin": vin,
-                "stock_num": stock_num,
-                "color": color,
-                "row": row,
-                "date": date,
-                "image": image_url,
-                "image_urls": image_urls,
-                "interest_level": interest_level
-            }
-
-            # Check if the car is already in the database
-            existing_car = collection.find_one({"stock_num": stock_num})
-            if existing_car is None:
-                # Fetch additional details from NHTSA API
-                if len(vin) == 17:  # Check if VIN is 17 characters
-                    series = fetch_vehicle_details(vin)
-                    if series:
-                        car_data['series'] = series
-                
-                # Send the notification
-                send_to_home_assistant(car_data)
-                # Add the car to the database
-                collection.insert_one(car_data)
-
-            # Check if image has been added for an existing car if not already present
-            elif existing_car.get("image") is None or not is_url(existing_car["image"]):
-                # Fetch vehicle image if not already present
+            while in_flight:
+                data = in_flight.popleft().result()
+                if data is None:
+                    yield None
+                    return
+                # Keep the pipeline full while this window is being parsed
+                for start in islice(starts, 1):
+                    in_flight.append(executor.submit(fetch_window, start, target))
+                yield data
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+def parse_car(car, target):
+    """Turn one inventory row of a make's search into a car record, or None if the row is invalid."""
+    try:
+        year = int(car['year'])
+        model = (car['model']).upper()
+        vin = car['vin']
+        stock_num = car['stock_number']
+        color = car['color']
+        row = car['yard_row']
+        date = car['date_set']
+        image_url = car['images'][0]['url'] if car['images'] else None
+        image_urls = [image['url'] for image in car['images']] if car['images'] else []
+
+        return Vehicle(
+            source=SOURCE,
+            location="Hebron",
+            year=year,
+            make=target.make,
+            model=model,
+            vin=vin,
+            stock_num=stock_num,
+            color=color,
+            row=row,
+            date=date,
+            image=image_url,
+            image_urls=image_urls,
+        )
+
+    except ValueError:
+        # Handle cases where conversion to int fails
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {car}")
+        update_health_status("unhealthy")
+        return None
+
+def search(target, collection, incremental):
+    """
+    Fetch and parse one make's inventory, parsing each window as it arrives.
+
+    Returns the cars, the stored records looked up along the way by an
+    incremental run, and whether they are only part of the make's inventory:
+    because the search stopped at a window of known cars, or because the
+    listing changed while its windows were fetched. Returns None if a window
+    could not be fetched.
+    """
+    cars = []
+    known_cars = {}
+    records_total = None
+    shifted = False
+    windows = iter_windows(target)
+    for data in windows:
+        if data is None:
+            return None
+        # The windows are offsets into a live listing, so a car added or sold while they
+        # were fetched shifts the rest by a row and another window may skip a car
+        if records_total is None:
+            records_total = data.get('recordsTotal')
+        elif data.get('recordsTotal') != records_total and not shifted:
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} {target.make} inventory changed from {records_total} to {data.get('recordsTotal')} records during the search, keeping cars that weren't listed.")
+            shifted = True
+        rows = data['data']
+        ROWS_PARSED.labels(source=SOURCE).inc(len(rows))
+        with stage_timer(SOURCE, "parse"):
+            window_cars = score_vehicles(SOURCE, [car_data for car_data in (parse_car(row, target) for row in rows) if car_data is not None])
+        cars.extend(window_cars)
+
+        if incremental:
+            window_known = fetch_known_cars(collection, SOURCE, window_cars, projection=KNOWN_PROJECTION)
+            known_cars.update(window_known)
+            # Newest cars come first, so a window of known cars means the rest are known too
+            if window_cars and all(car_data['stock_num'] in window_known for car_data in window_cars):
+                windows.close()
+                print(f"{str(datetime.now())} - {LOGGING_PREFIX} Reached a window of known {target.make} cars, skipping the rest of its inventory.")
+                return cars, known_cars, True
+    return cars, known_cars, shifted
+
+def run():
+    """Scrape the U Pull & Save inventory and reconcile it with the database."""
+    try:
+        collection = get_collection()
+        snapshot = Snapshot(SOURCE)
+        # Windows are parsed while the next ones download, so the fetch stage includes the parse time
+        stages = Stages(SOURCE)
+        # Incremental runs need a recent full sweep to stand on
+        incremental = INCREMENTAL and snapshot.is_fresh()
+        if incremental:
+            ensure_indexes(collection, SOURCE)
+
+        # Every make is searched at once, and the run stops if any search failed so
+        # its cars aren't taken for sold
+        results = fan_out(SOURCE, lambda target: search(target, collection, incremental), search_targets(SOURCE))
+        if any(result is None for result in results):
+            return
+
+        # A car listed by more than one search is kept once
+        cars_of_interest = unique_by_stock_num(car_data for cars, _, _ in results for car_data in cars)
+        known_cars = {}
+        for _, search_known, _ in results:
+            known_cars.update(search_known)
+        # Sold cars can only be told apart when every search covered its whole inventory
+        partial = any(search_partial for _, _, search_partial in results)
+
+        print(f"{str(datetime.now())} - Succesfully fetched {len(cars_of_interest)} cars from U Pull & Save.")
+
+        # Skip the database entirely if the parsed inventory hasn't changed
+        if not partial and snapshot.vehicles_unchanged(cars_of_interest):
+            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Inventory unchanged since the last run, skipping reconcile.")
+            # An unchanged inventory is a run without changes, which the scheduler learns from too
+            count_changes(SOURCE, 0)
+            snapshot.save(reconciled=False)
+            update_health_status("healthy")
+            return
+
+        stages.start("lookup")
+        if not incremental:
+            # Make sure the reconcile queries are indexed
+            ensure_indexes(collection, SOURCE)
+
+            # Look up which cars are already in the database in one query
+            known_cars = fetch_known_cars(collection, SOURCE, cars_of_interest, projection=KNOWN_PROJECTION)
+        new_cars = select_new_cars(cars_of_interest, known_cars)
+
+        # Fetch additional details for the new cars from NHTSA API
+        stages.start("enrich")
+        add_vehicle_details(new_cars, LOGGING_PREFIX, on_failure=lambda: update_health_status("unhealthy"))
+
+        # Check if image has been added for existing cars if not already present
+        latest_cars = {car_data['stock_num']: car_data for car_data in cars_of_interest}
+        image_updates = []
+        for stock_num, existing_car in known_cars.items():
+            if existing_car.get("image") is None or not is_url(existing_car["image"]):
+                image_url = latest_cars[stock_num]["image"]
+                image_urls = latest_cars[stock_num]["image_urls"]
                 if image_url and image_url != existing_car.get("image"):
                     print(f"{str(datetime.now())} - {LOGGING_PREFIX} Updating image for existing car: {stock_num}")
                     existing_car["image"] = image_url
                     existing_car["image_urls"] = image_urls
-                    collection.update_one({"stock_num": stock_num}, {"$set": {"image": image_url, "image_urls": image_urls}})
-                    # Send to Home Assistant minus the Object ID
-                    existing_car.pop("_id", None)
-                    send_to_home_assistant(existing_car)
-
-            cars_of_interest.append(car_data)
+                    image_updates.append((stock_num, {"image": image_url, "image_urls": image_urls}))
 
-        except ValueError:
-            # Handle cases where conversion to int fails
-            print(f"{str(datetime.now())} - {LOGGING_PREFIX} Skipping row with invalid data: {car}")
-            update_health_status("unhealthy")
+        # Add new cars, update images and delete old records not found in the latest search.
+        # Sold cars can only be told apart when the whole inventory was fetched.
+        stages.start("reconcile")
+        counts = reconcile(collection, SOURCE, cars_of_interest, known_cars, new_cars=new_cars, updates=image_updates, legacy=LEGACY_RECORDS, logging_prefix=LOGGING_PREFIX, delete_stale=not partial)
+        # The new cars are stored either way, so they are still notified
+        health = "healthy" if counts["events_logged"] else "unhealthy"
+        # The whole record is only read for the cars that got an image
+        updated_cars = list(fetch_records(collection, SOURCE, [stock_num for stock_num, _ in image_updates]).values())
 
-    # Fetch all records from MongoDB
-    existing_cars = fetch_all_records()
+        # Send the notifications
+        stages.start("notify")
+        for car_data in new_cars + updated_cars:
+            send_to_home_assistant(car_data)
+        stages.stop()
 
-    # Delete old records not found in the latest search
-    delete_old_records(existing_cars, cars_of_interest)
+        # Remember this inventory so unchanged runs can be skipped. Partial runs
+        # leave the snapshot to expire, so a full sweep still happens on schedule.
+        if not partial:
+            snapshot.save()
 
-    # If everything is successful, set the status to healthy
-    update_health_status("healthy")
+        # If everything is successful, set the status to healthy
+        update_health_status(health)
 
-except Exception as e:
-    print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in U Pull & Save: {format_exc()}")
-    update_health_status("unhealthy")
+    except Exception as e:
+        print(f"{str(datetime.now())} - {LOGGING_PREFIX} An error occurred in U Pull & Save: {format_exc()}")
+        update_health_status("unhealthy")
 
-# Close MongoDB connection
-client.close()
+if __name__ == "__main__":
+    run()
+    notifier.close()
+    close_connection()